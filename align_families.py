@@ -3,6 +3,7 @@ from __future__ import division
 import os
 import sys
 import time
+import select
 import tempfile
 import argparse
 import subprocess
@@ -13,6 +14,12 @@ from lib import simplewrap
 from lib import version
 from ET import phone
 import seqtools
+import famfile
+import bgzf
+import famcounts
+import msa
+import poa
+import star
 
 #TODO: Warn if it looks like the two input FASTQ files are the same (i.e. the _1 file was given
 #      twice). Can tell by whether the alpha and beta (first and last 12bp) portions of the barcodes
@@ -20,8 +27,24 @@ import seqtools
 #      to make, but it's not obvious that it happened. The pipeline won't fail, but will just
 #      produce pretty weird results.
 
-REQUIRED_COMMANDS = ['mafft']
-OPT_DEFAULTS = {'processes':1}
+REQUIRED_COMMANDS = {'mafft':['mafft'], 'builtin':[], 'poa':[], 'star':[]}
+OPT_DEFAULTS = {'processes':1, 'binary':False, 'compress_output':False, 'min_reads':1,
+                'aligner':'mafft', 'fast_path':False, 'star_above':0, 'align_duplex':False,
+                'window':200, 'mafft_pool':False}
+# How many chunks of duplexes to have out to the workers at once, per worker.
+IN_FLIGHT_PER_WORKER = 8
+# Duplexes are sent to the workers in chunks of at least this many read pairs.
+CHUNK_PAIRS = 200
+# How many windows' worth of finished duplexes can wait in the reorder buffer.
+MAX_BUFFERED_WINDOWS = 4
+# How many groups --mafft-pool can hold, waiting for MAFFT or in its reorder buffer, before it stops
+# reading more input.
+MAFFT_POOL_MAX_PENDING = 1000
+PAIR_FIELDS = ('name1', 'seq1', 'qual1', 'name2', 'seq2', 'qual2')
+# Limits for the ungapped fast path (see is_ungapped()).
+FAST_PATH_MAX_DIFF = 0.1  # The most mismatches a read can have, as a fraction of its length.
+FAST_PATH_K = 8           # The length of the k-mer anchors checked for shifts.
+FAST_PATH_MAX_SHIFT = 3   # How far to look for a shifted anchor.
 DESCRIPTION = """Read in sorted FASTQ data and do multiple sequence alignments of each family."""
 
 
@@ -45,9 +68,58 @@ def main(argv):
               '5. read 1 quality scores\n'
               '6. read 2 name\n'
               '7. read 2 sequence\n'
-              '8. read 2 quality scores'))
+              '8. read 2 quality scores\n'
+              'It can also be in the binary families format written by make_families.py -b, or '
+              'gzipped (BGZF or regular gzip).'))
+  parser.add_argument('-b', '--binary', action='store_true',
+    help=wrap('Write the output in the compact binary families format (see famfile.py) instead of '
+              'text.'))
+  parser.add_argument('-r', '--min-reads', type=int,
+    help=wrap('Skip families (single strands) with fewer than this many read pairs, instead of '
+              'aligning them. Use the same value as dunovo.py --min-reads, which ignores them '
+              'anyway. Default: %(default)s.'))
+  parser.add_argument('-c', '--counts', metavar='COUNTS_FILE',
+    help=wrap('A table of family sizes from make_families.py --counts. With --min-reads, this lets '
+              'the reads of small families be skipped as soon as they\'re read.'))
+  parser.add_argument('-a', '--aligner', choices=('mafft', 'builtin', 'poa', 'star'),
+    help=wrap('The multiple sequence aligner to use. "mafft" runs MAFFT on each family. "builtin" '
+              'aligns in-process with the aligner in msa.c, a progressive alignment meant for '
+              'families of nearly identical reads. It\'s much faster, since it avoids starting a '
+              'process and writing a temporary file for each family. "poa" also aligns in-process, '
+              'with partial-order alignment (poa.c). "star" does a center-star alignment (star.py): '
+              'each read is aligned to the read with the best mean quality score, with a banded '
+              'pairwise alignment. Default: %(default)s.'))
+  parser.add_argument('-S', '--star-above', type=int,
+    help=wrap('Use the center-star alignment for families with more than this many reads, '
+              'whatever the --aligner. Its run time grows linearly with the size of the family, '
+              'so the largest families don\'t hold up a worker for long. Something like 200 works '
+              'well with MAFFT. 0 turns this off, so every family gets the --aligner. '
+              'Default: %(default)s.'))
+  parser.add_argument('-d', '--align-duplex', action='store_true',
+    help=wrap('Align both strands of a duplex together: the reads from each end of the molecule '
+              '(ab/1 with ba/2, and ab/2 with ba/1) go into one alignment instead of two. This '
+              'halves the number of alignments, and lets dunovo.py --aligned-duplex call duplex '
+              'consensus sequences straight from the shared columns.'))
+  parser.add_argument('--fast-path', action='store_true',
+    help=wrap('Give families whose reads are all the same length and only differ by a few '
+              'substitutions an ungapped alignment directly, without running the aligner. This is '
+              'much faster on data with few indels, but the output can differ from the aligner\'s. '
+              'By default, every family goes to the aligner.'))
+  parser.add_argument('-z', '--compress-output', action='store_true',
+    help=wrap('Compress the output with BGZF (gzip-compatible).'))
   parser.add_argument('-p', '--processes', type=int,
     help=wrap('Number of worker subprocesses to use. Must be at least 1. Default: %(default)s.'))
+  parser.add_argument('-W', '--window', type=int,
+    help=wrap('Read ahead this many duplexes and send the most expensive ones (by reads times read '
+              'length) to the workers first, so a large family near the end of a window doesn\'t '
+              'leave one worker finishing alone. The output is still in input order, but only '
+              'comes out a window at a time. Use 1 to send duplexes in input order. '
+              'Default: %(default)s.'))
+  parser.add_argument('--mafft-pool', action='store_true',
+    help=wrap('Run MAFFT from this process, instead of from worker processes: keep up to '
+              '--processes MAFFT processes running at once, feeding them their input and reading '
+              'their output over pipes. Since MAFFT does the real work, this saves the memory of a '
+              'Python process per worker. Only for --aligner mafft. --window doesn\'t apply.'))
   parser.add_argument('--phone-home', action='store_true',
     help=wrap('Report helpful usage data to the developer, to better understand the use cases and '
               'performance of the tool. The only data which will be recorded is the name and '
@@ -72,24 +144,43 @@ def main(argv):
 
   # Check for required commands.
   missing_commands = []
-  for command in REQUIRED_COMMANDS:
+  for command in REQUIRED_COMMANDS[args.aligner]:
     if not distutils.spawn.find_executable(command):
       missing_commands.append(command)
   if missing_commands:
     fail('Error: Missing commands: "'+'", "'.join(missing_commands)+'".')
 
-  if args.infile:
-    infile = open(args.infile)
+  if args.mafft_pool and args.aligner != 'mafft':
+    fail('Error: --mafft-pool only works with --aligner mafft.')
+
+  if args.binary and args.compress_output:
+    fail('Error: The --binary format is already compressed. Don\'t give --compress-output too.')
+
+  infile = bgzf.open_input(args.infile)
+
+  family_counts = None
+  if args.counts and args.min_reads > 1:
+    family_counts, read_pairs = famcounts.load_counts(args.counts)
+
+  if args.binary:
+    outfile = famfile.BinaryWriter(sys.stdout, kind='msa')
   else:
-    infile = sys.stdin
+    outfile = bgzf.open_output(compress=args.compress_output)
 
   # Open all the worker processes.
-  workers = open_workers(args.processes)
+  static = {'aligner':args.aligner, 'fast_path':args.fast_path, 'star_above':args.star_above}
+  if args.mafft_pool:
+    pool = MafftPool(args.processes, static, align_duplex=args.align_duplex)
+  else:
+    pool = WorkerPool(args.processes, static, window=args.window, align_duplex=args.align_duplex)
 
   # Main loop.
-  """This processes whole duplexes (pairs of strands) at a time for a future option to align the
-  whole duplex at a time.
-  duplex data structure:
+  """This processes whole duplexes (pairs of strands) at a time, so --align-duplex can align the
+  whole duplex at once.
+  Here, each read pair is a tuple of its PAIR_FIELDS, which is compact to send to the workers.
+  The pool splits each duplex into the families (or pairs of families) to align, and the workers
+  expand each read into a dict, giving process_group() this duplex data structure (with only the
+  fields of the mate being aligned):
   duplex = {
     'ab': [
       {'name1': 'read_name1a',
@@ -107,54 +198,56 @@ def main(argv):
   e.g.:
   seq = duplex[order][pair_num]['seq1']
   """
-  stats = {'duplexes':0, 'time':0, 'pairs':0, 'runs':0, 'aligned_pairs':0}
-  current_worker_i = 0
+  stats = {'duplexes':0, 'time':0, 'pairs':0, 'runs':0, 'aligned_pairs':0, 'fast_path':0}
   duplex = collections.OrderedDict()
   family = []
   barcode = None
   order = None
-  for line in infile:
-    fields = line.rstrip('\r\n').split('\t')
+  for fields in famfile.read_rows(infile):
     if len(fields) != 8:
       continue
     (this_barcode, this_order, name1, seq1, qual1, name2, seq2, qual2) = fields
+    if family_counts is not None and this_barcode in family_counts:
+      if family_counts[this_barcode][this_order] < args.min_reads:
+        continue
     # If the barcode or order has changed, we're in a new family.
     # Process the reads we've previously gathered as one family and start a new family.
     if this_barcode != barcode or this_order != order:
-      duplex[order] = family
+      if len(family) >= args.min_reads:
+        duplex[order] = family
       # If the barcode is different, we're at the end of the whole duplex. Process the it and start
       # a new one. If the barcode is the same, we're in the same duplex, but we've switched strands.
       if this_barcode != barcode:
         # sys.stderr.write('processing {}: {} orders ({})\n'.format(barcode, len(duplex),
         #                  '/'.join([str(len(duplex[order])) for order in duplex])))
-        output, run_stats, current_worker_i = delegate(workers, stats, duplex, barcode)
-        process_results(output, run_stats, stats)
+        if duplex:
+          for output, run_stats in delegate(pool, stats, duplex, barcode):
+            process_results(output, run_stats, stats, outfile)
         duplex = collections.OrderedDict()
       barcode = this_barcode
       order = this_order
       family = []
-    pair = {'name1': name1, 'seq1':seq1, 'qual1':qual1, 'name2':name2, 'seq2':seq2, 'qual2':qual2}
-    family.append(pair)
+    family.append((name1, seq1, qual1, name2, seq2, qual2))
     stats['pairs'] += 1
   # Process the last family.
-  duplex[order] = family
+  if len(family) >= args.min_reads:
+    duplex[order] = family
   # sys.stderr.write('processing {}: {} orders ({}) [last]\n'.format(barcode, len(duplex),
   #                  '/'.join([str(len(duplex[order])) for order in duplex])))
-  output, run_stats, current_worker_i = delegate(workers, stats, duplex, barcode)
-  process_results(output, run_stats, stats)
-
-  # Do one last loop through the workers, reading the remaining results and stopping them.
-  # Start at the worker after the last one processed by the previous loop.
-  start = current_worker_i + 1
-  for i in range(len(workers)):
-    worker_i = (start + i) % args.processes
-    worker = workers[worker_i]
-    output, run_stats = worker['parent_pipe'].recv()
-    process_results(output, run_stats, stats)
-    worker['parent_pipe'].send(None)
+  if duplex:
+    for output, run_stats in delegate(pool, stats, duplex, barcode):
+      process_results(output, run_stats, stats, outfile)
+
+  # Read the remaining results and stop the workers.
+  for output, run_stats in pool.close():
+    process_results(output, run_stats, stats, outfile)
 
   if infile is not sys.stdin:
     infile.close()
+  if args.binary:
+    outfile.close()
+  else:
+    bgzf.close_output(outfile)
 
   end_time = time.time()
   run_time = int(end_time - start_time)
@@ -166,6 +259,8 @@ def main(argv):
     per_run = stats['time'] / stats['runs']
     sys.stderr.write('{:0.3f}s per pair, {:0.3f}s per run.\n'.format(per_pair, per_run))
     sys.stderr.write('{}s total time.\n'.format(run_time))
+  if args.fast_path:
+    sys.stderr.write('{} families took the ungapped fast path.\n'.format(stats['fast_path']))
 
   if args.phone_home:
     stats['align_time'] = stats['time']
@@ -173,62 +268,443 @@ def main(argv):
     phone.send_end(__file__, version.get_version(), run_id, run_time, stats, platform=args.platform,
                    test=args.test)
 
-
-def open_workers(num_workers):
-  """Open the required number of worker processes."""
-  workers = []
-  for i in range(num_workers):
-    worker = open_worker()
-    workers.append(worker)
-  return workers
-
-
-def open_worker():
-  parent_pipe, child_pipe = multiprocessing.Pipe()
-  process = multiprocessing.Process(target=worker_function, args=(child_pipe,))
-  process.start()
-  worker = {'process':process, 'parent_pipe':parent_pipe, 'child_pipe':child_pipe}
-  return worker
-
-
-def worker_function(child_pipe):
+  if pool.failed:
+    fail('Error: Families from {} barcodes failed to align and were left out of the output: {}'
+         .format(len(pool.failed), ', '.join(pool.failed)))
+
+
+class WorkerPool(object):
+  """A pool of worker processes which align duplexes, with a shared task queue. Each duplex is split
+  into its alignment groups (see get_groups()), usually one per family, and each group is a separate
+  task, run with process_group(). So the families of one large duplex can be aligned at once by
+  different workers. Groups are read ahead a "window" of duplexes at a time, and each window is sent
+  out most expensive first (by estimate_cost()), so the largest families start early instead of
+  holding up the end of the window. They're sent in chunks of at least chunk_pairs read pairs, so
+  the cost of each message between processes is spread over many small families. Each chunk goes to
+  whichever worker is free next, so one large family doesn't hold up the others. At most
+  max_in_flight chunks are out at once, and a reorder buffer returns the results in the order the
+  groups were submitted, which is the order get_groups() lists them in. If a worker fails on a
+  chunk, or dies while holding one (like from a segfault or the OOM killer), it's replaced, the
+  chunk's groups are retried one at a time, and the barcodes of any which fail again are listed in
+  "failed", along with those of any groups the aligner fails on. "static" holds the keyword
+  arguments to process_group() which are the same for every group."""
+
+  def __init__(self, num_workers, static, max_in_flight=None, chunk_pairs=CHUNK_PAIRS, window=1,
+               align_duplex=False):
+    if max_in_flight is None:
+      max_in_flight = num_workers * IN_FLIGHT_PER_WORKER
+    self.static = static
+    self.align_duplex = align_duplex
+    self.max_in_flight = max_in_flight
+    self.chunk_pairs = chunk_pairs
+    self.window_size = max(window, 1)
+    self.max_buffered = self.window_size * MAX_BUFFERED_WINDOWS
+    self.task_queue = multiprocessing.Queue()
+    # Each worker sends its results back over its own pipe, by pid. Sending on a pipe is synchronous,
+    # so nothing a worker has sent is lost if it's killed.
+    self.pipes = {}
+    # The task id of the chunk each worker is processing (or -1), by pid, in shared memory so it's
+    # still there if the worker is killed.
+    self.holding = {}
+    self.workers = [self._open_worker() for i in range(num_workers)]
+    self.window = []       # The groups in the current window: (cost, group id, size, group).
+    self.window_duplexes = 0  # The number of duplexes in the window.
+    self.unsent = collections.deque()  # Chunks waiting to be sent: (group ids, groups).
+    self.next_group = 0    # The id of the next group to be submitted.
+    self.next_task = 0     # The id of the next chunk to be sent.
+    self.next_result = 0   # The id of the next group to be returned.
+    self.sent = {}         # The chunks out to the workers, by task id: (group ids, groups).
+    self.finished = {}     # Output of groups which came back out of order, by group id.
+    self.stats = []        # Stats from finished chunks, not yet returned.
+    self.failed = []       # The barcodes of groups which couldn't be aligned.
+
+  def _open_worker(self):
+    current = multiprocessing.RawValue('l', -1)
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=worker_function,
+                                      args=(self.task_queue, sender, self.static, current))
+    process.start()
+    sender.close()
+    self.pipes[process.pid] = receiver
+    self.holding[process.pid] = current
+    return process
+
+  def submit(self, duplex, barcode):
+    """Add a duplex's groups to the window. "duplex" maps each order to a list of read pairs, as
+    tuples of PAIR_FIELDS. Returns a list of the results now ready to be returned, in order:
+    (output, run_stats) tuples."""
+    for families in pack_groups(duplex, barcode, self.align_duplex):
+      size = sum(len(reads) for mate, order, reads in families)
+      self.window.append((estimate_cost(families), self.next_group, size, (barcode, families)))
+      self.next_group += 1
+    self.window_duplexes += 1
+    if self.window_duplexes < self.window_size:
+      return []
+    self._close_window()
+    self._send_ready()
+    results = []
+    while self.sent and (self.unsent or len(self.finished) > self.max_buffered):
+      self._receive()
+      self._send_ready()
+      results.extend(self._pop_ready())
+    results.extend(self._pop_ready())
+    return results
+
+  def close(self):
+    """Send the rest of the duplexes, wait for them all to finish, stop the workers, and return the
+    remaining results."""
+    self._close_window()
+    self._send_ready()
+    results = []
+    while self.sent:
+      self._receive()
+      self._send_ready()
+      results.extend(self._pop_ready())
+    for worker in self.workers:
+      self.task_queue.put(None)
+    for worker in self.workers:
+      worker.join()
+    return results
+
+  def _close_window(self):
+    """Split the groups in the window into chunks, most expensive first, and queue them to be
+    sent."""
+    # Sort by cost, descending, then by input order.
+    self.window.sort(key=lambda item: (-item[0], item[1]))
+    chunk_ids = []
+    chunk = []
+    chunk_size = 0
+    for cost, group_id, size, group in self.window:
+      chunk_ids.append(group_id)
+      chunk.append(group)
+      chunk_size += size
+      if chunk_size >= self.chunk_pairs:
+        self.unsent.append((chunk_ids, chunk))
+        chunk_ids = []
+        chunk = []
+        chunk_size = 0
+    if chunk:
+      self.unsent.append((chunk_ids, chunk))
+    self.window = []
+    self.window_duplexes = 0
+
+  def _send_ready(self):
+    """Send queued chunks to the workers, up to max_in_flight at once."""
+    while self.unsent and len(self.sent) < self.max_in_flight:
+      chunk_ids, chunk = self.unsent.popleft()
+      self.task_queue.put((self.next_task, chunk))
+      self.sent[self.next_task] = (chunk_ids, chunk)
+      self.next_task += 1
+
+  def _receive(self):
+    """Wait for results from the workers and put them in the reorder buffer. While waiting, check
+    for workers which died without reporting back, and deal with the chunks they held."""
+    while True:
+      pipes = [self.pipes[worker.pid] for worker in self.workers]
+      ready, unused, unused = select.select(pipes, [], [], 1)
+      received = False
+      for pipe in ready:
+        try:
+          task_id, result = pipe.recv()
+        except EOFError:
+          # The worker exited. _check_workers() will deal with it.
+          continue
+        self._add_result(task_id, result)
+        received = True
+      if self._check_workers() or received:
+        return
+
+  def _add_result(self, task_id, result):
+    if task_id not in self.sent:
+      # A chunk which was already given up on.
+      return
+    if result is None:
+      # The worker hit an exception and is exiting. _check_workers() will replace it.
+      self._fail_chunk(task_id, 'Worker died on chunk {}.'.format(task_id))
+      return
+    chunk_ids, chunk = self.sent.pop(task_id)
+    outputs, chunk_stats = result
+    for group_id, (barcode, families), output in zip(chunk_ids, chunk, outputs):
+      if output is None:
+        self._fail_group(group_id, barcode, families, 'The aligner failed.')
+      else:
+        self.finished[group_id] = output
+    self.stats.append(chunk_stats)
+
+  def _check_workers(self):
+    """Replace any workers which have exited. If one died without reporting back on its chunk (like
+    from a signal), fail the chunk. Returns True if any chunks failed this way."""
+    failed_chunks = False
+    for worker in list(self.workers):
+      if worker.exitcode is None:
+        continue
+      # Take any results it sent before it died.
+      pipe = self.pipes.pop(worker.pid)
+      try:
+        while pipe.poll():
+          self._add_result(*pipe.recv())
+      except EOFError:
+        pass
+      pipe.close()
+      task_id = self.holding.pop(worker.pid).value
+      self.workers.remove(worker)
+      self.workers.append(self._open_worker())
+      if task_id in self.sent:
+        self._fail_chunk(task_id, 'Worker process {} died (exit code {}) on chunk {}.'
+                                  .format(worker.pid, worker.exitcode, task_id))
+        failed_chunks = True
+    return failed_chunks
+
+  def _fail_chunk(self, task_id, message):
+    """Retry the groups of a chunk which failed one at a time, so only the one(s) causing the error
+    are lost. If it was a single group, give up on it and list its barcode in "failed"."""
+    chunk_ids, chunk = self.sent.pop(task_id)
+    if len(chunk) > 1:
+      sys.stderr.write('{} Retrying its {} groups one at a time.\n'.format(message, len(chunk)))
+      for group_id, group in reversed(zip(chunk_ids, chunk)):
+        self.unsent.appendleft(([group_id], [group]))
+      return
+    barcode, families = chunk[0]
+    self._fail_group(chunk_ids[0], barcode, families, message)
+
+  def _fail_group(self, group_id, barcode, families, message):
+    """Give up on a group: leave it out of the output and list its barcode in "failed"."""
+    report_failed_group(self.failed, barcode, [(mate, order) for mate, order, reads in families],
+                        message)
+    self.finished[group_id] = ''
+
+  def _pop_ready(self):
+    results = [('', chunk_stats) for chunk_stats in self.stats]
+    self.stats = []
+    while self.next_result in self.finished:
+      results.append((self.finished.pop(self.next_result), {}))
+      self.next_result += 1
+    return results
+
+
+class MafftPool(object):
+  """Runs MAFFT on the families of each duplex from this process, with no worker processes. Up to
+  "max_procs" MAFFT processes run at once. One loop drives them all, using select(): it streams each
+  one its input over a pipe and reads back its output as it comes. Groups which don't need MAFFT
+  (the ungapped fast path, the center-star alignment, or a single unique read) are aligned
+  in-process as soon as they're submitted. It has the same interface as WorkerPool, and returns the
+  results in the same order. "static" holds the keyword arguments to process_group()."""
+
+  def __init__(self, max_procs, static, align_duplex=False, max_pending=MAFFT_POOL_MAX_PENDING):
+    self.max_procs = max_procs
+    self.static = static
+    self.align_duplex = align_duplex
+    self.max_pending = max_pending
+    self.devnull = open(os.devnull, 'w')
+    self.waiting = collections.deque()  # Jobs waiting for a MAFFT process to start.
+    self.running = []      # Jobs with a MAFFT process running.
+    self.next_group = 0    # The id of the next group to be submitted.
+    self.next_result = 0   # The id of the next group to be returned.
+    self.finished = {}     # Results of groups not returned yet, by group id.
+    self.failed = []       # The barcodes of groups MAFFT failed on, as in WorkerPool.
+
+  def submit(self, duplex, barcode):
+    """Add a duplex. "duplex" maps each order to a list of read pairs, as tuples of PAIR_FIELDS.
+    Returns a list of the results now ready to be returned, in order: (output, run_stats) tuples."""
+    for families in pack_groups(duplex, barcode, self.align_duplex):
+      self._add_group(self.next_group, barcode, families)
+      self.next_group += 1
+    self._start_jobs()
+    results = []
+    while self.running and len(self.waiting) + len(self.finished) > self.max_pending:
+      self._poll()
+      results.extend(self._pop_ready())
+    results.extend(self._pop_ready())
+    return results
+
+  def close(self):
+    """Wait for all the MAFFT processes to finish and return the remaining results."""
+    results = []
+    while self.running or self.waiting:
+      self._poll()
+      results.extend(self._pop_ready())
+    self.devnull.close()
+    return results
+
+  def _add_group(self, group_id, barcode, families):
+    """Align the group now if it doesn't need MAFFT, or else queue it for a MAFFT process."""
+    duplex, group = unpack_group(families)
+    family, mate = get_group_family(duplex, group)
+    mate = str(mate)
+    aligner = choose_aligner(family, mate, **self.static)
+    if aligner == 'mafft' and len(family) > 1:
+      names, seqs, copies = get_mafft_input([pair['name'+mate] for pair in family],
+                                            [pair['seq'+mate] for pair in family])
+      if len(seqs) > 1:
+        job = {'id':group_id, 'barcode':barcode, 'duplex':duplex, 'group':group, 'num_seqs':len(seqs)}
+        job['input'] = ''.join('>{}\n{}\n'.format(name, seq) for name, seq in zip(names, seqs))
+        self.waiting.append(job)
+        return
+    output, run_stats = process_group(duplex, barcode, group, **self.static)
+    if output is None:
+      report_failed_group(self.failed, barcode, group, 'The aligner failed.')
+      output = ''
+    self.finished[group_id] = (output, run_stats)
+
+  def _start_jobs(self):
+    while self.waiting and len(self.running) < self.max_procs:
+      job = self.waiting.popleft()
+      job['written'] = 0
+      job['output'] = []
+      job['start'] = time.time()
+      try:
+        job['process'] = subprocess.Popen(['mafft', '--nuc', '--quiet', '-'], stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE, stderr=self.devnull,
+                                          close_fds=True)
+      except OSError:
+        self._finish(job, None)
+        continue
+      self.running.append(job)
+
+  def _poll(self):
+    """Wait until at least one MAFFT process can take more input or has more output, and handle
+    it. Then start any waiting jobs there's room for."""
+    self._start_jobs()
+    if not self.running:
+      return
+    writers = {}
+    readers = {}
+    for job in self.running:
+      process = job['process']
+      if not process.stdin.closed:
+        writers[process.stdin.fileno()] = job
+      readers[process.stdout.fileno()] = job
+    readable, writable, errored = select.select(readers.keys(), writers.keys(), [])
+    for fd in writable:
+      job = writers[fd]
+      # A write no bigger than PIPE_BUF won't block once select() says the pipe is writable.
+      end = job['written'] + select.PIPE_BUF
+      try:
+        job['written'] += os.write(fd, job['input'][job['written']:end])
+      except OSError:
+        # MAFFT exited without reading all its input. The error will show when it's reaped.
+        job['written'] = len(job['input'])
+      if job['written'] >= len(job['input']):
+        job['process'].stdin.close()
+    for fd in readable:
+      job = readers[fd]
+      data = os.read(fd, 65536)
+      if data:
+        job['output'].append(data)
+        continue
+      # End of MAFFT's output.
+      job['process'].stdout.close()
+      if not job['process'].stdin.closed:
+        job['process'].stdin.close()
+      returncode = job['process'].wait()
+      self.running.remove(job)
+      aligned = None
+      if returncode == 0:
+        aligned = parse_mafft(''.join(job['output']), job['num_seqs'])
+      self._finish(job, aligned)
+    self._start_jobs()
+
+  def _finish(self, job, aligned):
+    """Build a group's output from MAFFT's alignment of its unique sequences ("aligned"), or None if
+    MAFFT failed. Failed groups are left out of the output, and their barcodes are listed in
+    "failed"."""
+    if aligned is None:
+      report_failed_group(self.failed, job['barcode'], job['group'], 'MAFFT failed.')
+      self.finished[job['id']] = ('', {})
+      return
+    elapsed = time.time() - job['start']
+    output, run_stats = process_group(job['duplex'], job['barcode'], job['group'], aligner='mafft',
+                                      fast_path=False, star_above=0,
+                                      mafft=lambda names, seqs: aligned)
+    run_stats['time'] += elapsed
+    self.finished[job['id']] = (output, run_stats)
+
+  def _pop_ready(self):
+    results = []
+    while self.next_result in self.finished:
+      results.append(self.finished.pop(self.next_result))
+      self.next_result += 1
+    return results
+
+
+def pack_groups(duplex, barcode, align_duplex=False):
+  """Split a duplex into its groups (see get_groups()), in a compact form to send to a worker. For
+  each group, this yields a list of (mate, order, reads) tuples, one per family, where each read is
+  a (name, seq, qual) tuple of only the mate being aligned. "duplex" maps each order to a list of
+  read pairs, as tuples of PAIR_FIELDS."""
+  for group in get_groups(duplex, barcode, align_duplex):
+    families = []
+    for mate, order in group:
+      fields = slice(0, 3) if mate == 1 else slice(3, 6)
+      families.append((mate, order, tuple(pair[fields] for pair in duplex[order])))
+    yield families
+
+
+def unpack_group(families):
+  """Turn a group from pack_groups() back into a duplex data structure and the list of
+  (mate, order) pairs to give process_group()."""
+  duplex = collections.OrderedDict()
+  group = []
+  for mate, order, reads in families:
+    mate_str = str(mate)
+    duplex[order] = [{'name'+mate_str:name, 'seq'+mate_str:seq, 'qual'+mate_str:qual}
+                     for name, seq, qual in reads]
+    group.append((mate, order))
+  return duplex, group
+
+
+def estimate_cost(families):
+  """Estimate how long a group will take to align: the number of reads times the read length.
+  "families" is a list of (mate, order, reads) tuples, where each read is a (name, seq, qual)
+  tuple."""
+  cost = 0
+  for mate, order, reads in families:
+    if reads:
+      cost += len(reads) * len(reads[0][1])
+  return cost
+
+
+def worker_function(task_queue, result_pipe, static, current=None):
+  """Process chunks of alignment groups from "task_queue" (see WorkerPool). For each chunk, send one
+  result on "result_pipe": a list of the output of each group, and the sum of their stats. While
+  processing a chunk, its task id is stored in "current" (a multiprocessing.RawValue)."""
   while True:
-    args = child_pipe.recv()
-    if args is None:
+    task = task_queue.get()
+    if task is None:
       break
+    task_id, chunk = task
+    if current is not None:
+      current.value = task_id
     try:
-      child_pipe.send(process_duplex(*args))
+      outputs = []
+      chunk_stats = collections.Counter()
+      for barcode, families in chunk:
+        duplex, group = unpack_group(families)
+        output, run_stats = process_group(duplex, barcode, group, **static)
+        outputs.append(output)
+        chunk_stats.update(run_stats)
+      result_pipe.send((task_id, (outputs, dict(chunk_stats))))
     except Exception:
-      child_pipe.send((None, None))
+      result_pipe.send((task_id, None))
       raise
+    if current is not None:
+      current.value = -1
 
 
-def delegate(workers, stats, duplex, barcode):
-  worker_i = stats['duplexes'] % len(workers)
-  worker = workers[worker_i]
-  # Receive results from the last duplex the worker processed, if any.
-  if stats['duplexes'] >= len(workers):
-    output, run_stats = worker['parent_pipe'].recv()
-  else:
-    output, run_stats = '', {}
-  if output is None and run_stats is None:
-    sys.stderr.write('Worker {} died.\n'.format(worker['process'].name))
-    worker = open_worker()
-    workers[worker_i] = worker
-    output, run_stats = '', {}
+def delegate(pool, stats, duplex, barcode):
+  """Send a duplex to the worker pool. Returns the results which are ready (see
+  WorkerPool.submit())."""
   stats['duplexes'] += 1
-  # Send in a new duplex to the worker.
-  args = (duplex, barcode)
-  worker['parent_pipe'].send(args)
-  return output, run_stats, worker_i
+  return pool.submit(duplex, barcode)
 
 
-def process_duplex(duplex, barcode):
-  output = ''
-  run_stats = {'time':0, 'runs':0, 'aligned_pairs':0}
+def get_groups(duplex, barcode, align_duplex=False):
+  """Decide which alignments to do for a duplex, and in what order. Returns a list of groups of
+  families to align together, each a tuple of (mate, order) pairs. Without align_duplex, each
+  group is a single family."""
   orders = duplex.keys()
   if len(duplex) == 0 or None in duplex:
-    return '', {}
+    return []
   elif len(duplex) == 1:
     # If there's only one strand in the duplex, just process the first mate, then the second.
     combos = ((1, orders[0]), (2, orders[0]))
@@ -238,36 +714,100 @@ def process_duplex(duplex, barcode):
     combos = ((1, orders[0]), (2, orders[1]), (2, orders[0]), (1, orders[1]))
   else:
     raise AssertionError('Error: More than 2 orders in duplex {}: {}'.format(barcode, orders))
-  for mate, order in combos:
-    family = duplex[order]
-    start = time.time()
-    try:
-      alignment = align_family(family, mate)
-    except AssertionError:
-      sys.stderr.write('AssertionError on family {}, order {}, mate {}.\n'
-                       .format(barcode, order, mate))
-      raise
-    # Compile statistics.
-    elapsed = time.time() - start
-    pairs = len(family)
-    #logging.info('{} sec for {} read pairs.'.format(elapsed, pairs))
-    if pairs > 1:
-      run_stats['time'] += elapsed
-      run_stats['runs'] += 1
-      run_stats['aligned_pairs'] += pairs
-    if alignment is None:
-      pass  #logging.warning('Error aligning family {}/{} (read {}).'.format(barcode, order, mate))
-    else:
-      output += format_msa(alignment, barcode, order, mate)
+  if align_duplex and len(duplex) == 2:
+    # Align the two families from each end of the molecule together: strand1/mate1 with
+    # strand2/mate2, then strand1/mate2 with strand2/mate1.
+    return [combos[:2], combos[2:]]
+  else:
+    return [(combo,) for combo in combos]
+
+
+def process_group(duplex, barcode, group, aligner='mafft', fast_path=False, star_above=0,
+                  mafft=None):
+  """Align one group of families from a duplex (see get_groups()). Returns the output (the aligned
+  reads, in families.msa.tsv format) and a dict of stats on the run. The output is None if the
+  aligner failed. "mafft" is the function to run MAFFT with (see make_msa())."""
+  run_stats = {'time':0, 'runs':0, 'aligned_pairs':0, 'fast_path':0}
+  family, mate = get_group_family(duplex, group)
+  start = time.time()
+  family_aligner = choose_aligner(family, mate, aligner, fast_path, star_above)
+  if family_aligner == 'ungapped':
+    run_stats['fast_path'] += 1
+  try:
+    alignment = align_family(family, mate, family_aligner, mafft)
+  except AssertionError:
+    families_str = ' and '.join('order {}, mate {}'.format(order, mate) for mate, order in group)
+    sys.stderr.write('AssertionError on family {}, {}.\n'.format(barcode, families_str))
+    raise
+  # Compile statistics.
+  elapsed = time.time() - start
+  pairs = len(family)
+  #logging.info('{} sec for {} read pairs.'.format(elapsed, pairs))
+  if pairs > 1:
+    run_stats['time'] += elapsed
+    run_stats['runs'] += 1
+    run_stats['aligned_pairs'] += pairs
+  if alignment is None:
+    return None, run_stats
+  # Split a joint alignment back into its families.
+  output = ''
+  start_i = 0
+  for mate, order in group:
+    end_i = start_i + len(duplex[order])
+    output += format_msa(alignment[start_i:end_i], barcode, order, mate)
+    start_i = end_i
   return output, run_stats
 
 
-def align_family(family, mate):
+def report_failed_group(failed, barcode, group, message):
+  """Print an error for a group which failed to align, and add its barcode to the list "failed".
+  "group" is a list of (mate, order) pairs."""
+  families_str = ' and '.join('order {}, mate {}'.format(order, mate) for mate, order in group)
+  sys.stderr.write('{} Error aligning family {}, {}. Leaving it out of the output.\n'
+                   .format(message, barcode, families_str))
+  if barcode not in failed:
+    failed.append(barcode)
+
+
+def get_group_family(duplex, group):
+  """Get the reads to align for a group (see get_groups()). Returns the family and the mate whose
+  fields hold the reads."""
+  if len(group) == 1:
+    mate, order = group[0]
+    return duplex[order], mate
+  else:
+    return join_families(duplex, group), 1
+
+
+def choose_aligner(family, mate, aligner='mafft', fast_path=False, star_above=0):
+  """Decide which aligner a family should get: 'ungapped' if it can take the fast path (see
+  is_ungapped()), 'star' if it's over the star_above size limit, or else "aligner"."""
+  if fast_path and len(family) > 1 and is_ungapped([pair['seq'+str(mate)] for pair in family]):
+    return 'ungapped'
+  elif star_above and len(family) > star_above:
+    return 'star'
+  else:
+    return aligner
+
+
+def join_families(duplex, group):
+  """Combine the reads of several families, given as (mate, order) pairs, into one family to align
+  together. In the combined family, each pair only has one mate: the "1" fields hold whichever mate
+  the (mate, order) pair named."""
+  family = []
+  for mate, order in group:
+    mate = str(mate)
+    for pair in duplex[order]:
+      family.append({'name1':pair['name'+mate], 'seq1':pair['seq'+mate], 'qual1':pair['qual'+mate]})
+  return family
+
+
+def align_family(family, mate, aligner='mafft', mafft=None):
   """Do a multiple sequence alignment of the reads in a family and their quality scores."""
   mate = str(mate)
   assert mate == '1' or mate == '2'
   # Do the multiple sequence alignment.
-  seq_alignment = make_msa(family, mate)
+  seq_alignment = make_msa(family, mate, aligner, mafft)
   if seq_alignment is None:
     return None
   # Transfer the alignment to the quality scores.
@@ -283,9 +823,15 @@ def align_family(family, mate):
   return alignment
 
 
-def make_msa(family, mate):
+def make_msa(family, mate, aligner='mafft', mafft=None):
   """Perform a multiple sequence alignment on a set of sequences and parse the result.
-  Uses MAFFT."""
+  Uses MAFFT, or the in-process aligner named by "aligner": 'builtin' (msa.py), 'poa' (poa.py), or
+  'star' (star.py). If aligner is 'ungapped', the sequences are taken as already aligned (see
+  is_ungapped()).
+  For MAFFT and the center-star alignment, identical reads are collapsed first, so only one copy of
+  each sequence is aligned, then the aligned copy is given to each of the reads.
+  "mafft" is the function which runs MAFFT, given the names and sequences (see get_mafft_input()).
+  By default it's run_mafft()."""
   mate = str(mate)
   assert mate == '1' or mate == '2'
   if len(family) == 0:
@@ -293,11 +839,69 @@ def make_msa(family, mate):
   elif len(family) == 1:
     # If there's only one read pair, there's no alignment to be done (and MAFFT won't accept it).
     return [{'name':family[0]['name'+mate], 'seq':family[0]['seq'+mate]}]
+  names = [pair['name'+mate] for pair in family]
+  seqs = [pair['seq'+mate] for pair in family]
+  if aligner == 'ungapped':
+    aligned_seqs = [seq.upper() for seq in seqs]
+  elif aligner == 'builtin':
+    aligned_seqs = msa.align(seqs)
+  elif aligner == 'poa':
+    # The families.msa.tsv format has no place for the consensus, and it depends on the quality
+    # threshold, which is dunovo.py's option. So dunovo.py --consensus poa builds it again from the
+    # reads and their quality scores.
+    aligned_seqs, _ = poa.align(seqs)
+  elif aligner == 'star':
+    # The center is chosen from all the reads, so it's the same as without collapsing.
+    center = star.choose_center(seqs, [pair['qual'+mate] for pair in family])
+    unique_seqs, copies = collapse_duplicates(seqs)
+    aligned_unique = star.align(unique_seqs, center=copies[center])
+    aligned_seqs = [aligned_unique[i] for i in copies]
+  else:
+    unique_names, unique_seqs, copies = get_mafft_input(names, seqs)
+    if len(unique_seqs) == 1:
+      aligned_unique = [unique_seqs[0].upper()]
+    else:
+      if mafft is None:
+        mafft = run_mafft
+      aligned_unique = mafft(unique_names, unique_seqs)
+      if aligned_unique is None:
+        return None
+    aligned_seqs = [aligned_unique[i] for i in copies]
+  return [{'name':name, 'seq':seq} for name, seq in zip(names, aligned_seqs)]
+
+
+def get_mafft_input(names, seqs):
+  """Collapse identical reads (see collapse_duplicates()) and name each unique sequence after its
+  first read. Returns the names and sequences to give MAFFT, and the index in those of each read."""
+  unique_seqs, copies = collapse_duplicates(seqs)
+  unique_names = [None] * len(unique_seqs)
+  for name, i in zip(names, copies):
+    if unique_names[i] is None:
+      unique_names[i] = name
+  return unique_names, unique_seqs, copies
+
+
+def collapse_duplicates(seqs):
+  """Find the unique sequences in a list. Returns the unique sequences, in order of first
+  appearance, and the index in that list of each input sequence."""
+  unique_seqs = []
+  indices = {}
+  copies = []
+  for seq in seqs:
+    i = indices.get(seq)
+    if i is None:
+      i = indices[seq] = len(unique_seqs)
+      unique_seqs.append(seq)
+    copies.append(i)
+  return unique_seqs, copies
+
+
+def run_mafft(names, seqs):
+  """Align sequences with MAFFT. Returns the aligned sequences (in upper case), in the same order, or
+  None if MAFFT failed."""
   #TODO: Replace with tempfile.mkstemp()?
   with tempfile.NamedTemporaryFile('w', delete=False, prefix='align.msa.') as family_file:
-    for pair in family:
-      name = pair['name'+mate]
-      seq = pair['seq'+mate]
+    for name, seq in zip(names, seqs):
       family_file.write('>'+name+'\n')
       family_file.write(seq+'\n')
   with open(os.devnull, 'w') as devnull:
@@ -307,7 +911,51 @@ def make_msa(family, mate):
     except (OSError, subprocess.CalledProcessError):
       return None
   os.remove(family_file.name)
-  return read_fasta(output, is_file=False, upper=True)
+  return parse_mafft(output, len(seqs))
+
+
+def parse_mafft(output, num_seqs):
+  """Parse MAFFT's output. Returns the aligned sequences (in upper case), or None if there aren't
+  "num_seqs" of them."""
+  aligned = read_fasta(output, is_file=False, upper=True)
+  if len(aligned) != num_seqs:
+    return None
+  return [sequence['seq'] for sequence in aligned]
+
+
+def is_ungapped(seqs):
+  """Decide whether a family's reads can be aligned without gaps: they're all the same length,
+  each has at most FAST_PATH_MAX_DIFF mismatches (as a fraction of its length) against the first
+  read, and there's no sign of an indel. The signal for an indel is a k-mer of the first read
+  (checked every FAST_PATH_K bases) which doesn't match the same position in another read, but does
+  match it shifted by up to FAST_PATH_MAX_SHIFT bases. This errs on the side of sending families to
+  the aligner, since a substitution next to a repetitive stretch can look like a shift."""
+  ref = seqs[0].upper()
+  length = len(ref)
+  max_diffs = int(length * FAST_PATH_MAX_DIFF)
+  k = FAST_PATH_K
+  for seq in seqs[1:]:
+    if len(seq) != length:
+      return False
+    seq = seq.upper()
+    if seq == ref:
+      continue
+    diffs = 0
+    for base1, base2 in zip(ref, seq):
+      if base1 != base2:
+        diffs += 1
+    if diffs > max_diffs:
+      return False
+    for start in range(0, length-k+1, k):
+      anchor = ref[start:start+k]
+      if seq[start:start+k] == anchor:
+        continue
+      for shift in range(1, FAST_PATH_MAX_SHIFT+1):
+        if seq[start+shift:start+shift+k] == anchor:
+          return False
+        if start-shift >= 0 and seq[start-shift:start-shift+k] == anchor:
+          return False
+  return True
 
 
 def read_fasta(fasta, is_file=True, upper=False):
@@ -347,13 +995,13 @@ def format_msa(align, barcode, order, mate, outfile=sys.stdout):
   return output
 
 
-def process_results(output, run_stats, stats):
+def process_results(output, run_stats, stats, outfile):
   """Process the outcome of a duplex run.
   Print the aligned output and sum the stats from the run with the running totals."""
   for key, value in run_stats.items():
     stats[key] += value
   if output:
-    sys.stdout.write(output)
+    outfile.write(output)
 
 
 def fail(message):
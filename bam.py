@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Detect and write unaligned BAM (uBAM) files.
+
+Reading them is done in C, by the pair reader in families.c (see families.read_family_chunks()),
+so make_families.py can take a uBAM directly instead of converting it to FASTQ first. This module
+only has what the Python side needs: a check for whether a file is BAM, and a minimal writer.
+
+Run as a script, this converts a pair of FASTQ files to a uBAM, with the mates of each pair in
+consecutive records, flagged as the first and second reads.
+"""
+import sys
+import struct
+import argparse
+import bgzf
+import families
+import fqsplit
+
+MAGIC = 'BAM\1'
+HEADER_TEXT = '@HD\tVN:1.6\tSO:unsorted\n'
+# refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen
+RECORD = struct.Struct('<iiBBHHHIiii')
+# The bin of an unmapped read (reg2bin(-1, 0) in the SAM spec).
+UNMAPPED_BIN = 4680
+FLAG_PAIRED = 0x1
+FLAG_UNMAPPED = 0x4
+FLAG_MATE_UNMAPPED = 0x8
+FLAG_READ1 = 0x40
+FLAG_READ2 = 0x80
+BASES = '=ACMGRSVTWYHKDBN'
+BASE_CODES = dict((base, code) for code, base in enumerate(BASES))
+N_CODE = BASE_CODES['N']
+
+
+def make_argparser():
+  parser = argparse.ArgumentParser(description='Convert a pair of FASTQ files to unaligned BAM.')
+  parser.add_argument('fastq1', metavar='reads_1.fq')
+  parser.add_argument('fastq2', metavar='reads_2.fq')
+  parser.add_argument('-o', '--output',
+    help='Write to this file instead of stdout.')
+  return parser
+
+
+def main(argv):
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+  fastq1 = bgzf.get_fd_file(bgzf.open_input(args.fastq1))
+  fastq2 = bgzf.get_fd_file(bgzf.open_input(args.fastq2))
+  outfile = bgzf.open_output(args.output, compress=True)
+  writer = UbamWriter(outfile)
+  for name1, seq1, qual1, name2, seq2, qual2 in families.read_pairs(fastq1, fastq2):
+    writer.write(fqsplit.get_id(name1), seq1, qual1, FLAG_READ1)
+    writer.write(fqsplit.get_id(name2), seq2, qual2, FLAG_READ2)
+  bgzf.close_output(outfile)
+  fastq1.close()
+  fastq2.close()
+
+
+def is_bam_path(path):
+  """Check whether a file is BAM: BGZF-compressed, starting with the BAM magic string. Returns False
+  for anything that can't be read twice, like a pipe."""
+  if not bgzf.is_bgzf_path(path):
+    return False
+  with open(path, 'rb') as infile:
+    data, block_size = bgzf.read_block(infile)
+  return data is not None and data.startswith(MAGIC)
+
+
+class UbamWriter(object):
+  """Write unmapped, paired reads as BAM records to a file (usually a bgzf.BgzfWriter)."""
+
+  def __init__(self, outfile):
+    self.outfile = outfile
+    # The header, with no reference sequences.
+    self.outfile.write(MAGIC + struct.pack('<i', len(HEADER_TEXT)) + HEADER_TEXT +
+                       struct.pack('<i', 0))
+
+  def write(self, name, seq, qual, mate_flag):
+    """Write one read. "qual" is in Sanger format (+33), and "mate_flag" is FLAG_READ1 or
+    FLAG_READ2."""
+    flag = FLAG_PAIRED | FLAG_UNMAPPED | FLAG_MATE_UNMAPPED | mate_flag
+    codes = [BASE_CODES.get(base, N_CODE) for base in seq.upper()]
+    if len(codes) % 2:
+      codes.append(0)
+    packed_seq = ''.join(chr(codes[i] << 4 | codes[i+1]) for i in range(0, len(codes), 2))
+    packed_qual = ''.join(chr(ord(score) - 33) for score in qual)
+    fields = RECORD.pack(-1, -1, len(name)+1, 0, UNMAPPED_BIN, 0, flag, len(seq), -1, -1, 0)
+    record = fields + name + '\0' + packed_seq + packed_qual
+    self.outfile.write(struct.pack('<i', len(record)) + record)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
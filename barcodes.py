@@ -0,0 +1,45 @@
+"""Encode barcodes as integers, 2 bits per base.
+A barcode of up to 31 bases (like the usual 24: two 12bp tags) fits in a 64-bit integer, with a bit
+to spare for the order ("ab" or "ba"). Comparing these integers gives the same order as comparing
+the barcode strings, since A < C < G < T either way. Barcodes with any other characters (like N)
+can't be encoded, and have to be handled as strings.
+"""
+
+BASE_CODES = {'A':0, 'C':1, 'G':2, 'T':3}
+BASES = 'ACGT'
+MAX_LENGTH = 31
+
+
+def encode(barcode):
+  """Return the barcode as an integer, or None if it contains anything but A, C, G, and T or it's
+  longer than MAX_LENGTH. Barcodes of different lengths can have the same code."""
+  if len(barcode) > MAX_LENGTH:
+    return None
+  code = 0
+  try:
+    for base in barcode:
+      code = (code << 2) | BASE_CODES[base]
+  except KeyError:
+    return None
+  return code
+
+
+def decode(code, length):
+  """Return the barcode string for a code from encode()."""
+  bases = []
+  for i in range(length):
+    bases.append(BASES[code & 3])
+    code >>= 2
+  return ''.join(reversed(bases))
+
+
+def swap_halves(barcode, tag_len=None):
+  """Swap the alpha and beta halves of a barcode. This gives the barcode of the other order of the
+  same pair of tags. The barcode can be a string or a code from encode(). For a string, tag_len
+  defaults to half its length. For a code, it's required."""
+  if isinstance(barcode, basestring):
+    if tag_len is None:
+      tag_len = len(barcode)//2
+    return barcode[tag_len:] + barcode[:tag_len]
+  tag_bits = 2*tag_len
+  return ((barcode & ((1 << tag_bits) - 1)) << tag_bits) | (barcode >> tag_bits)
@@ -0,0 +1,539 @@
+#!/usr/bin/env python
+"""Read and write BGZF files: gzip files made of independently compressed blocks of at most 64KB,
+as used by samtools and tabix. Any gzip reader can decompress them, but they also allow random
+access through "virtual offsets": the file offset of the start of a block, shifted left 16 bits,
+plus the offset of a position inside that block's uncompressed data.
+
+This is also the shared I/O layer for the pipeline's scripts: open_input() opens plain, BGZF, or
+gzip files, and open_output() writes BGZF when compression is requested. BGZF blocks are
+(de)compressed in a pool of threads, so reading and writing compressed files isn't limited to one
+core's worth of inflate and deflate. In Python 2.7, zlib's compress and decompress release the GIL
+while they run (zlib.crc32() doesn't, but it's much faster).
+
+Run as a script, this compresses (or with -d, decompresses) stdin to stdout.
+"""
+import os
+import sys
+import errno
+import zlib
+import struct
+import signal
+import argparse
+import threading
+import subprocess
+import collections
+import distutils.spawn
+import multiprocessing.pool
+
+# The maximum amount of uncompressed data per block. This is the value samtools uses, so that a
+# block can never grow past 64KB even if the data is incompressible.
+MAX_BLOCK_DATA = 0xff00
+HEADER = struct.Struct('<4BI2BH2BHH')
+HEADER_MAGIC = '\x1f\x8b\x08\x04'
+TRAILER = struct.Struct('<II')
+GZIP_MAGIC = '\x1f\x8b'
+# The default number of threads for (de)compressing blocks.
+IO_THREADS = min(4, multiprocessing.cpu_count())
+# The empty block which marks the end of a BGZF file.
+EOF_BLOCK = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00'
+             '\x00\x00\x00\x00\x00\x00')
+
+
+def make_argparser():
+  parser = argparse.ArgumentParser(description='Compress stdin into BGZF format, or decompress it.')
+  parser.add_argument('-d', '--decompress', action='store_true',
+    help='Decompress instead.')
+  parser.add_argument('-@', '--threads', type=int, default=IO_THREADS,
+    help='Number of threads to use for (de)compression. Default: %(default)s')
+  return parser
+
+
+def main(argv):
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+  if args.decompress:
+    reader = BgzfReader(sys.stdin, threads=args.threads)
+    while True:
+      data = reader.read(MAX_BLOCK_DATA)
+      if not data:
+        break
+      sys.stdout.write(data)
+  else:
+    writer = BgzfWriter(sys.stdout, threads=args.threads)
+    while True:
+      data = sys.stdin.read(MAX_BLOCK_DATA)
+      if not data:
+        break
+      writer.write(data)
+    writer.close()
+
+
+class FormatError(Exception):
+  def __init__(self, message=None):
+    if message:
+      Exception.__init__(self, message)
+
+
+def is_bgzf(infile):
+  """Return True if the file starts with a BGZF block header. Doesn't move the file position."""
+  position = infile.tell()
+  header = infile.read(16)
+  infile.seek(position)
+  return header.startswith(HEADER_MAGIC) and header[12:14] == 'BC'
+
+
+def is_bgzf_path(path):
+  with open(path, 'rb') as infile:
+    return is_bgzf(infile)
+
+
+def make_virtual_offset(block_start, within_block):
+  return (block_start << 16) | within_block
+
+
+def split_virtual_offset(virtual_offset):
+  """Return the file offset of the block and the offset within the block's uncompressed data."""
+  return virtual_offset >> 16, virtual_offset & 0xffff
+
+
+def compress_block(data, level=6):
+  """Return a complete BGZF block containing "data" (at most MAX_BLOCK_DATA bytes)."""
+  compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+  compressed = compressor.compress(data) + compressor.flush()
+  block_size = HEADER.size + len(compressed) + TRAILER.size
+  header = HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, block_size-1)
+  trailer = TRAILER.pack(zlib.crc32(data) & 0xffffffff, len(data))
+  return header + compressed + trailer
+
+
+def read_raw_block(infile):
+  """Read the next block from the file, without decompressing it. Return None at the end of the
+  file."""
+  header = infile.read(HEADER.size)
+  if not header:
+    return None
+  if len(header) < HEADER.size or not header.startswith(HEADER_MAGIC) or header[12:14] != 'BC':
+    raise FormatError('Invalid BGZF block header.')
+  block_size = HEADER.unpack(header)[-1] + 1
+  rest = infile.read(block_size - HEADER.size)
+  if len(rest) < block_size - HEADER.size:
+    raise FormatError('Truncated BGZF block.')
+  return header + rest
+
+
+def decompress_block(block):
+  """Return the uncompressed data in a raw block from read_raw_block()."""
+  data = zlib.decompress(block[HEADER.size:-TRAILER.size], -15)
+  crc, size = TRAILER.unpack(block[-TRAILER.size:])
+  if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+    raise FormatError('BGZF block failed its integrity check.')
+  return data
+
+
+def read_block(infile):
+  """Read the next block from the file and return its uncompressed data, or None at the end of the
+  file. Also returns the size of the block in the file."""
+  block = read_raw_block(infile)
+  if block is None:
+    return None, 0
+  return decompress_block(block), len(block)
+
+
+class BgzfReader(object):
+  """A file-like object for reading a BGZF file. tell() returns a virtual offset, and seek() takes
+  one. Iterating yields lines.
+  With threads > 1, the blocks ahead of the current one are decompressed in a thread pool.
+  Raises a FormatError if the file ends without the EOF marker block, since it's been truncated."""
+
+  def __init__(self, infile, threads=1):
+    self.infile = infile
+    self.name = getattr(infile, 'name', None)
+    self.block_start = 0
+    self.block_size = 0
+    self.data = ''
+    self.within = 0
+    self.pool = None
+    # Blocks being decompressed in the background: (block size, AsyncResult) tuples.
+    self.pending = collections.deque()
+    self.eof = False
+    # Whether the last block read was the EOF marker.
+    self.eof_block = False
+    if threads > 1:
+      self.pool = multiprocessing.pool.ThreadPool(threads)
+      self.read_ahead = 2*threads
+    try:
+      self.block_start = infile.tell()
+    except (AttributeError, IOError):
+      pass
+
+  def _read_raw_block(self):
+    """Read the next raw block, checking that the file ends with the EOF marker."""
+    block = read_raw_block(self.infile)
+    if block is None:
+      if not self.eof_block:
+        raise FormatError('BGZF file "{}" ends without an EOF marker. It may be truncated.'
+                          .format(self.name))
+    else:
+      self.eof_block = block == EOF_BLOCK
+    return block
+
+  def _read_ahead(self):
+    while not self.eof and len(self.pending) < self.read_ahead:
+      block = self._read_raw_block()
+      if block is None:
+        self.eof = True
+      else:
+        self.pending.append((len(block), self.pool.apply_async(decompress_block, (block,))))
+
+  def _load_block(self):
+    """Load the next block into self.data, and return its size (or 0 at the end of the file)."""
+    if self.pool is None:
+      block = self._read_raw_block()
+      if block is None:
+        data, block_size = None, 0
+      else:
+        data, block_size = decompress_block(block), len(block)
+    else:
+      self._read_ahead()
+      if self.pending:
+        block_size, result = self.pending.popleft()
+        data = result.get()
+      else:
+        data, block_size = None, 0
+    self.data = data or ''
+    self.within = 0
+    return block_size
+
+  def _next_block(self):
+    """Load the next non-empty block. Return False at the end of the file."""
+    while True:
+      self.block_start += self.block_size
+      self.block_size = self._load_block()
+      if not self.block_size:
+        return False
+      if self.data:
+        return True
+
+  def tell(self):
+    if self.within >= len(self.data) and self.data:
+      # Report positions at the end of a block as the start of the next one, like samtools does.
+      return make_virtual_offset(self.block_start + self.block_size, 0)
+    return make_virtual_offset(self.block_start, self.within)
+
+  def seek(self, virtual_offset):
+    block_start, within = split_virtual_offset(virtual_offset)
+    if block_start != self.block_start or not self.data:
+      # Throw away any blocks read ahead from the old position.
+      for block_size, result in self.pending:
+        result.wait()
+      self.pending.clear()
+      self.eof = False
+      self.eof_block = False
+      self.infile.seek(block_start)
+      self.block_start = block_start
+      self.block_size = self._load_block()
+    if within > len(self.data):
+      raise FormatError('Virtual offset {} is past the end of its block.'.format(virtual_offset))
+    self.within = within
+
+  def read(self, size=-1):
+    chunks = []
+    while size < 0 or size > 0:
+      if self.within >= len(self.data) and not self._next_block():
+        break
+      if size < 0:
+        end = len(self.data)
+      else:
+        end = min(len(self.data), self.within + size)
+        size -= end - self.within
+      chunks.append(self.data[self.within:end])
+      self.within = end
+    return ''.join(chunks)
+
+  def read_until(self, end, size=MAX_BLOCK_DATA):
+    """Read up to "size" bytes, but not past the virtual offset "end". Returns '' once it's reached.
+    Each call returns data from at most one block."""
+    end_block, end_within = split_virtual_offset(end)
+    if self.within >= len(self.data) and not self._next_block():
+      return ''
+    if self.block_start > end_block:
+      return ''
+    elif self.block_start == end_block:
+      stop = min(end_within, len(self.data))
+    else:
+      stop = len(self.data)
+    stop = max(min(stop, self.within + size), self.within)
+    data = self.data[self.within:stop]
+    self.within = stop
+    return data
+
+  def readline(self):
+    chunks = []
+    while True:
+      if self.within >= len(self.data) and not self._next_block():
+        break
+      newline = self.data.find('\n', self.within)
+      if newline == -1:
+        chunks.append(self.data[self.within:])
+        self.within = len(self.data)
+      else:
+        chunks.append(self.data[self.within:newline+1])
+        self.within = newline+1
+        break
+    return ''.join(chunks)
+
+  def __iter__(self):
+    while True:
+      line = self.readline()
+      if not line:
+        break
+      yield line
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+    self.infile.close()
+
+
+class BgzfWriter(object):
+  """A file-like object for writing a BGZF file. tell() returns the virtual offset the next write
+  will start at. The output doesn't need to be seekable.
+  With threads > 1, full blocks are compressed in a thread pool and written in order."""
+
+  def __init__(self, outfile, level=6, threads=1):
+    self.outfile = outfile
+    self.level = level
+    self.block_start = 0
+    self.buffer = []
+    self.buffer_size = 0
+    self.pool = None
+    self.pending = collections.deque()
+    if threads > 1:
+      self.pool = multiprocessing.pool.ThreadPool(threads)
+      self.max_pending = 2*threads
+
+  def write(self, data):
+    while data:
+      space = MAX_BLOCK_DATA - self.buffer_size
+      self.buffer.append(data[:space])
+      self.buffer_size += len(self.buffer[-1])
+      data = data[space:]
+      if self.buffer_size >= MAX_BLOCK_DATA:
+        self._end_block()
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def tell(self):
+    # The start of the current block depends on the compressed sizes of all the blocks before it.
+    self._write_pending(0)
+    return make_virtual_offset(self.block_start, self.buffer_size)
+
+  def _end_block(self):
+    if not self.buffer_size:
+      return
+    data = ''.join(self.buffer)
+    self.buffer = []
+    self.buffer_size = 0
+    if self.pool is None:
+      self._write_block(compress_block(data, self.level))
+    else:
+      self.pending.append(self.pool.apply_async(compress_block, (data, self.level)))
+      self._write_pending(self.max_pending)
+
+  def _write_pending(self, max_pending):
+    while len(self.pending) > max_pending:
+      self._write_block(self.pending.popleft().get())
+
+  def _write_block(self, block):
+    self.outfile.write(block)
+    self.block_start += len(block)
+
+  def flush(self):
+    """Write all the buffered data as a block."""
+    self._end_block()
+    self._write_pending(0)
+    self.outfile.flush()
+
+  def close(self):
+    self.flush()
+    self.outfile.write(EOF_BLOCK)
+    self.outfile.flush()
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+    if self.outfile is not sys.stdout:
+      self.outfile.close()
+
+
+class ProcessReader(object):
+  """Read the stdout of a decompression command like a file. Raises an IOError at the end of the
+  output (or on close()) if the command failed, e.g. because the input was truncated or corrupt."""
+
+  def __init__(self, command, name=None):
+    self.command = command
+    self.name = name
+    # Let the command die quietly from SIGPIPE if the output is closed before it's all read (Python
+    # ignores SIGPIPE, and the child would inherit that).
+    self.process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                    preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL))
+    self.stdout = self.process.stdout
+    self.checked = False
+
+  def fileno(self):
+    return self.stdout.fileno()
+
+  def read(self, size=-1):
+    data = self.stdout.read(size)
+    if not data and size != 0:
+      self._check_exit(self.process.wait())
+    return data
+
+  def readline(self):
+    line = self.stdout.readline()
+    if not line:
+      self._check_exit(self.process.wait())
+    return line
+
+  def __iter__(self):
+    for line in self.stdout:
+      yield line
+    self._check_exit(self.process.wait())
+
+  def close(self):
+    self.stdout.close()
+    returncode = self.process.wait()
+    # Being killed by SIGPIPE just means the output was closed early.
+    if returncode != -signal.SIGPIPE:
+      self._check_exit(returncode)
+
+  def _check_exit(self, returncode):
+    if returncode != 0 and not self.checked:
+      self.checked = True
+      raise IOError('Error decompressing "{}": {} exited with status {}.'
+                    .format(self.name, self.command[0], returncode))
+
+
+def open_input(path, threads=IO_THREADS):
+  """Open a file for reading, decompressing it if it's BGZF or gzip. Gives stdin for "-" or None.
+  BGZF files are decompressed in a thread pool. Other gzip files can't be decompressed in parallel,
+  so they're decompressed by pigz (or gzip) in a separate process. Pipes are read as-is."""
+  if path is None or path == '-':
+    return sys.stdin
+  elif not os.path.isfile(path):
+    # Pipes and other special files can't be read twice to detect the format.
+    return open(path, 'rb')
+  # Check the format in a separate file object, so the returned one's file descriptor is still at
+  # the start (seeking back may only rewind its buffer).
+  with open(path, 'rb') as infile:
+    header = infile.read(16)
+  if header.startswith(HEADER_MAGIC) and header[12:14] == 'BC':
+    return BgzfReader(open(path, 'rb'), threads=threads)
+  elif header.startswith(GZIP_MAGIC):
+    command = 'pigz' if distutils.spawn.find_executable('pigz') else 'gzip'
+    return ProcessReader([command, '-dc', path], name=path)
+  return open(path, 'rb')
+
+
+def open_output(path=None, compress=False, threads=IO_THREADS):
+  """Open a file for writing (stdout if path is None or "-"), BGZF-compressed if "compress"."""
+  if path is None or path == '-':
+    outfile = sys.stdout
+  else:
+    outfile = open(path, 'wb')
+  if compress:
+    return BgzfWriter(outfile, threads=threads)
+  return outfile
+
+
+def close_output(outfile):
+  """Close a file from open_output(), finishing the compression if needed, but leave stdout open."""
+  if isinstance(outfile, BgzfWriter):
+    outfile.close()
+  elif outfile is not sys.stdout:
+    outfile.close()
+
+
+def get_fd_file(infile):
+  """Return a file with a real file descriptor that gives the same data as "infile", for code which
+  reads the descriptor directly. If infile doesn't have one (like a BgzfReader), a thread copies its
+  data into a pipe (see PipeReader)."""
+  if hasattr(infile, 'fileno'):
+    return infile
+  return PipeReader(infile)
+
+
+class PipeReader(object):
+  """The read end of a pipe which a thread fills with the data from "infile". If reading infile
+  fails, the reader of the pipe just sees it end, so the error is raised at the end of the output
+  (or on close()) instead, like ProcessReader does for a failed command. Code reading the descriptor
+  directly should always close() this when it's done."""
+
+  def __init__(self, infile):
+    self.infile = infile
+    self.name = getattr(infile, 'name', None)
+    read_fd, self.write_fd = os.pipe()
+    self.pipe = os.fdopen(read_fd, 'rb')
+    self.error = None
+    self.checked = False
+    self.thread = threading.Thread(target=self._feed)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _feed(self):
+    try:
+      while True:
+        data = self.infile.read(MAX_BLOCK_DATA)
+        if not data:
+          break
+        while data:
+          written = os.write(self.write_fd, data)
+          data = data[written:]
+    except OSError as error:
+      # EPIPE just means the reader closed the pipe early.
+      if error.errno != errno.EPIPE:
+        self.error = error
+    except Exception as error:
+      self.error = error
+    finally:
+      os.close(self.write_fd)
+
+  def fileno(self):
+    return self.pipe.fileno()
+
+  def read(self, size=-1):
+    data = self.pipe.read(size)
+    if not data and size != 0:
+      self._check_error()
+    return data
+
+  def readline(self):
+    line = self.pipe.readline()
+    if not line:
+      self._check_error()
+    return line
+
+  def __iter__(self):
+    for line in self.pipe:
+      yield line
+    self._check_error()
+
+  def close(self):
+    self.pipe.close()
+    self.thread.join()
+    self.infile.close()
+    self._check_error()
+
+  def _check_error(self):
+    self.thread.join()
+    if self.error is not None and not self.checked:
+      self.checked = True
+      raise self.error
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -78,10 +78,14 @@ def get_consensus(align, quals=[], cons_thres=-1.0, qual_thres=' ', gapped=False
 
 # N.B.: The quality scores must be aligned with their accompanying sequences.
 def get_consensus_duplex(align1, align2, quals1=[], quals2=[], cons_thres=-1.0, qual_thres=' ',
-                         method='iupac'):
+                         gapped=False, method='iupac'):
   assert method in ('iupac', 'freq')
   cons_thres_c = ctypes.c_double(cons_thres)
   qual_thres_c = ctypes.c_char(qual_thres)
+  if gapped:
+    gapped_c = 1
+  else:
+    gapped_c = 0
   n_seqs1 = len(align1)
   n_seqs2 = len(align2)
   assert (not quals1 and not quals2) or (quals1 and quals2)
@@ -96,13 +100,13 @@ def get_consensus_duplex(align1, align2, quals1=[], quals2=[], cons_thres=-1.0,
   align1_c = (ctypes.c_char_p * n_seqs1)()
   for i, seq in enumerate(align1):
     align1_c[i] = ctypes.c_char_p(seq)
-  align2_c = (ctypes.c_char_p * n_seqs1)()
+  align2_c = (ctypes.c_char_p * n_seqs2)()
   for i, seq in enumerate(align2):
     align2_c[i] = ctypes.c_char_p(seq)
   quals1_c = (ctypes.c_char_p * n_seqs1)()
   for i, seq in enumerate(quals1):
     quals1_c[i] = ctypes.c_char_p(seq)
-  quals2_c = (ctypes.c_char_p * n_seqs1)()
+  quals2_c = (ctypes.c_char_p * n_seqs2)()
   for i, seq in enumerate(quals2):
     quals2_c[i] = ctypes.c_char_p(seq)
   if not quals1:
@@ -110,7 +114,7 @@ def get_consensus_duplex(align1, align2, quals1=[], quals2=[], cons_thres=-1.0,
   if not quals2:
     quals2_c = 0
   return consensus.get_consensus_duplex(align1_c, align2_c, quals1_c, quals2_c, n_seqs1, n_seqs2,
-                                        seq_len, cons_thres_c, qual_thres_c, method)
+                                        seq_len, cons_thres_c, qual_thres_c, gapped_c, method)
 
 
 def build_consensus_duplex_simple(cons1, cons2, gapped=False):
@@ -25,8 +25,7 @@ function main {
 
   bash "$script_dir/baralign.sh" "$families" refdir barcodes.bam
   samtools view -f 256 barcodes.bam \
-    | python2 "$script_dir/correct.py" "$@" refdir/barcodes.fa \
-    | sort
+    | python2 "$script_dir/correct.py" --sort "$@" refdir/barcodes.fa
 }
 
 function fail {
@@ -3,20 +3,27 @@ from __future__ import division
 from __future__ import print_function
 import os
 import sys
-import gzip
 import time
 import logging
 import argparse
+import heapq
 import resource
 import subprocess
 import networkx
 from lib import version
 from ET import phone
 import swalign
+import famfile
+import famindex
+import famcounts
+import bgzf
+import barcodes
+import extsort
 
 VERBOSE = (logging.DEBUG+logging.INFO)//2
-ARG_DEFAULTS = {'sam':sys.stdin, 'mapq':20, 'pos':2, 'dist':1, 'choose_by':'count', 'output':True,
-                'visualize':0, 'viz_format':'png', 'log':sys.stderr, 'volume':logging.WARNING}
+ARG_DEFAULTS = dict(extsort.OPT_DEFAULTS, sam=sys.stdin, mapq=20, pos=2, dist=1, choose_by='count',
+                    output=True, visualize=0, viz_format='png', log=sys.stderr,
+                    volume=logging.WARNING, compress_output=False)
 USAGE = "%(prog)s [options]"
 DESCRIPTION = """Correct barcodes using an alignment of all barcodes to themselves. Reads the
 alignment in SAM format and corrects the barcodes in an input "families" file (the output of
@@ -36,7 +43,9 @@ def main(argv):
   parser.add_argument('families', type=open_as_text_or_gzip,
     help='The sorted output of make-barcodes.awk. The important part is that it\'s a tab-delimited '
          'file with at least 2 columns: the barcode sequence and order, and it must be sorted in '
-         'the same order as the "reads" in the SAM file.')
+         'the same order as the "reads" in the SAM file. It can also be in the binary families '
+         'format written by make_families.py -b. If it has an up-to-date index (see famindex.py), '
+         'the family sizes will be read from that instead of from a first pass over the file.')
   parser.add_argument('reads', type=open_as_text_or_gzip,
     help='The fasta/q file given to the aligner. Used to get barcode sequences from read names.')
   parser.add_argument('sam', type=argparse.FileType('r'), nargs='?',
@@ -55,6 +64,9 @@ def main(argv):
     help='Choose the "correct" barcode in a network of related barcodes by either the count of how '
          'many times the barcode was observed ("freq") or how connected the barcode is to the '
          'others in the network ("connect").')
+  parser.add_argument('-f', '--counts', metavar='COUNTS_FILE',
+    help='Get the size of each family from this table (from make_families.py --counts) instead of '
+         'reading the whole families file for them.')
   parser.add_argument('--limit', type=int,
     help='Limit the number of lines that will be read from each input file, for testing purposes.')
   parser.add_argument('-S', '--structures', action='store_true',
@@ -65,6 +77,13 @@ def main(argv):
          'If you omit a filename, it will be displayed in a window.')
   parser.add_argument('-F', '--viz-format', choices=('dot', 'graphviz', 'png'))
   parser.add_argument('-n', '--no-output', dest='output', action='store_false')
+  parser.add_argument('-z', '--compress-output', action='store_true',
+    help='Compress the output with BGZF (gzip-compatible).')
+  parser.add_argument('--sort', action='store_true',
+    help='Sort the output, like piping it through extsort.py. If the input is sorted, only the '
+         'corrected lines have to be sorted. The rest are passed through and merged with them. '
+         'The sorting options below are the same as extsort.py\'s.')
+  extsort.add_sort_args(parser, short_options=False)
   parser.add_argument('-l', '--log', type=argparse.FileType('w'),
     help='Print log messages to this file instead of to stderr. Warning: Will overwrite the file.')
   parser.add_argument('-q', '--quiet', dest='volume', action='store_const', const=logging.CRITICAL)
@@ -88,6 +107,12 @@ def main(argv):
 
   args = parser.parse_args(argv[1:])
 
+  if args.sort:
+    try:
+      sorter = extsort.ExternalSorter(**extsort.sorter_kwargs(args))
+    except ValueError as error:
+      parser.error(str(error))
+
   logging.basicConfig(stream=args.log, level=args.volume, format='%(message)s')
   tone_down_logger()
 
@@ -103,8 +128,20 @@ def main(argv):
                                                                   args.pos, args.mapq,
                                                                   args.dist, args.limit)
 
-  logging.info('Reading the families.tsv to get the counts of each family..')
-  family_counts, read_pairs = get_family_counts(args.families, args.limit)
+  index = None
+  if args.limit is None and not args.counts:
+    index = famindex.load_index_for(args.families.name)
+  if args.counts and args.limit is None:
+    logging.info('Reading the family size table to get the counts of each family..')
+    family_counts, read_pairs = famcounts.load_counts(args.counts)
+    args.families.close()
+  elif index:
+    logging.info('Reading the families.tsv index to get the counts of each family..')
+    family_counts, read_pairs = index.family_counts()
+    args.families.close()
+  else:
+    logging.info('Reading the families.tsv to get the counts of each family..')
+    family_counts, read_pairs = get_family_counts(args.families, args.limit)
 
   if args.structures:
     logging.info('Counting the unique barcode networks..')
@@ -119,8 +156,22 @@ def main(argv):
 
   logging.info('Reading the families.tsv again to print corrected output..')
   families = open_as_text_or_gzip(args.families.name)
-  print_corrected_output(families, corrections, reversed_barcodes, args.prepend, args.limit,
-                         args.output)
+  outfile = bgzf.open_output(compress=args.compress_output)
+  if args.sort:
+    try:
+      print_corrected_output(families, corrections, reversed_barcodes, args.prepend, args.limit,
+                             args.output, outfile, sorter=sorter)
+      if args.output:
+        logging.info('Reading the families.tsv a third time to merge the uncorrected lines into the '
+                     'sorted output..')
+        families = open_as_text_or_gzip(args.families.name)
+        print_sorted_output(families, corrections, sorter, args.prepend, args.limit, outfile)
+    finally:
+      sorter.cleanup()
+  else:
+    print_corrected_output(families, corrections, reversed_barcodes, args.prepend, args.limit,
+                           args.output, outfile)
+  bgzf.close_output(outfile)
 
   end_time = time.time()
   run_time = int(end_time - start_time)
@@ -327,11 +378,10 @@ def get_family_counts(families_file, limit=None):
   last_barcode = None
   this_family_counts = None
   read_pairs = 0
-  for line in families_file:
+  for fields in famfile.read_rows(families_file):
     read_pairs += 1
     if limit is not None and read_pairs > limit:
       break
-    fields = line.rstrip('\r\n').split('\t')
     barcode = fields[0]
     order = fields[1]
     if barcode != last_barcode:
@@ -359,9 +409,9 @@ def make_correction_table(meta_graph, family_counts, choose_by='count'):
       degrees = graph.degree()
       def key(bar):
         return degrees[bar]
-    barcodes = sorted(graph.nodes(), key=key, reverse=True)
-    correct = barcodes[0]
-    for barcode in barcodes:
+    ranked_barcodes = sorted(graph.nodes(), key=key, reverse=True)
+    correct = ranked_barcodes[0]
+    for barcode in ranked_barcodes:
       if barcode != correct:
         logging.debug('Correcting {} ->\n           {}\n'.format(barcode, correct))
         corrections[barcode] = correct
@@ -369,18 +419,22 @@ def make_correction_table(meta_graph, family_counts, choose_by='count'):
 
 
 def print_corrected_output(families_file, corrections, reversed_barcodes, prepend=False, limit=None,
-                           output=True):
+                           output=True, outfile=sys.stdout, sorter=None):
+  """Print the families file with the barcodes corrected.
+  If a sorter (an extsort.ExternalSorter) is given, nothing is printed. Instead, the corrected lines
+  are added to the sorter, for print_sorted_output(), along with any uncorrected lines which are out
+  of order (see extsort.RunSplitter)."""
+  runs = extsort.RunSplitter()
   line_num = 0
   barcode_num = 0
   barcode_last = None
   corrected = {'reads':0, 'barcodes':0, 'reversed':0}
   reads = [0, 0]
   corrections_in_this_family = 0
-  for line in families_file:
+  for fields in famfile.read_rows(families_file):
     line_num += 1
     if limit is not None and line_num > limit:
       break
-    fields = line.rstrip('\r\n').split('\t')
     raw_barcode = fields[0]
     order = fields[1]
     if raw_barcode != barcode_last:
@@ -421,14 +475,44 @@ def print_corrected_output(families_file, corrections, reversed_barcodes, prepen
       fields.insert(0, correct_barcode)
     else:
       fields[0] = correct_barcode
-    if output:
-      print(*fields, sep='\t')
+    if sorter is not None:
+      line = '\t'.join(fields)+'\n'
+      if raw_barcode in corrections or not runs.in_order(line):
+        sorter.add(line)
+    elif output:
+      print(*fields, sep='\t', file=outfile)
   families_file.close()
   if corrections_in_this_family:
     corrected['reads'] += corrections_in_this_family
     corrected['barcodes'] += 1
   logging.info('Corrected {barcodes} barcodes on {reads} read pairs, with {reversed} reversed.'
                .format(**corrected))
+  if runs.out_of_order:
+    logging.info('{} uncorrected lines in {} runs were out of order, and had to be sorted.'
+                 .format(runs.out_of_order, runs.out_of_order_runs))
+
+
+def print_sorted_output(families_file, corrections, sorter, prepend=False, limit=None,
+                        outfile=sys.stdout):
+  """Print the lines with uncorrected barcodes merged with the lines in the sorter, in sorted order.
+  The uncorrected lines which print_corrected_output() found to be in order are read again and
+  streamed into the merge. The rest were added to the sorter, with the corrected lines."""
+  def in_order_lines():
+    runs = extsort.RunSplitter()
+    line_num = 0
+    for fields in famfile.read_rows(families_file):
+      line_num += 1
+      if limit is not None and line_num > limit:
+        break
+      if fields[0] in corrections:
+        continue
+      if prepend:
+        fields.insert(0, fields[0])
+      line = '\t'.join(fields)+'\n'
+      if runs.in_order(line):
+        yield line
+    families_file.close()
+  outfile.writelines(heapq.merge(in_order_lines(), sorter))
 
 
 def is_alignment_reversed(barcode1, barcode2):
@@ -437,8 +521,7 @@ def is_alignment_reversed(barcode1, barcode2):
   Determine by aligning the two to each other, once in their original forms, and once with the
   second barcode reversed. If the smith-waterman score is higher in the reversed form, return True.
   """
-  half = len(barcode2)//2
-  barcode2_rev = barcode2[half:] + barcode2[:half]
+  barcode2_rev = barcodes.swap_halves(barcode2)
   fwd_align = swalign.smith_waterman(barcode1, barcode2)
   rev_align = swalign.smith_waterman(barcode1, barcode2_rev)
   if rev_align.score > fwd_align.score:
@@ -590,9 +673,12 @@ def add_graph(graph, subgraph):
 
 def open_as_text_or_gzip(path):
   """Return an open file-like object reading the path as a text file or a gzip file, depending on
-  which it looks like."""
-  if detect_gzip(path):
-    return gzip.open(path, 'r')
+  which it looks like. Binary families files are opened in binary mode. BGZF files are decompressed
+  in multiple threads, and other gzip files in a separate process."""
+  if famfile.is_binary_path(path):
+    return open(path, 'rb')
+  elif detect_gzip(path):
+    return bgzf.open_input(path)
   else:
     return open(path, 'rU')
 
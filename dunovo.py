@@ -13,10 +13,14 @@ from lib import version
 from ET import phone
 import consensus
 import swalign
+import poa
+import famfile
+import bgzf
 
 SANGER_START = 33
 SOLEXA_START = 64
-OPT_DEFAULTS = {'min_reads':3, 'processes':1, 'qual':20, 'qual_format':'sanger'}
+OPT_DEFAULTS = {'min_reads':3, 'processes':1, 'qual':20, 'qual_format':'sanger',
+                'compress_output':False, 'consensus':'vote', 'aligned_duplex':False}
 USAGE = "%(prog)s [options]"
 DESCRIPTION = """Build consensus sequences from read aligned families. Prints duplex consensus \
 sequences in FASTA to stdout. The sequence ids are BARCODE.MATE, e.g. "CTCAGATAACATACCTTATATGCA.1", \
@@ -51,7 +55,9 @@ def main(argv):
               '3. mate ("1" or "2")\n'
               '4. read name\n'
               '5. aligned sequence\n'
-              '6. aligned quality scores.'))
+              '6. aligned quality scores.\n'
+              'It can also be in the binary format written by align_families.py -b, or gzipped '
+              '(BGZF or regular gzip).'))
   parser.add_argument('-r', '--min-reads', type=int,
     help=wrap('The minimum number of reads (from each strand) required to form a single-strand '
               'consensus. Strands with fewer reads will be skipped. Default: %(default)s.'))
@@ -61,6 +67,17 @@ def main(argv):
   parser.add_argument('-F', '--qual-format', choices=('sanger', 'solexa'),
     help=wrap('FASTQ quality score format. Sanger scores are assumed to begin at \'{}\' ({}). '
               'Default: %(default)s.'.format(SANGER_START, chr(SANGER_START))))
+  parser.add_argument('-c', '--consensus', choices=('vote', 'poa'),
+    help=wrap('How to build single-strand consensus sequences. "vote" counts the bases in each '
+              'column of the alignment, as described above. "poa" realigns the reads of each '
+              'family with partial-order alignment (poa.c) and takes the heaviest path through the '
+              'graph, calling bases by the same majority vote. Default: %(default)s.'))
+  parser.add_argument('-a', '--aligned-duplex', action='store_true',
+    help=wrap('The input is from align_families.py --align-duplex, where both strands of each '
+              'duplex were aligned together. The duplex consensus is then called directly from '
+              'the shared columns of the alignment instead of aligning the two single-strand '
+              'consensus sequences to each other. This votes on the columns of the alignment, so '
+              'it can\'t be used with --consensus poa, which realigns each family.'))
   parser.add_argument('--incl-sscs', action='store_true',
     help=wrap('When outputting duplex consensus sequences, include reads without a full duplex '
               '(missing one strand). The result will just be the single-strand consensus of the '
@@ -68,6 +85,8 @@ def main(argv):
   parser.add_argument('-s', '--sscs-file',
     help=wrap('Save single-strand consensus sequences in this file (FASTA format). Currently does '
               'not work when in parallel mode.'))
+  parser.add_argument('-z', '--compress-output', action='store_true',
+    help=wrap('Compress the output with BGZF (gzip-compatible).'))
   parser.add_argument('-l', '--log', metavar='LOG_FILE', dest='stats_file',
     help=wrap('Print statistics on the run to this file. Use "-" to print to stderr.'))
   parser.add_argument('-p', '--processes', type=int,
@@ -95,11 +114,16 @@ def main(argv):
     run_id = phone.send_start(__file__, version.get_version(), platform=args.platform, test=args.test)
 
   assert args.processes > 0, '-p must be greater than zero'
+  if args.aligned_duplex and args.consensus == 'poa':
+    fail('Error: --aligned-duplex calls the duplex consensus by voting on the columns of the joint '
+         'alignment, so it can\'t be used with --consensus poa.')
   # Make dict of process_family() parameters that don't change between families.
   static = {}
   static['processes'] = args.processes
   static['incl_sscs'] = args.incl_sscs
   static['min_reads'] = args.min_reads
+  static['cons_method'] = args.consensus
+  static['aligned_duplex'] = args.aligned_duplex
   if args.sscs_file:
     static['sscs_fh'] = open(args.sscs_file, 'w')
   if args.qual_format == 'sanger':
@@ -109,10 +133,9 @@ def main(argv):
   else:
     fail('Error: unrecognized --qual-format.')
 
-  if args.infile:
-    infile = open(args.infile)
-  else:
-    infile = sys.stdin
+  infile = bgzf.open_input(args.infile)
+  outfile = bgzf.open_output(compress=args.compress_output)
+  static['outfile'] = outfile
 
   if args.stats_file:
     if args.stats_file == '-':
@@ -135,8 +158,7 @@ def main(argv):
   barcode = None
   order = None
   mate = None
-  for line in infile:
-    fields = line.rstrip('\r\n').split('\t')
+  for fields in famfile.read_rows(infile):
     if len(fields) != 6:
       continue
     (this_barcode, this_order, this_mate, name, seq, qual) = fields
@@ -168,13 +190,14 @@ def main(argv):
 
   if args.processes > 1:
     close_workers(workers)
-    compile_results(workers)
+    compile_results(workers, outfile)
     delete_tempfiles(workers)
 
   if args.sscs_file:
     static['sscs_fh'].close()
   if infile is not sys.stdin:
     infile.close()
+  bgzf.close_output(outfile)
 
   end_time = time.time()
   run_time = int(end_time - start_time)
@@ -218,7 +241,7 @@ def open_workers(num_workers, args):
   return workers
 
 
-def gather_args(args, infile, excluded_flags={'-S', '--slurm'},
+def gather_args(args, infile, excluded_flags={'-S', '--slurm', '-z', '--compress-output'},
                 excluded_args={'-p', '--processes', '-l', '--log', '-s', '--sscs-file'}):
   """Take the full list of command-line arguments and return only the ones which
   should be passed to worker processes.
@@ -257,12 +280,12 @@ def close_workers(workers):
     worker['proc'].stdin.close()
 
 
-def compile_results(workers):
+def compile_results(workers, outfile=sys.stdout):
   for worker in workers:
     worker['proc'].wait()
-    with open(worker['outfile'].name, 'r') as outfile:
-      for line in outfile:
-        sys.stdout.write(line)
+    with open(worker['outfile'].name, 'r') as worker_outfile:
+      for line in worker_outfile:
+        outfile.write(line)
 
 
 def delete_tempfiles(workers):
@@ -273,7 +296,8 @@ def delete_tempfiles(workers):
 
 
 def process_duplex(duplex, barcode, workers=None, stats=None, incl_sscs=False, sscs_fh=None,
-                   processes=1, min_reads=1, qual_thres=' '):
+                   processes=1, min_reads=1, qual_thres=' ', cons_method='vote',
+                   aligned_duplex=False, outfile=sys.stdout):
   stats['families'] += 1
   # Are we the controller process or a worker?
   if processes > 1:
@@ -284,6 +308,7 @@ def process_duplex(duplex, barcode, workers=None, stats=None, incl_sscs=False, s
   # We're a worker. Actually process the family.
   start = time.time()
   consensi = []
+  alignments = []
   reads_per_strand = []
   duplex_mate = None
   for (order, mate), family in duplex.items():
@@ -299,7 +324,11 @@ def process_duplex(duplex, barcode, workers=None, stats=None, incl_sscs=False, s
       duplex_mate = 2
     seqs = [read['seq'] for read in family]
     quals = [read['qual'] for read in family]
-    consensi.append(consensus.get_consensus(seqs, quals, qual_thres=qual_thres))
+    if cons_method == 'poa':
+      consensi.append(poa.get_consensus(seqs, quals, qual_thres=qual_thres))
+    else:
+      consensi.append(consensus.get_consensus(seqs, quals, qual_thres=qual_thres))
+    alignments.append((seqs, quals))
     reads_per_strand.append(reads)
   assert len(consensi) <= 2
   if sscs_fh:
@@ -308,12 +337,22 @@ def process_duplex(duplex, barcode, workers=None, stats=None, incl_sscs=False, s
                                                              reads=reads))
       sscs_fh.write(cons+'\n')
   if len(consensi) == 1 and incl_sscs:
-    print_duplex(consensi[0], barcode, duplex_mate, reads_per_strand)
+    print_duplex(consensi[0], barcode, duplex_mate, reads_per_strand, outfile)
   elif len(consensi) == 2:
-    align = swalign.smith_waterman(*consensi)
-    #TODO: log error & return if len(align.target) != len(align.query)
-    cons = consensus.build_consensus_duplex_simple(align.target, align.query)
-    print_duplex(cons, barcode, duplex_mate, reads_per_strand)
+    (seqs1, quals1), (seqs2, quals2) = alignments
+    if aligned_duplex and len(set(len(seq) for seq in seqs1 + seqs2)) == 1:
+      # Both strands are already in one alignment. Only call the duplex consensus over the columns
+      # both strands cover, like the Smith-Waterman path does. Otherwise an overhang where only one
+      # strand has bases comes out as a run of N's.
+      start, end = get_shared_span(seqs1, seqs2, quals1, quals2, qual_thres)
+      seqs1, seqs2 = [seq[start:end] for seq in seqs1], [seq[start:end] for seq in seqs2]
+      quals1, quals2 = [qual[start:end] for qual in quals1], [qual[start:end] for qual in quals2]
+      cons = consensus.get_consensus_duplex(seqs1, seqs2, quals1, quals2, qual_thres=qual_thres)
+    else:
+      align = swalign.smith_waterman(*consensi)
+      #TODO: log error & return if len(align.target) != len(align.query)
+      cons = consensus.build_consensus_duplex_simple(align.target, align.query)
+    print_duplex(cons, barcode, duplex_mate, reads_per_strand, outfile)
   elapsed = time.time() - start
   logging.info('{} sec for {} reads.'.format(elapsed, sum(reads_per_strand)))
   if stats and len(consensi) > 0:
@@ -322,6 +361,19 @@ def process_duplex(duplex, barcode, workers=None, stats=None, incl_sscs=False, s
     stats['runs'] += 1
 
 
+def get_shared_span(seqs1, seqs2, quals1, quals2, qual_thres=' '):
+  """Find the columns of a joint duplex alignment that both strands cover: from the first to the
+  last column where neither strand's (gapped) single-strand consensus is a gap.
+  Returns the (start, end) slice coordinates, or (0, 0) if the strands don't overlap."""
+  cons1 = consensus.get_consensus(seqs1, quals1, qual_thres=qual_thres, gapped=True)
+  cons2 = consensus.get_consensus(seqs2, quals2, qual_thres=qual_thres, gapped=True)
+  shared = [i for i, (base1, base2) in enumerate(zip(cons1, cons2))
+            if base1 != '-' and base2 != '-']
+  if not shared:
+    return 0, 0
+  return shared[0], shared[-1]+1
+
+
 def print_duplex(cons, barcode, mate, reads_per_strand, outfile=sys.stdout):
   header = '>{bar}.{mate} {reads}'.format(bar=barcode, mate=mate,
                                           reads='-'.join(map(str, reads_per_strand)))
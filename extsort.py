@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+from __future__ import division
+import os
+import sys
+import zlib
+import heapq
+import itertools
+import shutil
+import struct
+import argparse
+import tempfile
+import multiprocessing.pool
+import bgzf
+
+OPT_DEFAULTS = {'mem':'1G', 'temp_dir':None, 'max_runs':64, 'threads':1, 'compression':'auto'}
+DESCRIPTION = """Sort lines with a bounded amount of memory. This is a replacement for `sort` (with
+LC_ALL=C) in the pipeline, for families.tsv files. Sorting is by whole line, which means by the
+barcode and order columns first. Lines are sorted in memory until the --mem budget is reached, then
+each sorted run is compressed and spilled to a temporary file, and the runs are merged into the
+output at the end. Runs which don't overlap are just concatenated, so only out-of-order parts of the
+input get merged. The input is read once, and lines which are already in order (see RunSplitter)
+skip the sort: they're kept as one sorted stream and merged with the sorted out-of-order lines at
+the end. So sorted input comes out unchanged, with no sorting at all."""
+
+# The most text to put in one compressed block of a run file. Blocks are smaller when the memory
+# budget is too small to hold max_runs of these at once while merging (see ExternalSorter).
+BLOCK_SIZE = 1024*1024
+# The approximate memory overhead of each line, beyond its characters: the str object itself plus
+# its pointer in the list.
+LINE_OVERHEAD = sys.getsizeof('') + 8
+SIZE_SUFFIXES = {'K':1024, 'M':1024**2, 'G':1024**3, 'T':1024**4}
+BLOCK_HEADER = struct.Struct('<I')
+
+
+def make_argparser():
+  parser = argparse.ArgumentParser(description=DESCRIPTION)
+  parser.set_defaults(**OPT_DEFAULTS)
+  parser.add_argument('infiles', metavar='families.tsv', nargs='*',
+    help='The input files. Omit to read from stdin. They can be gzipped (BGZF or regular gzip).')
+  parser.add_argument('-z', '--compress-output', action='store_true',
+    help='Compress the output with BGZF (gzip-compatible).')
+  add_sort_args(parser)
+  return parser
+
+
+def add_sort_args(parser, wrap=lambda text: text, short_options=True):
+  """Add the arguments that control an ExternalSorter to an argparse parser. Use
+  short_options=False to leave out the one-letter options (-S and -T), if the parser already has
+  its own."""
+  if short_options:
+    mem_flags, temp_dir_flags = ('-S', '--mem'), ('-T', '--temp-dir')
+  else:
+    mem_flags, temp_dir_flags = ('--mem',), ('--temp-dir',)
+  parser.add_argument(*mem_flags,
+    help=wrap('Memory budget for sorting, in bytes. Use a suffix of K, M, G, or T for kilobytes, '
+              'megabytes, etc. Default: %(default)s'))
+  parser.add_argument(*temp_dir_flags,
+    help=wrap('Write temporary run files in this directory. Default: the system temp directory '
+              '($TMPDIR, /tmp, etc).'))
+  parser.add_argument('--max-runs', type=int,
+    help=wrap('The maximum number of run files to merge at once. If there are more runs, they '
+              'will be merged in multiple passes. Default: %(default)s'))
+  parser.add_argument('--threads', type=int,
+    help=wrap('Number of threads for sorting and compressing runs. The memory budget is split '
+              'between them and the run being filled. Python only runs one sort at a time, so the '
+              'gain is in compressing and writing runs while others are sorted and filled. '
+              'Default: %(default)s'))
+  parser.add_argument('--compression', choices=('auto',)+tuple(COMPRESSORS),
+    help=wrap('Compression for the temporary run files. "auto" uses lz4 or zstd if their Python '
+              'modules are installed, and zlib otherwise. Default: %(default)s'))
+
+
+def main(argv):
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+  try:
+    sorter = ExternalSorter(**sorter_kwargs(args))
+  except ValueError as error:
+    fail('Error: '+str(error))
+  try:
+    if args.infiles:
+      lines = read_files(args.infiles)
+    else:
+      lines = sys.stdin
+    runs = RunSplitter()
+    try:
+      for line in lines:
+        if runs.in_order(line):
+          sorter.add_sorted(line)
+        else:
+          sorter.add(line)
+    finally:
+      if args.infiles:
+        lines.close()
+    outfile = bgzf.open_output(compress=args.compress_output)
+    outfile.writelines(sorter)
+    bgzf.close_output(outfile)
+  finally:
+    sorter.cleanup()
+
+
+def read_files(paths):
+  """Read the lines of each file in turn. Closing the generator closes the open file."""
+  for path in paths:
+    infile = bgzf.open_input(path)
+    try:
+      for line in infile:
+        yield line
+    finally:
+      infile.close()
+
+
+def sorter_kwargs(args):
+  """Make the ExternalSorter keyword arguments from the arguments added by add_sort_args()."""
+  return {'mem':parse_size(args.mem), 'temp_dir':args.temp_dir, 'max_runs':args.max_runs,
+          'threads':args.threads, 'compression':args.compression}
+
+
+def parse_size(size_str):
+  """Parse a size like "500M" into a number of bytes."""
+  size_str = str(size_str).strip()
+  multiplier = SIZE_SUFFIXES.get(size_str[-1:].upper())
+  if multiplier:
+    size_str = size_str[:-1]
+  else:
+    multiplier = 1
+  try:
+    return int(float(size_str) * multiplier)
+  except ValueError:
+    raise ValueError('Invalid size "{}".'.format(size_str))
+
+
+##### Run file compression #####
+
+def _zlib_codec():
+  return (lambda data: zlib.compress(data, 1)), zlib.decompress
+
+
+def _lz4_codec():
+  import lz4.frame
+  return lz4.frame.compress, lz4.frame.decompress
+
+
+def _zstd_codec():
+  import zstandard
+  # The (de)compressor objects aren't safe to share between threads, so make one per call.
+  return ((lambda data: zstandard.ZstdCompressor(level=1).compress(data)),
+          (lambda data: zstandard.ZstdDecompressor().decompress(data)))
+
+
+def _null_codec():
+  return (lambda data: data), (lambda data: data)
+
+
+COMPRESSORS = {'lz4':_lz4_codec, 'zstd':_zstd_codec, 'zlib':_zlib_codec, 'none':_null_codec}
+
+
+def get_codec(compression):
+  """Return the (compress, decompress) functions for this compression type."""
+  if compression == 'auto':
+    for name in ('lz4', 'zstd'):
+      try:
+        return COMPRESSORS[name]()
+      except ImportError:
+        pass
+    return _zlib_codec()
+  try:
+    return COMPRESSORS[compression]()
+  except KeyError:
+    raise ValueError('Unrecognized compression "{}".'.format(compression))
+  except ImportError:
+    raise ValueError('The Python module for {} compression is not installed.'.format(compression))
+
+
+##### The sorter #####
+
+class ExternalSorter(object):
+  """Sort lines of text in bounded memory.
+  Usage:
+    sorter = ExternalSorter(mem=500*1024**2)
+    for line in infile:
+      sorter.add(line)
+    for line in sorter:
+      outfile.write(line)
+    sorter.cleanup()
+  Every line must end in a newline. If all the lines fit in the memory budget, nothing is written to
+  disk. Lines known to be in sorted order can be given to add_sorted() instead of add(), to skip
+  sorting them.
+  Runs are sorted and written in "threads" background threads. list.sort() holds the GIL, so only
+  one run sorts at a time, but compression releases it, so writing runs overlaps with sorting and
+  with filling the next run. While merging, each run being read holds one decompressed block in
+  memory, twice over (as a str and as a list of lines), so the blocks are sized to fit max_runs of
+  them, plus the block being written by a multi-pass merge, in the budget."""
+
+  def __init__(self, mem=1024**3, temp_dir=None, max_runs=64, threads=1, compression='auto'):
+    if max_runs < 2:
+      raise ValueError('max_runs must be at least 2.')
+    if threads < 1:
+      raise ValueError('threads must be at least 1.')
+    self.compress, self.decompress = get_codec(compression)
+    # Up to "threads" runs can be sorting and compressing while the next one fills up.
+    self.run_mem = max(mem // (threads + 1), 1)
+    self.block_size = max(min(mem // (2 * max_runs + 1), BLOCK_SIZE), 1)
+    self.temp_base = temp_dir
+    self.max_runs = max_runs
+    self.threads = threads
+    self.temp_dir = None
+    self.pool = None
+    self.pending = []
+    self.runs = []
+    self.lines = []
+    # The lines from add_sorted() which haven't been written yet, and the [path, first line, last
+    # line] of the run file they go to once they don't fit in memory.
+    self.stream = []
+    self.stream_run = None
+    self.size = 0
+
+  def add(self, line):
+    self.lines.append(line)
+    self.size += len(line) + LINE_OVERHEAD
+    if self.size >= self.run_mem:
+      self.spill()
+
+  def add_sorted(self, line):
+    """Add a line which sorts at or after every line given to add_sorted() before it. These lines
+    aren't sorted: they're written as they are to one run, which is merged with the rest."""
+    self.stream.append(line)
+    self.size += len(line) + LINE_OVERHEAD
+    if self.size >= self.run_mem:
+      self.spill()
+
+  def add_lines(self, lines):
+    for line in lines:
+      self.add(line)
+
+  def add_chunk(self, chunk):
+    """Add a str containing multiple complete lines."""
+    lines = chunk.splitlines(True)
+    self.lines.extend(lines)
+    self.size += len(chunk) + LINE_OVERHEAD * len(lines)
+    if self.size >= self.run_mem:
+      self.spill()
+
+  def spill(self):
+    """Sort the lines in memory and write them to a new run file, in a background thread. Lines from
+    add_sorted() are appended to their own run file instead."""
+    if not self.lines and not self.stream:
+      return
+    self._make_temp_dir()
+    if self.stream:
+      self._write_stream()
+    if self.lines:
+      # Don't let more than "threads" runs be in memory at once.
+      self._finish_pending(self.threads - 1)
+      run_path = self._new_run_path()
+      self.pending.append((run_path, self.pool.apply_async(self._write_run,
+                                                           (self.lines, run_path, True))))
+      self.lines = []
+    self.size = 0
+
+  def _write_stream(self):
+    if self.stream_run is None:
+      self.stream_run = [self._new_run_path(), self.stream[0], None]
+    with open(self.stream_run[0], 'ab') as run_file:
+      self._write_blocks(run_file, self.stream)
+    self.stream_run[2] = self.stream[-1]
+    self.stream = []
+
+  def _finish_runs(self):
+    """Write everything to run files and wait for them to finish."""
+    self.spill()
+    self._finish_pending()
+    if self.stream_run is not None:
+      self.runs.append(tuple(self.stream_run))
+      self.stream_run = None
+
+  def _finish_pending(self, max_pending=0):
+    """Wait for background runs to be written, until at most max_pending are left."""
+    while len(self.pending) > max_pending:
+      run_path, result = self.pending.pop(0)
+      first, last = result.get()
+      self.runs.append((run_path, first, last))
+
+  def _make_temp_dir(self):
+    if self.temp_dir is None:
+      self.temp_dir = tempfile.mkdtemp(prefix='extsort.', dir=self.temp_base)
+      self.pool = multiprocessing.pool.ThreadPool(self.threads)
+
+  def dump_runs(self):
+    """Write all the lines added so far to sorted run files, and hand them over to the caller: return
+    them, and leave them out of cleanup(). Another sorter can merge them with add_runs().
+    Each run is a (path, first line, last line) tuple."""
+    self._finish_runs()
+    runs = self.runs
+    self.runs = []
+    # The runs are in this sorter's temp directory, so forget it, too.
+    self.temp_dir = None
+    return runs
+
+  def add_runs(self, runs):
+    """Merge in runs from dump_runs() of other sorters (with the same compression), like ones in
+    other processes. The files are deleted when they're merged or by cleanup(), like this sorter's
+    own runs (but not the directories they're in)."""
+    self._make_temp_dir()
+    self.runs.extend(runs)
+
+  def _new_run_path(self):
+    fd, path = tempfile.mkstemp(prefix='run.', dir=self.temp_dir)
+    os.close(fd)
+    return path
+
+  def _write_run(self, lines, run_path, unsorted=False):
+    """Write the lines to a run file. Returns the first and last lines."""
+    if unsorted:
+      lines.sort()
+    with open(run_path, 'wb') as run_file:
+      return self._write_blocks(run_file, lines)
+
+  def _write_blocks(self, run_file, lines):
+    """Write the lines to an open run file, in blocks. Returns the first and last lines."""
+    first = line = None
+    block = []
+    block_size = 0
+    for line in lines:
+      if first is None:
+        first = line
+      block.append(line)
+      block_size += len(line)
+      if block_size >= self.block_size:
+        self._write_block(run_file, block)
+        block = []
+        block_size = 0
+    if block:
+      self._write_block(run_file, block)
+    return first, line
+
+  def _write_block(self, run_file, block):
+    data = self.compress(''.join(block))
+    run_file.write(BLOCK_HEADER.pack(len(data)))
+    run_file.write(data)
+
+  def _read_run(self, run_path):
+    with open(run_path, 'rb') as run_file:
+      while True:
+        header = run_file.read(BLOCK_HEADER.size)
+        if not header:
+          break
+        size, = BLOCK_HEADER.unpack(header)
+        for line in self.decompress(run_file.read(size)).splitlines(True):
+          yield line
+
+  def _merge(self, runs):
+    if len(runs) == 1:
+      return self._read_run(runs[0][0])
+    return heapq.merge(*[self._read_run(run_path) for run_path, first, last in runs])
+
+  def __iter__(self):
+    if not self.runs and not self.pending and self.stream_run is None:
+      # Everything fit in memory.
+      self.lines.sort()
+      lines = self.lines
+      stream = self.stream
+      self.lines = []
+      self.stream = []
+      self.size = 0
+      if not stream:
+        return iter(lines)
+      return heapq.merge(stream, lines)
+    self._finish_runs()
+    # Runs which don't overlap any others can just be read in turn. Only the runs that overlap each
+    # other have to be merged. So already-sorted input is passed through without any merging.
+    groups = get_overlapping(self.runs)
+    # Merge down to at most max_runs runs per group, then merge those straight into the output.
+    for group in groups:
+      while len(group) > self.max_runs:
+        runs = list(group)
+        del group[:]
+        for i in range(0, len(runs), self.max_runs):
+          subgroup = runs[i:i+self.max_runs]
+          if len(subgroup) == 1:
+            group.append(subgroup[0])
+            continue
+          merged_path = self._new_run_path()
+          first, last = self._write_run(self._merge(subgroup), merged_path)
+          for run_path, run_first, run_last in subgroup:
+            os.remove(run_path)
+          group.append((merged_path, first, last))
+    self.runs = [run for group in groups for run in group]
+    return itertools.chain.from_iterable(self._merge(group) for group in groups)
+
+  def cleanup(self):
+    """Delete all temporary files."""
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+    # Runs from add_runs() can be outside the temp directory.
+    for run_path, first, last in self.runs:
+      if os.path.exists(run_path):
+        os.remove(run_path)
+    if self.temp_dir is not None:
+      shutil.rmtree(self.temp_dir, ignore_errors=True)
+      self.temp_dir = None
+    self.runs = []
+    self.stream = []
+    self.stream_run = None
+
+
+def get_overlapping(runs):
+  """Sort (path, first line, last line) runs by their first lines, and split them into groups whose
+  ranges overlap. Each group only contains lines which sort after the lines of the previous group."""
+  groups = []
+  group_last = None
+  for run in sorted(runs, key=lambda run: run[1]):
+    if groups and run[1] < group_last:
+      groups[-1].append(run)
+      group_last = max(group_last, run[2])
+    else:
+      groups.append([run])
+      group_last = run[2]
+  return groups
+
+
+class RunSplitter(object):
+  """Split a stream of lines into maximal sorted runs, and pick out the runs which are out of order.
+  The first run is in order, and so is each run which starts at or after the last line of the
+  in-order runs before it. The in-order runs make one sorted stream, which can be merged with a
+  sort of the rest. The decision only depends on the lines seen so far, so the same lines always
+  give the same answers."""
+
+  def __init__(self):
+    self.last_line = None     # The last line seen.
+    self.stream_last = None   # The last line of the in-order runs.
+    self.in_stream = True     # Whether the current run is in order.
+    self.out_of_order = 0     # The number of lines in out-of-order runs.
+    self.out_of_order_runs = 0
+
+  def in_order(self, line):
+    """Add the next line. Returns True if it's in an in-order run, False otherwise."""
+    if self.last_line is not None and line < self.last_line:
+      # A new run starts here.
+      self.in_stream = line >= self.stream_last
+      if not self.in_stream:
+        self.out_of_order_runs += 1
+    self.last_line = line
+    if self.in_stream:
+      self.stream_last = line
+    else:
+      self.out_of_order += 1
+    return self.in_stream
+
+
+def fail(message):
+  sys.stderr.write(message+"\n")
+  sys.exit(1)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
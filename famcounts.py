@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Read and write family size tables: the number of read pairs in each strand of each family.
+
+make_families.py writes one (with --counts) as it writes the families, so later stages can look up
+family sizes without rereading all the reads. The format is tab-delimited, with a "#" header line
+and then one line per barcode:
+  barcode, "ab" read pairs, "ba" read pairs
+Run as a script, this makes a table from an existing families.tsv (or families.msa.tsv) file.
+"""
+import sys
+import argparse
+import famfile
+import bgzf
+
+HEADER = '#barcode\tab\tba\n'
+
+
+def make_argparser():
+  parser = argparse.ArgumentParser(description='Make a family size table from a families file.')
+  parser.add_argument('families', nargs='?',
+    help='The families file (text or binary, optionally gzipped), grouped by barcode. Omit to '
+         'read from stdin.')
+  return parser
+
+
+def main(argv):
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+  infile = bgzf.open_input(args.families)
+  counter = FamilyCounter(sys.stdout)
+  for fields in famfile.read_rows(infile):
+    if fields[2] == '2' and len(fields) == famfile.NUM_FIELDS['msa']:
+      # Only count one of the two mates in families.msa.tsv files.
+      continue
+    counter.add(fields[0], fields[1])
+  counter.close()
+  if infile is not sys.stdin:
+    infile.close()
+
+
+class FamilyCounter(object):
+  """Count the read pairs in each family from a stream of (barcode, order) rows grouped by barcode,
+  and write the table as it goes."""
+
+  def __init__(self, outfile):
+    self.outfile = outfile
+    self.barcode = None
+    self.counts = {'ab':0, 'ba':0}
+    self.outfile.write(HEADER)
+
+  def add(self, barcode, order):
+    if barcode != self.barcode:
+      self._write()
+      self.barcode = barcode
+    self.counts[order] += 1
+
+  def add_lines(self, lines):
+    """Count families.tsv lines, and yield them back, so this can sit in the middle of a pipeline of
+    generators."""
+    for line in lines:
+      barcode, order, rest = line.split('\t', 2)
+      self.add(barcode, order)
+      yield line
+
+  def _write(self):
+    if self.barcode is not None:
+      self.outfile.write('{}\t{ab}\t{ba}\n'.format(self.barcode, **self.counts))
+    self.counts = {'ab':0, 'ba':0}
+
+  def close(self):
+    self._write()
+    self.barcode = None
+
+
+def load_counts(path):
+  """Read a family size table into a dict mapping each barcode to a dict of counts for 'ab', 'ba',
+  and 'all' (the total). Also returns the total number of read pairs."""
+  family_counts = {}
+  read_pairs = 0
+  with open(path) as counts_file:
+    for line in counts_file:
+      if line.startswith('#'):
+        continue
+      barcode, ab, ba = line.rstrip('\r\n').split('\t')
+      counts = family_counts.get(barcode)
+      if counts is None:
+        counts = family_counts[barcode] = {'ab':0, 'ba':0, 'all':0}
+      counts['ab'] += int(ab)
+      counts['ba'] += int(ba)
+      counts['all'] += int(ab) + int(ba)
+      read_pairs += int(ab) + int(ba)
+  return family_counts, read_pairs
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
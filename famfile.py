@@ -0,0 +1,364 @@
+"""Read and write families files in either the tab-delimited text format or the compact binary one.
+The text formats are families.tsv (8 columns, see make-barcodes.awk) and families.msa.tsv
+(6 columns, see align_families.py). The binary format holds the same rows. Reading either kind gives
+the same lists of fields, so callers can just replace
+  for line in infile:
+    fields = line.rstrip('\r\n').split('\t')
+with
+  for fields in famfile.read_rows(infile):
+
+Binary format (all integers little-endian):
+  header:  MAGIC, then 1 byte for the kind ('F' for families.tsv rows, 'M' for families.msa.tsv)
+  blocks:  block header (compressed payload length: uint32, payload length: uint32, number of
+           families: uint32), then the zlib-compressed payload. A block header of all zeros ends
+           the blocks.
+  payload: a series of families. Each is the barcode (a "short string": uint8 length + bytes),
+           the number of rows (uint32), and the rows. A families row is the order (short string)
+           and then read 1 and read 2. An msa row is the order, the mate (short strings), and a read.
+  read:    name (uint16 length + bytes), sequence (uint32 length, then 2-bit packed as described in
+           pack_seq() in seqtools.c), quality scores (uint32 length + bytes).
+  index:   number of blocks (uint32), then for each block its file offset (uint64) and the first
+           barcode in it (short string).
+  footer:  index offset (uint64), whether the barcodes are in sorted order (uint8), END_MAGIC.
+
+Run as a script, this converts files between the two formats.
+"""
+import sys
+import zlib
+import bisect
+import struct
+import argparse
+import seqtools
+
+MAGIC = 'DUNOVOF\x01'
+END_MAGIC = 'DNFINDEX'
+KINDS = {'families':'F', 'msa':'M'}
+NUM_FIELDS = {'families':8, 'msa':6}
+BLOCK_SIZE = 1024*1024
+BLOCK_HEADER = struct.Struct('<III')
+FOOTER = struct.Struct('<QB8s')
+UINT16 = struct.Struct('<H')
+UINT32 = struct.Struct('<I')
+UINT64 = struct.Struct('<Q')
+
+
+def make_argparser():
+  parser = argparse.ArgumentParser(description='Convert a families file between the text and binary '
+                                               'formats.')
+  parser.add_argument('infile', nargs='?',
+    help='The input families file (text or binary). Omit to read from stdin.')
+  parser.add_argument('-b', '--binary', dest='to_binary', action='store_true',
+    help='Convert to binary. Otherwise, the output is text.')
+  return parser
+
+
+def main(argv):
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+  if args.infile:
+    infile = open(args.infile, 'rb')
+  else:
+    infile = sys.stdin
+  writer = None
+  for fields in read_rows(infile):
+    if args.to_binary:
+      if writer is None:
+        kind = 'msa' if len(fields) == NUM_FIELDS['msa'] else 'families'
+        writer = BinaryWriter(sys.stdout, kind=kind)
+      writer.write_row(fields)
+    else:
+      sys.stdout.write('\t'.join(fields)+'\n')
+  if writer is not None:
+    writer.close()
+  if infile is not sys.stdin:
+    infile.close()
+
+
+class FormatError(Exception):
+  def __init__(self, message=None):
+    if message:
+      Exception.__init__(self, message)
+
+
+def is_binary(infile):
+  """Check whether a seekable file is in the binary format, leaving its position unchanged."""
+  position = infile.tell()
+  magic = infile.read(len(MAGIC))
+  infile.seek(position)
+  return magic == MAGIC
+
+
+def is_binary_path(path):
+  with open(path, 'rb') as infile:
+    return infile.read(len(MAGIC)) == MAGIC
+
+
+def read_rows(infile):
+  """Yield the rows of a families file (text or binary) as lists of fields.
+  Works on unseekable streams like stdin."""
+  start = infile.read(len(MAGIC))
+  if start == MAGIC:
+    kind = _read_kind(infile)
+    for barcode, rows in _read_binary_families(infile, kind):
+      for row in rows:
+        yield row
+  else:
+    # It's text. Put back the bytes we read.
+    if start and not start.endswith('\n'):
+      start += infile.readline()
+    for line in start.splitlines(True):
+      yield line.rstrip('\r\n').split('\t')
+    for line in infile:
+      yield line.rstrip('\r\n').split('\t')
+
+
+def read_families(infile):
+  """Yield (barcode, rows) for each family (all the rows with one barcode) in a binary file."""
+  if infile.read(len(MAGIC)) != MAGIC:
+    raise FormatError('Not a binary families file.')
+  kind = _read_kind(infile)
+  return _read_binary_families(infile, kind)
+
+
+def _read_kind(infile):
+  kind_code = infile.read(1)
+  for kind, code in KINDS.items():
+    if code == kind_code:
+      return kind
+  raise FormatError('Unrecognized kind of binary families file: {!r}'.format(kind_code))
+
+
+def _read_binary_families(infile, kind):
+  while True:
+    header = infile.read(BLOCK_HEADER.size)
+    if len(header) < BLOCK_HEADER.size:
+      raise FormatError('Binary families file is truncated.')
+    compressed_len, payload_len, num_families = BLOCK_HEADER.unpack(header)
+    if compressed_len == 0:
+      break
+    compressed = infile.read(compressed_len)
+    if len(compressed) < compressed_len:
+      raise FormatError('Binary families file is truncated.')
+    for family in decode_block(_decompress(compressed, payload_len), num_families, kind):
+      yield family
+
+
+def _decompress(compressed, payload_len):
+  try:
+    payload = zlib.decompress(compressed)
+  except zlib.error:
+    raise FormatError('Invalid block in binary families file.')
+  if len(payload) != payload_len:
+    raise FormatError('Invalid block in binary families file.')
+  return payload
+
+
+def decode_block(payload, num_families, kind):
+  """Decode a block payload into a list of (barcode, rows)."""
+  families = []
+  offset = 0
+  try:
+    for i in range(num_families):
+      barcode, offset = _unpack_short_str(payload, offset)
+      num_rows, = UINT32.unpack_from(payload, offset)
+      offset += UINT32.size
+      rows = []
+      for j in range(num_rows):
+        order, offset = _unpack_short_str(payload, offset)
+        if kind == 'families':
+          name1, seq1, qual1, offset = _unpack_read(payload, offset)
+          name2, seq2, qual2, offset = _unpack_read(payload, offset)
+          rows.append([barcode, order, name1, seq1, qual1, name2, seq2, qual2])
+        else:
+          mate, offset = _unpack_short_str(payload, offset)
+          name, seq, qual, offset = _unpack_read(payload, offset)
+          rows.append([barcode, order, mate, name, seq, qual])
+      families.append((barcode, rows))
+  except (struct.error, ValueError):
+    raise FormatError('Invalid block in binary families file.')
+  return families
+
+
+def _unpack_short_str(data, offset):
+  length = ord(data[offset])
+  offset += 1
+  return data[offset:offset+length], offset+length
+
+
+def _unpack_read(data, offset):
+  name_len, = UINT16.unpack_from(data, offset)
+  offset += UINT16.size
+  name = data[offset:offset+name_len]
+  offset += name_len
+  seq_len, = UINT32.unpack_from(data, offset)
+  offset += UINT32.size
+  seq, offset = seqtools.unpack_seq(data, seq_len, offset)
+  qual_len, = UINT32.unpack_from(data, offset)
+  offset += UINT32.size
+  qual = data[offset:offset+qual_len]
+  return name, seq, qual, offset+qual_len
+
+
+def read_index(infile):
+  """Read the block index from a seekable binary file.
+  Returns (index, is_sorted), where index is a list of (first_barcode, offset) for each block."""
+  infile.seek(-FOOTER.size, 2)
+  index_offset, is_sorted, end_magic = FOOTER.unpack(infile.read(FOOTER.size))
+  if end_magic != END_MAGIC:
+    raise FormatError('Binary families file is missing its index.')
+  infile.seek(index_offset)
+  data = infile.read()
+  num_blocks, = UINT32.unpack_from(data, 0)
+  offset = UINT32.size
+  index = []
+  for i in range(num_blocks):
+    block_offset, = UINT64.unpack_from(data, offset)
+    barcode, offset = _unpack_short_str(data, offset+UINT64.size)
+    index.append((barcode, block_offset))
+  return index, bool(is_sorted)
+
+
+def find_family(infile, barcode, index=None):
+  """Look up one family in a seekable binary file, using its index.
+  Returns its list of rows, or None if it's not in the file."""
+  infile.seek(len(MAGIC))
+  kind = _read_kind(infile)
+  if index is None:
+    index = read_index(infile)
+  blocks, is_sorted = index
+  if is_sorted:
+    # The family can only be in the last block that starts at or before it.
+    i = bisect.bisect_right([first for first, offset in blocks], barcode) - 1
+    candidates = blocks[i:i+1] if i >= 0 else []
+  else:
+    candidates = blocks
+  for first, block_offset in candidates:
+    infile.seek(block_offset)
+    compressed_len, payload_len, num_families = BLOCK_HEADER.unpack(infile.read(BLOCK_HEADER.size))
+    payload = _decompress(infile.read(compressed_len), payload_len)
+    for this_barcode, rows in decode_block(payload, num_families, kind):
+      if this_barcode == barcode:
+        return rows
+  return None
+
+
+class BinaryWriter(object):
+  """Write rows to a binary families file. The rows must be grouped by barcode.
+  Usage:
+    writer = BinaryWriter(outfile, kind='families')
+    for fields in rows:
+      writer.write_row(fields)
+    writer.close()
+  The output file doesn't have to be seekable."""
+
+  def __init__(self, outfile, kind='families', block_size=BLOCK_SIZE):
+    if kind not in KINDS:
+      raise ValueError('Unrecognized kind "{}".'.format(kind))
+    self.outfile = outfile
+    self.kind = kind
+    self.num_fields = NUM_FIELDS[kind]
+    self.block_size = block_size
+    self.offset = 0
+    self.index = []
+    self.is_sorted = True
+    self.last_barcode = None
+    self.block = []
+    self.block_len = 0
+    self.block_families = 0
+    self.barcode = None
+    self.rows = []
+    self.partial_line = ''
+    self._write(MAGIC + KINDS[kind])
+
+  def _write(self, data):
+    self.outfile.write(data)
+    self.offset += len(data)
+
+  def write_row(self, fields):
+    """Write one row, given as a list of fields (like from line.split('\t'))."""
+    if len(fields) != self.num_fields:
+      raise FormatError('Expected {} fields, found {}.'.format(self.num_fields, len(fields)))
+    if fields[0] != self.barcode:
+      self._end_family()
+      self.barcode = fields[0]
+    self.rows.append(fields)
+
+  def write_text(self, text):
+    """Write rows given as text lines (from the text format). Lines may be split across calls."""
+    lines = (self.partial_line + text).split('\n')
+    self.partial_line = lines.pop()
+    for line in lines:
+      fields = line.rstrip('\r').split('\t')
+      if len(fields) == self.num_fields:
+        self.write_row(fields)
+
+  # So a BinaryWriter can stand in for a text output file.
+  write = write_text
+
+  def _end_family(self):
+    if self.barcode is None:
+      return
+    if self.last_barcode is not None and self.barcode < self.last_barcode:
+      self.is_sorted = False
+    self.last_barcode = self.barcode
+    parts = [_pack_short_str(self.barcode), UINT32.pack(len(self.rows))]
+    for fields in self.rows:
+      parts.append(_pack_short_str(fields[1]))
+      if self.kind == 'families':
+        parts.append(_pack_read(*fields[2:5]))
+        parts.append(_pack_read(*fields[5:8]))
+      else:
+        parts.append(_pack_short_str(fields[2]))
+        parts.append(_pack_read(*fields[3:6]))
+    data = ''.join(parts)
+    if not self.block:
+      self.index.append((self.barcode, self.offset))
+    self.block.append(data)
+    self.block_len += len(data)
+    self.block_families += 1
+    self.barcode = None
+    self.rows = []
+    if self.block_len >= self.block_size:
+      self._end_block()
+
+  def _end_block(self):
+    if not self.block:
+      return
+    compressed = zlib.compress(''.join(self.block), 1)
+    self._write(BLOCK_HEADER.pack(len(compressed), self.block_len, self.block_families))
+    self._write(compressed)
+    self.block = []
+    self.block_len = 0
+    self.block_families = 0
+
+  def close(self):
+    """Finish writing the file (the last block, index, and footer). Doesn't close the outfile."""
+    if self.partial_line:
+      self.write_text('\n')
+    self._end_family()
+    self._end_block()
+    self._write(BLOCK_HEADER.pack(0, 0, 0))
+    index_offset = self.offset
+    parts = [UINT32.pack(len(self.index))]
+    for barcode, block_offset in self.index:
+      parts.append(UINT64.pack(block_offset))
+      parts.append(_pack_short_str(barcode))
+    self._write(''.join(parts))
+    self._write(FOOTER.pack(index_offset, int(self.is_sorted), END_MAGIC))
+
+
+def _pack_short_str(string):
+  if len(string) > 255:
+    raise FormatError('Value too long for the binary format (max 255): "{}"'.format(string))
+  return chr(len(string)) + string
+
+
+def _pack_read(name, seq, qual):
+  if len(name) > 65535:
+    raise FormatError('Read name too long for the binary format (max 65535): "{}"'.format(name))
+  return ''.join((UINT16.pack(len(name)), name, UINT32.pack(len(seq)), seqtools.pack_seq(seq),
+                  UINT32.pack(len(qual)), qual))
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
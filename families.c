@@ -0,0 +1,919 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+
+// The C core of make_families.py: read the two FASTQ files of a paired-end run in lockstep,
+// extract the tags from the start of each read, and format one line of families.tsv per read pair.
+// It does the same thing as the `paste | paste - - - - | awk -f make-barcodes.awk` pipeline, minus
+// the text round-trips. See make-barcodes.awk for the definition of the output columns.
+// The FASTQ reader is also used on its own (see read_batch()), by the Python iterators in families.py.
+// It accepts multi-line records and CRLF line endings.
+// Pairs can also come from a single file: interleaved FASTQ (mates in consecutive records), or
+// unaligned BAM, which is decoded here directly (see read_bam_record()).
+
+#define BUF_SIZE 1048576
+
+// Error codes returned by the reading functions.
+#define ERR_FORMAT -1
+#define ERR_TOO_BIG -2
+#define ERR_NAMES -3
+
+// Input formats.
+#define FORMAT_FASTQ 0
+#define FORMAT_BAM 1
+
+// BAM flags.
+#define BAM_PAIRED 0x1
+#define BAM_REVERSE 0x10
+#define BAM_READ1 0x40
+#define BAM_READ2 0x80
+#define BAM_SKIP 0x900  // Secondary or supplementary alignments.
+// The quality score given to BAM records without any (like `samtools fastq` does).
+#define BAM_MISSING_QUAL 1
+
+typedef struct {
+  int fd;
+  char *buf;
+  size_t size;
+  size_t start;
+  size_t end;
+  int eof;
+  long long remaining;  // The bytes left to read before the end of a range, or -1 for no limit.
+  int format;
+  int header_done;      // Whether the BAM header has been skipped yet.
+  char *scratch;        // Where BAM records are decoded into FASTQ form.
+  size_t scratch_size;
+} stream_t;
+
+// A FASTQ record. All pointers point into the buffer of the stream it was read from (or its scratch
+// buffer, for BAM), so they're only valid until the next read from that stream. They're not
+// null-terminated. The name includes the "@" (one is added for BAM records).
+typedef struct {
+  char *name;
+  int name_len;
+  char *seq;
+  int seq_len;
+  char *qual;
+  int qual_len;
+  int flag;  // The BAM flag, for records read from BAM.
+} record_t;
+
+// If stream2 is NULL, it reads single records from stream1 into rec1, unless "interleaved" is set,
+// in which case it reads pairs from consecutive records of stream1. Then rec1 is copied into "saved"
+// before rec2 is read, since reading can move the stream buffer.
+typedef struct {
+  stream_t *stream1;
+  stream_t *stream2;
+  record_t rec1;
+  record_t rec2;
+  int pending;
+  int validate_names;
+  int interleaved;
+  char *saved;
+  size_t saved_size;
+} pair_reader_t;
+
+// Filters for the barcodes of read pairs, and counts of the pairs each one removed. A pair is
+// counted under the first filter it fails, in the order the counts are listed.
+typedef struct {
+  int tag_len;
+  int invariant;
+  int max_n;            // Maximum number of N's in the barcode (both tags). Negative for no limit.
+  char min_qual;        // Minimum quality score character for tag bases. 0 for no minimum.
+  char *invariant_seq;  // The expected invariant sequence (NULL to not check it).
+  int max_mismatches;   // The maximum number of mismatches to invariant_seq in each read.
+  int max_repeat;       // The longest allowed single-base run in each tag. 0 for no limit.
+  long long pairs;      // The total number of pairs seen.
+  long long empty;      // Pairs where a read has no sequence.
+  long long failed_n;
+  long long failed_qual;
+  long long failed_invariant;
+  long long failed_repeat;
+  // Read-through trimming (see trim_readthrough()). This isn't a filter, but it's applied to the
+  // pairs which pass them.
+  int trim;             // Whether to trim read-through.
+  int trim_mismatches;  // The mismatches allowed between the mate's tag + invariant and the read.
+  int trim_min_overlap; // The fewest bases of it which have to be present at the end of a read.
+  long long trimmed;    // The number of reads trimmed.
+} filters_t;
+
+stream_t *open_stream(int fd);
+void close_stream(stream_t *stream);
+int fill_stream(stream_t *stream);
+int read_record(stream_t *stream, record_t *rec);
+int read_bam_record(stream_t *stream, record_t *rec);
+pair_reader_t *open_pair_reader(int fd1, int fd2, int validate_names);
+pair_reader_t *open_interleaved_reader(int fd, int format, int validate_names);
+void close_pair_reader(pair_reader_t *reader);
+void set_read_limits(pair_reader_t *reader, long long limit1, long long limit2);
+int read_pair(pair_reader_t *reader);
+int read_batch(pair_reader_t *reader, char *out, int out_size, int *lens, int max_records);
+int pair_line_len(record_t *rec1, record_t *rec2, int tag_len, int invariant);
+int format_pair(record_t *rec1, record_t *rec2, int tag_len, int invariant, char *out);
+int filter_pair(record_t *rec1, record_t *rec2, filters_t *filters);
+int readthrough_start(record_t *rec, record_t *mate, filters_t *filters);
+void trim_readthrough(record_t *rec1, record_t *rec2, filters_t *filters);
+int families_chunk(pair_reader_t *reader, filters_t *filters, char *out, int out_size);
+
+
+stream_t *open_stream(int fd) {
+  stream_t *stream = malloc(sizeof(stream_t));
+  stream->fd = fd;
+  stream->size = BUF_SIZE;
+  stream->buf = malloc(sizeof(char) * stream->size);
+  stream->start = 0;
+  stream->end = 0;
+  stream->eof = 0;
+  stream->remaining = -1;
+  stream->format = FORMAT_FASTQ;
+  stream->header_done = 0;
+  stream->scratch = NULL;
+  stream->scratch_size = 0;
+  return stream;
+}
+
+
+void close_stream(stream_t *stream) {
+  free(stream->buf);
+  free(stream->scratch);
+  free(stream);
+}
+
+
+// Move the unconsumed data to the start of the buffer and read more in after it. If the buffer is
+// already full of unconsumed data, double its size first.
+// If the stream has a limit, it counts as the end of the file once that many bytes have been read.
+// Returns the number of bytes read, 0 at the end of the file, or -1 on a read error.
+int fill_stream(stream_t *stream) {
+  if (stream->start > 0) {
+    memmove(stream->buf, stream->buf + stream->start, stream->end - stream->start);
+    stream->end -= stream->start;
+    stream->start = 0;
+  }
+  if (stream->end == stream->size) {
+    stream->size *= 2;
+    stream->buf = realloc(stream->buf, sizeof(char) * stream->size);
+  }
+  size_t space = stream->size - stream->end;
+  if (stream->remaining >= 0 && stream->remaining < (long long) space) {
+    space = (size_t) stream->remaining;
+  }
+  ssize_t bytes_read = 0;
+  if (space > 0) {
+    bytes_read = read(stream->fd, stream->buf + stream->end, space);
+  }
+  if (bytes_read < 0) {
+    return -1;
+  } else if (bytes_read == 0) {
+    stream->eof = 1;
+  }
+  stream->end += bytes_read;
+  if (stream->remaining >= 0) {
+    stream->remaining -= bytes_read;
+  }
+  return (int) bytes_read;
+}
+
+
+// Return the length of substr(str, start+1) in awk terms (everything after the first "start"
+// characters), without going negative.
+static int tail_len(int len, int start) {
+  return len > start ? len - start : 0;
+}
+
+
+static int min_int(int a, int b) {
+  return a < b ? a : b;
+}
+
+
+// Find the line starting at "pos". Sets "len" to its length, not counting the newline or a
+// carriage return before it, and "next" to the position of the line after it.
+// Returns 1 if the line was found, 0 if more data has to be read to find its end, or -1 if "pos" is
+// at the end of the file.
+static int next_line(stream_t *stream, size_t pos, int *len, size_t *next) {
+  if (pos >= stream->end) {
+    return stream->eof ? -1 : 0;
+  }
+  size_t line_end;
+  char *newline = memchr(stream->buf + pos, '\n', stream->end - pos);
+  if (newline == NULL) {
+    if (! stream->eof) {
+      return 0;
+    }
+    // The last line of the file has no trailing newline.
+    line_end = stream->end;
+    *next = stream->end;
+  } else {
+    line_end = newline - stream->buf;
+    *next = line_end + 1;
+  }
+  if (line_end > pos && stream->buf[line_end-1] == '\r') {
+    line_end--;
+  }
+  *len = line_end - pos;
+  return 1;
+}
+
+
+// Join "lines" consecutive lines starting at "pos" into one string, in place, by moving each one
+// back over the line endings before it.
+static void join_lines(stream_t *stream, size_t pos, int lines) {
+  size_t dest = pos;
+  size_t next;
+  int len;
+  int i;
+  for (i = 0; i < lines; i++) {
+    next_line(stream, pos, &len, &next);
+    memmove(stream->buf + dest, stream->buf + pos, len);
+    dest += len;
+    pos = next;
+  }
+}
+
+
+// Read the next FASTQ record from the stream into "rec". The sequence and quality scores can each
+// span multiple lines: the sequence lines end at the "+" line, and the quality lines end once there
+// are as many quality scores as bases. Blank lines between records are skipped.
+// Returns 1 on success, 0 at the end of the file, or -1 if the file ends in the middle of a record,
+// isn't valid FASTQ, or can't be read.
+int read_record(stream_t *stream, record_t *rec) {
+  if (stream->format == FORMAT_BAM) {
+    return read_bam_record(stream, rec);
+  }
+  size_t pos, next, name_pos, seq_pos, qual_pos;
+  int len, result, name_len, seq_len, qual_len, seq_lines, qual_lines;
+  while (1) {
+    pos = stream->start;
+    // Skip blank lines.
+    while ((result = next_line(stream, pos, &len, &next)) == 1 && len == 0) {
+      pos = next;
+      stream->start = pos;
+    }
+    if (result < 0) {
+      return 0;
+    } else if (result == 0) {
+      goto read_more;
+    }
+    if (stream->buf[pos] != '@') {
+      return -1;
+    }
+    name_pos = pos;
+    name_len = len;
+    pos = next;
+    // Sequence lines, up to the "+" line.
+    seq_pos = pos;
+    seq_len = 0;
+    seq_lines = 0;
+    while ((result = next_line(stream, pos, &len, &next)) == 1
+           && ! (len > 0 && stream->buf[pos] == '+')) {
+      seq_len += len;
+      seq_lines++;
+      pos = next;
+    }
+    if (result < 0) {
+      return -1;
+    } else if (result == 0) {
+      goto read_more;
+    }
+    pos = next;
+    // Quality lines, until they cover the whole sequence (always at least one line).
+    qual_pos = pos;
+    qual_len = 0;
+    qual_lines = 0;
+    do {
+      result = next_line(stream, pos, &len, &next);
+      if (result != 1) {
+        break;
+      }
+      qual_len += len;
+      qual_lines++;
+      pos = next;
+    } while (qual_len < seq_len);
+    if (result < 0) {
+      return -1;
+    } else if (result == 0) {
+      goto read_more;
+    }
+    // The whole record is in the buffer. Join any multi-line sequences and quality scores in place
+    // so they can be pointed to as one string.
+    if (seq_lines > 1) {
+      join_lines(stream, seq_pos, seq_lines);
+    }
+    if (qual_lines > 1) {
+      join_lines(stream, qual_pos, qual_lines);
+    }
+    stream->start = pos;
+    rec->name = stream->buf + name_pos;
+    rec->name_len = name_len;
+    rec->seq = stream->buf + seq_pos;
+    rec->seq_len = seq_len;
+    rec->qual = stream->buf + qual_pos;
+    rec->qual_len = qual_len;
+    rec->flag = 0;
+    return 1;
+    read_more:
+    // Get more data and start over, since the buffer may have moved.
+    if (fill_stream(stream) < 0) {
+      return -1;
+    }
+  }
+}
+
+
+// Make sure at least "bytes" bytes of unconsumed data are in the buffer, reading more if needed.
+// Returns 1 if they are, 0 if the file ends first, or -1 on a read error.
+static int ensure_bytes(stream_t *stream, size_t bytes) {
+  while (stream->end - stream->start < bytes) {
+    if (stream->eof) {
+      return 0;
+    }
+    if (fill_stream(stream) < 0) {
+      return -1;
+    }
+  }
+  return 1;
+}
+
+
+// Consume "bytes" bytes of the stream without keeping them. Returns 1 on success, or 0 or -1 as in
+// ensure_bytes().
+static int skip_bytes(stream_t *stream, size_t bytes) {
+  while (stream->end - stream->start < bytes) {
+    bytes -= stream->end - stream->start;
+    stream->start = stream->end;
+    if (stream->eof) {
+      return 0;
+    }
+    if (fill_stream(stream) < 0) {
+      return -1;
+    }
+  }
+  stream->start += bytes;
+  return 1;
+}
+
+
+// BAM integers are little-endian.
+static int get_int32(char *data) {
+  unsigned char *bytes = (unsigned char *) data;
+  return (int) (bytes[0] | bytes[1] << 8 | bytes[2] << 16 | (unsigned) bytes[3] << 24);
+}
+
+
+static int get_uint16(char *data) {
+  unsigned char *bytes = (unsigned char *) data;
+  return bytes[0] | bytes[1] << 8;
+}
+
+
+// Skip the BAM header: the magic string, the header text, and the reference sequence list.
+// Returns 1 on success, or -1 if it isn't BAM, is truncated, or can't be read.
+static int skip_bam_header(stream_t *stream) {
+  if (ensure_bytes(stream, 8) <= 0 || memcmp(stream->buf + stream->start, "BAM\1", 4) != 0) {
+    return -1;
+  }
+  int text_len = get_int32(stream->buf + stream->start + 4);
+  stream->start += 8;
+  if (text_len < 0 || skip_bytes(stream, text_len) <= 0 || ensure_bytes(stream, 4) <= 0) {
+    return -1;
+  }
+  int num_refs = get_int32(stream->buf + stream->start);
+  stream->start += 4;
+  int i;
+  for (i = 0; i < num_refs; i++) {
+    if (ensure_bytes(stream, 4) <= 0) {
+      return -1;
+    }
+    int ref_name_len = get_int32(stream->buf + stream->start);
+    stream->start += 4;
+    // The name, then the reference length.
+    if (ref_name_len < 0 || skip_bytes(stream, ref_name_len + 4) <= 0) {
+      return -1;
+    }
+  }
+  return 1;
+}
+
+
+// Read the next record from a stream of (decompressed) BAM into "rec", decoded into FASTQ form in
+// the stream's scratch buffer: the name gets an "@", the 4-bit bases become letters, and the
+// quality scores get the usual +33 offset. Records flagged as reverse-complemented are turned back
+// to the original orientation of the read. Secondary and supplementary records are skipped. Any
+// alignment information is ignored, so this works for aligned BAM too, if it's grouped by name.
+// Returns 1 on success, 0 at the end of the file, or -1 if the file ends in the middle of a record,
+// isn't valid BAM, or can't be read.
+int read_bam_record(stream_t *stream, record_t *rec) {
+  static const char bases[] = "=ACMGRSVTWYHKDBN";
+  static const char complements[] = "=TGKCYSBAWRDMHVN";
+  if (! stream->header_done) {
+    if (skip_bam_header(stream) < 0) {
+      return -1;
+    }
+    stream->header_done = 1;
+  }
+  while (1) {
+    int result = ensure_bytes(stream, 4);
+    if (result <= 0) {
+      return result < 0 || stream->end > stream->start ? -1 : 0;
+    }
+    int block_size = get_int32(stream->buf + stream->start);
+    if (block_size < 32 || ensure_bytes(stream, 4 + (size_t) block_size) <= 0) {
+      return -1;
+    }
+    char *data = stream->buf + stream->start + 4;
+    stream->start += 4 + block_size;
+    // The fixed-length fields we need, then the variable-length ones.
+    int name_field_len = (unsigned char) data[8];
+    int num_cigar_ops = get_uint16(data + 12);
+    int flag = get_uint16(data + 14);
+    int seq_len = get_int32(data + 16);
+    if (name_field_len < 1 || seq_len < 0
+        || 32 + name_field_len + 4 * (long long) num_cigar_ops + (seq_len + 1) / 2 + (long long) seq_len
+           > block_size) {
+      return -1;
+    }
+    if (flag & BAM_SKIP) {
+      continue;
+    }
+    char *name = data + 32;
+    int name_len = name_field_len - 1;  // Minus the null terminator.
+    unsigned char *packed_seq = (unsigned char *) name + name_field_len + 4 * num_cigar_ops;
+    unsigned char *quals = packed_seq + (seq_len + 1) / 2;
+    size_t needed = 1 + name_len + 2 * (size_t) seq_len;
+    if (needed > stream->scratch_size) {
+      stream->scratch_size = needed * 2;
+      stream->scratch = realloc(stream->scratch, sizeof(char) * stream->scratch_size);
+    }
+    char *out = stream->scratch;
+    out[0] = '@';
+    memcpy(out + 1, name, name_len);
+    char *seq = out + 1 + name_len;
+    char *qual = seq + seq_len;
+    int reverse = flag & BAM_REVERSE;
+    int i;
+    for (i = 0; i < seq_len; i++) {
+      int code = (packed_seq[i/2] >> (i % 2 ? 0 : 4)) & 0xf;
+      int dest = reverse ? seq_len - 1 - i : i;
+      seq[dest] = reverse ? complements[code] : bases[code];
+      // A first score of 0xff means the record has no quality scores.
+      qual[dest] = 33 + (quals[0] == 0xff ? BAM_MISSING_QUAL : quals[i]);
+    }
+    rec->name = out;
+    rec->name_len = 1 + name_len;
+    rec->seq = seq;
+    rec->seq_len = seq_len;
+    rec->qual = qual;
+    rec->qual_len = seq_len;
+    rec->flag = flag;
+    return 1;
+  }
+}
+
+
+// Open a reader for a pair of FASTQ files, or a single one if "fd2" is negative.
+// If "validate_names" is true, read_pair() checks that the two reads in each pair have the same name.
+pair_reader_t *open_pair_reader(int fd1, int fd2, int validate_names) {
+  pair_reader_t *reader = malloc(sizeof(pair_reader_t));
+  reader->stream1 = open_stream(fd1);
+  reader->stream2 = fd2 < 0 ? NULL : open_stream(fd2);
+  reader->pending = 0;
+  reader->validate_names = validate_names;
+  reader->interleaved = 0;
+  reader->saved = NULL;
+  reader->saved_size = 0;
+  return reader;
+}
+
+
+// Open a reader for pairs from a single file, with the two mates of each pair in consecutive
+// records. "format" is FORMAT_FASTQ for interleaved FASTQ, or FORMAT_BAM for (decompressed) BAM. In
+// BAM, the mates can be in either order, but they must be flagged as the first and second reads.
+pair_reader_t *open_interleaved_reader(int fd, int format, int validate_names) {
+  pair_reader_t *reader = open_pair_reader(fd, -1, validate_names);
+  reader->stream1->format = format;
+  reader->interleaved = 1;
+  return reader;
+}
+
+
+void close_pair_reader(pair_reader_t *reader) {
+  close_stream(reader->stream1);
+  if (reader->stream2 != NULL) {
+    close_stream(reader->stream2);
+  }
+  free(reader->saved);
+  free(reader);
+}
+
+
+// Whether the reader reads pairs (as opposed to single records).
+static int is_paired(pair_reader_t *reader) {
+  return reader->stream2 != NULL || reader->interleaved;
+}
+
+
+// Stop reading each file after this many bytes from its current position, as if it ended there.
+// This is for reading a range of a file: seek its descriptor to the start of the range first.
+// Give -1 for no limit.
+void set_read_limits(pair_reader_t *reader, long long limit1, long long limit2) {
+  reader->stream1->remaining = limit1;
+  if (reader->stream2 != NULL) {
+    reader->stream2->remaining = limit2;
+  }
+}
+
+
+// The length of the read id in a FASTQ name line (without the "@"): everything before the first
+// whitespace, minus any "/1" or "/2" mate suffix.
+static int id_len(char *name, int name_len) {
+  int i;
+  for (i = 0; i < name_len; i++) {
+    if (name[i] == ' ' || name[i] == '\t') {
+      break;
+    }
+  }
+  if (i >= 2 && name[i-2] == '/' && (name[i-1] == '1' || name[i-1] == '2')) {
+    i -= 2;
+  }
+  return i;
+}
+
+
+static int names_match(record_t *rec1, record_t *rec2) {
+  int len1 = id_len(rec1->name + 1, rec1->name_len - 1);
+  int len2 = id_len(rec2->name + 1, rec2->name_len - 1);
+  return len1 == len2 && memcmp(rec1->name + 1, rec2->name + 1, len1) == 0;
+}
+
+
+// Copy a record's fields into the reader's "saved" buffer and point the record at the copy.
+static void save_record(pair_reader_t *reader, record_t *rec) {
+  size_t needed = rec->name_len + rec->seq_len + rec->qual_len;
+  if (needed > reader->saved_size) {
+    reader->saved_size = needed * 2;
+    reader->saved = realloc(reader->saved, sizeof(char) * reader->saved_size);
+  }
+  char *out = reader->saved;
+  memcpy(out, rec->name, rec->name_len);
+  rec->name = out;
+  out += rec->name_len;
+  memcpy(out, rec->seq, rec->seq_len);
+  rec->seq = out;
+  out += rec->seq_len;
+  memcpy(out, rec->qual, rec->qual_len);
+  rec->qual = out;
+}
+
+
+// Read a pair from two consecutive records of stream1. For BAM, put them in order by their flags.
+static int read_interleaved_pair(pair_reader_t *reader) {
+  int result = read_record(reader->stream1, &reader->rec1);
+  if (result <= 0) {
+    return result < 0 ? ERR_FORMAT : 0;
+  }
+  save_record(reader, &reader->rec1);
+  // A missing second mate is an error.
+  if (read_record(reader->stream1, &reader->rec2) <= 0) {
+    return ERR_FORMAT;
+  }
+  if (reader->stream1->format == FORMAT_BAM) {
+    int flag1 = reader->rec1.flag;
+    int flag2 = reader->rec2.flag;
+    if (! (flag1 & BAM_PAIRED && flag2 & BAM_PAIRED)) {
+      return ERR_FORMAT;
+    }
+    if (flag1 & BAM_READ2 && flag2 & BAM_READ1) {
+      record_t rec = reader->rec1;
+      reader->rec1 = reader->rec2;
+      reader->rec2 = rec;
+    } else if (! (flag1 & BAM_READ1 && flag2 & BAM_READ2)) {
+      return ERR_FORMAT;
+    }
+  }
+  if (reader->validate_names && ! names_match(&reader->rec1, &reader->rec2)) {
+    return ERR_NAMES;
+  }
+  return 1;
+}
+
+
+// Read the next pair of records into reader->rec1 and reader->rec2 (or just the next record into
+// reader->rec1, for a single file that isn't interleaved).
+// Returns 1 on success, 0 when both files end, ERR_FORMAT if the files are invalid, truncated or have
+// different numbers of records (or an interleaved file has an unpaired record), or ERR_NAMES if the
+// names of the pair don't match.
+int read_pair(pair_reader_t *reader) {
+  if (reader->interleaved) {
+    return read_interleaved_pair(reader);
+  }
+  int result1 = read_record(reader->stream1, &reader->rec1);
+  if (reader->stream2 == NULL) {
+    return result1 < 0 ? ERR_FORMAT : result1;
+  }
+  int result2 = read_record(reader->stream2, &reader->rec2);
+  if (result1 < 0 || result2 < 0 || result1 != result2) {
+    return ERR_FORMAT;
+  }
+  if (result1 > 0 && reader->validate_names && ! names_match(&reader->rec1, &reader->rec2)) {
+    return ERR_NAMES;
+  }
+  return result1;
+}
+
+
+// Copy the current record's name (without the "@"), sequence and quality scores to "out", and
+// their lengths to "lens". Returns the number of characters written.
+static int copy_record(record_t *rec, char *out, int *lens) {
+  int name_len = tail_len(rec->name_len, 1);
+  memcpy(out, rec->name + 1, name_len);
+  memcpy(out + name_len, rec->seq, rec->seq_len);
+  memcpy(out + name_len + rec->seq_len, rec->qual, rec->qual_len);
+  lens[0] = name_len;
+  lens[1] = rec->seq_len;
+  lens[2] = rec->qual_len;
+  return name_len + rec->seq_len + rec->qual_len;
+}
+
+
+// Read as many records (or pairs) as will fit into "out" and "lens". The name, sequence and quality
+// scores of each record are copied into "out" back to back, with no delimiters, and their lengths
+// are put in "lens" (3 per record, or 6 per pair). This way the caller can take a whole batch of
+// records at once instead of making a call per record.
+// Returns the number of records (or pairs) read, 0 at the end of the file(s), or an error code:
+// ERR_FORMAT or ERR_NAMES as in read_pair(), or ERR_TOO_BIG if one record won't fit in "out_size".
+int read_batch(pair_reader_t *reader, char *out, int out_size, int *lens, int max_records) {
+  int fields = is_paired(reader) ? 6 : 3;
+  int written = 0;
+  int records = 0;
+  while (records < max_records) {
+    if (! reader->pending) {
+      int result = read_pair(reader);
+      if (result <= 0) {
+        return result < 0 ? result : records;
+      }
+    }
+    int size = reader->rec1.name_len + reader->rec1.seq_len + reader->rec1.qual_len;
+    if (is_paired(reader)) {
+      size += reader->rec2.name_len + reader->rec2.seq_len + reader->rec2.qual_len;
+    }
+    if (written + size > out_size) {
+      reader->pending = 1;
+      return records > 0 ? records : ERR_TOO_BIG;
+    }
+    written += copy_record(&reader->rec1, out + written, lens + records*fields);
+    if (is_paired(reader)) {
+      written += copy_record(&reader->rec2, out + written, lens + records*fields + 3);
+    }
+    records++;
+    reader->pending = 0;
+  }
+  return records;
+}
+
+
+// The number of characters format_pair() will write for this pair, including the newline.
+int pair_line_len(record_t *rec1, record_t *rec2, int tag_len, int invariant) {
+  int trim = tag_len + invariant;
+  int len = min_int(rec1->seq_len, tag_len) + min_int(rec2->seq_len, tag_len);
+  len += 3;  // order
+  len += tail_len(rec1->name_len, 1) + 1;
+  len += tail_len(rec1->seq_len, trim) + 1 + tail_len(rec1->qual_len, trim) + 1;
+  len += tail_len(rec2->name_len, 1) + 1;
+  len += tail_len(rec2->seq_len, trim) + 1 + tail_len(rec2->qual_len, trim) + 1;
+  return len;
+}
+
+
+static char *write_field(char *out, char *str, int len, char delim) {
+  memcpy(out, str, len);
+  out[len] = delim;
+  return out + len + 1;
+}
+
+
+// Format a read pair as a line of families.tsv, exactly as make-barcodes.awk would. The output is
+// written to "out", which must have room for pair_line_len() characters. It is not null-terminated.
+// Returns the number of characters written.
+int format_pair(record_t *rec1, record_t *rec2, int tag_len, int invariant, char *out) {
+  int trim = tag_len + invariant;
+  int alpha_len = min_int(rec1->seq_len, tag_len);
+  int beta_len = min_int(rec2->seq_len, tag_len);
+  // Compare the tags as strings. The lesser one goes first (the beta goes first if they're equal).
+  int cmp = memcmp(rec1->seq, rec2->seq, min_int(alpha_len, beta_len));
+  if (cmp == 0) {
+    cmp = alpha_len - beta_len;
+  }
+  char *start = out;
+  if (cmp < 0) {
+    out = write_field(out, rec1->seq, alpha_len, '\0') - 1;
+    out = write_field(out, rec2->seq, beta_len, '\t');
+    out = write_field(out, "ab", 2, '\t');
+  } else {
+    out = write_field(out, rec2->seq, beta_len, '\0') - 1;
+    out = write_field(out, rec1->seq, alpha_len, '\t');
+    out = write_field(out, "ba", 2, '\t');
+  }
+  out = write_field(out, rec1->name + 1, tail_len(rec1->name_len, 1), '\t');
+  out = write_field(out, rec1->seq + trim, tail_len(rec1->seq_len, trim), '\t');
+  out = write_field(out, rec1->qual + trim, tail_len(rec1->qual_len, trim), '\t');
+  out = write_field(out, rec2->name + 1, tail_len(rec2->name_len, 1), '\t');
+  out = write_field(out, rec2->seq + trim, tail_len(rec2->seq_len, trim), '\t');
+  out = write_field(out, rec2->qual + trim, tail_len(rec2->qual_len, trim), '\n');
+  return out - start;
+}
+
+
+static int count_ns(record_t *rec, int tag_len) {
+  int count = 0;
+  int i;
+  for (i = 0; i < rec->seq_len && i < tag_len; i++) {
+    if (rec->seq[i] == 'N' || rec->seq[i] == 'n') {
+      count++;
+    }
+  }
+  return count;
+}
+
+
+static int min_tag_qual(record_t *rec, int tag_len) {
+  char min_qual = 127;
+  int i;
+  for (i = 0; i < rec->qual_len && i < tag_len; i++) {
+    if (rec->qual[i] < min_qual) {
+      min_qual = rec->qual[i];
+    }
+  }
+  return min_qual;
+}
+
+
+// The number of mismatches between the read's invariant region and the expected sequence. Missing
+// bases (if the read is too short) count as mismatches.
+static int invariant_mismatches(record_t *rec, filters_t *filters) {
+  int mismatches = 0;
+  int i;
+  for (i = 0; i < filters->invariant; i++) {
+    int pos = filters->tag_len + i;
+    if (pos >= rec->seq_len || rec->seq[pos] != filters->invariant_seq[i]) {
+      mismatches++;
+    }
+  }
+  return mismatches;
+}
+
+
+// The length of the longest run of one base in the tag.
+static int longest_repeat(record_t *rec, int tag_len) {
+  int longest = 0;
+  int run = 0;
+  int i;
+  for (i = 0; i < rec->seq_len && i < tag_len; i++) {
+    if (i > 0 && rec->seq[i] == rec->seq[i-1]) {
+      run++;
+    } else {
+      run = 1;
+    }
+    if (run > longest) {
+      longest = run;
+    }
+  }
+  return longest;
+}
+
+
+// Apply the filters to a pair, and count it. Returns 1 if it passes, 0 if it fails.
+int filter_pair(record_t *rec1, record_t *rec2, filters_t *filters) {
+  filters->pairs++;
+  if (rec1->seq_len == 0 || rec2->seq_len == 0) {
+    filters->empty++;
+    return 0;
+  }
+  if (filters->max_n >= 0
+      && count_ns(rec1, filters->tag_len) + count_ns(rec2, filters->tag_len) > filters->max_n) {
+    filters->failed_n++;
+    return 0;
+  }
+  if (filters->min_qual && (min_tag_qual(rec1, filters->tag_len) < filters->min_qual
+                            || min_tag_qual(rec2, filters->tag_len) < filters->min_qual)) {
+    filters->failed_qual++;
+    return 0;
+  }
+  if (filters->invariant_seq != NULL
+      && (invariant_mismatches(rec1, filters) > filters->max_mismatches
+          || invariant_mismatches(rec2, filters) > filters->max_mismatches)) {
+    filters->failed_invariant++;
+    return 0;
+  }
+  if (filters->max_repeat > 0 && (longest_repeat(rec1, filters->tag_len) > filters->max_repeat
+                                  || longest_repeat(rec2, filters->tag_len) > filters->max_repeat)) {
+    filters->failed_repeat++;
+    return 0;
+  }
+  return 1;
+}
+
+
+static char complement(char base) {
+  switch (base) {
+    case 'A': return 'T';
+    case 'C': return 'G';
+    case 'G': return 'C';
+    case 'T': return 'A';
+    default: return 'N';
+  }
+}
+
+
+// Find where a read runs through the end of its insert and into the mate's barcode. Then, the
+// read continues with the reverse complement of the start of the mate (its invariant and tag), and
+// then the adapter. This looks for the first place after the read's own tag and invariant where the
+// reverse complement of the mate's first tag_len + invariant bases matches, with up to
+// trim_mismatches mismatches (N's are mismatches). At the end of the read, a partial match of at
+// least trim_min_overlap bases counts.
+// Returns the position where the read-through starts, or -1 if there is none.
+int readthrough_start(record_t *rec, record_t *mate, filters_t *filters) {
+  int probe_len = filters->tag_len + filters->invariant;
+  if (mate->seq_len < probe_len || filters->trim_min_overlap < 1) {
+    return -1;
+  }
+  char probe[probe_len];
+  int i;
+  for (i = 0; i < probe_len; i++) {
+    probe[i] = complement(mate->seq[probe_len-1-i]);
+  }
+  int pos;
+  for (pos = probe_len; pos < rec->seq_len; pos++) {
+    int overlap = min_int(probe_len, rec->seq_len - pos);
+    if (overlap < filters->trim_min_overlap) {
+      break;
+    }
+    int mismatches = 0;
+    for (i = 0; i < overlap && mismatches <= filters->trim_mismatches; i++) {
+      if (rec->seq[pos+i] != probe[i] || probe[i] == 'N') {
+        mismatches++;
+      }
+    }
+    if (mismatches <= filters->trim_mismatches) {
+      return pos;
+    }
+  }
+  return -1;
+}
+
+
+// Trim any read-through off the ends of both reads, keeping the quality scores the same length as
+// the sequences. This only shortens the records; the tags and invariants are never touched.
+void trim_readthrough(record_t *rec1, record_t *rec2, filters_t *filters) {
+  // Find both before trimming either, since each search uses the start of the other read.
+  int start1 = readthrough_start(rec1, rec2, filters);
+  int start2 = readthrough_start(rec2, rec1, filters);
+  if (start1 >= 0) {
+    rec1->seq_len = start1;
+    rec1->qual_len = min_int(rec1->qual_len, start1);
+    filters->trimmed++;
+  }
+  if (start2 >= 0) {
+    rec2->seq_len = start2;
+    rec2->qual_len = min_int(rec2->qual_len, start2);
+    filters->trimmed++;
+  }
+}
+
+
+// Fill "out" with as many families.tsv lines as will fit in "out_size" characters.
+// Pairs where either read has no sequence are skipped, like in make-barcodes.awk, as are pairs that
+// fail the filters. The tag and invariant lengths come from "filters" too, as do the read-through
+// trimming settings.
+// Returns the number of characters written, 0 when there are no more pairs, or an error code as in
+// read_pair(). If a single line is longer than "out_size", it returns ERR_TOO_BIG (call again with a
+// bigger buffer).
+int families_chunk(pair_reader_t *reader, filters_t *filters, char *out, int out_size) {
+  int tag_len = filters->tag_len;
+  int invariant = filters->invariant;
+  int written = 0;
+  while (1) {
+    if (! reader->pending) {
+      int result = read_pair(reader);
+      if (result <= 0) {
+        return result < 0 ? result : written;
+      }
+      if (! filter_pair(&reader->rec1, &reader->rec2, filters)) {
+        continue;
+      }
+      if (filters->trim) {
+        trim_readthrough(&reader->rec1, &reader->rec2, filters);
+      }
+    }
+    int line_len = pair_line_len(&reader->rec1, &reader->rec2, tag_len, invariant);
+    if (written + line_len > out_size) {
+      // Keep this pair for the next call. Its records stay valid since we don't read again until
+      // we've written it.
+      reader->pending = 1;
+      return written > 0 ? written : ERR_TOO_BIG;
+    }
+    written += format_pair(&reader->rec1, &reader->rec2, tag_len, invariant, out + written);
+    reader->pending = 0;
+  }
+}
@@ -0,0 +1,192 @@
+import os
+import errno
+import ctypes
+
+# Locate the library file.
+LIBFILE = 'libfamilies.so'
+script_dir = os.path.dirname(os.path.realpath(__file__))
+library_path = os.path.join(script_dir, LIBFILE)
+if not os.path.isfile(library_path):
+  library_path = os.path.join(script_dir, '..', 'lib', LIBFILE)
+  if not os.path.isfile(library_path):
+    ioe = IOError('Library file "'+LIBFILE+'" not found.')
+    ioe.errno = errno.ENOENT
+    raise ioe
+
+class Filters(ctypes.Structure):
+  """The barcode filters applied by read_family_chunks(), and counts of the read pairs each one
+  removed. Mirrors filters_t in families.c."""
+  _fields_ = [
+    ('tag_len', ctypes.c_int),
+    ('invariant', ctypes.c_int),
+    ('max_n', ctypes.c_int),
+    ('min_qual', ctypes.c_char),
+    ('invariant_seq', ctypes.c_char_p),
+    ('max_mismatches', ctypes.c_int),
+    ('max_repeat', ctypes.c_int),
+    ('pairs', ctypes.c_longlong),
+    ('empty', ctypes.c_longlong),
+    ('failed_n', ctypes.c_longlong),
+    ('failed_qual', ctypes.c_longlong),
+    ('failed_invariant', ctypes.c_longlong),
+    ('failed_repeat', ctypes.c_longlong),
+    ('trim', ctypes.c_int),
+    ('trim_mismatches', ctypes.c_int),
+    ('trim_min_overlap', ctypes.c_int),
+    ('trimmed', ctypes.c_longlong),
+  ]
+  COUNTS = ('pairs', 'empty', 'failed_n', 'failed_qual', 'failed_invariant', 'failed_repeat')
+
+  def __init__(self, tag_len=12, invariant=5, max_n=None, min_qual=None, invariant_seq=None,
+               max_mismatches=0, max_repeat=None, trim=False, trim_mismatches=1,
+               trim_min_overlap=10):
+    """min_qual is the quality score character (e.g. chr(20+33) for PHRED 20 in Sanger format).
+    Give None for any filter to disable it.
+    If "trim" is True, reads which run through their insert into the mate's invariant and tag are
+    trimmed where that starts (see trim_readthrough() in families.c)."""
+    if invariant_seq is not None and len(invariant_seq) != invariant:
+      raise ValueError('The expected invariant sequence "{}" isn\'t {} bases long.'
+                       .format(invariant_seq, invariant))
+    ctypes.Structure.__init__(self, tag_len=tag_len, invariant=invariant,
+                              max_n=-1 if max_n is None else max_n,
+                              min_qual=min_qual or '\0', invariant_seq=invariant_seq,
+                              max_mismatches=max_mismatches, max_repeat=max_repeat or 0,
+                              trim=trim, trim_mismatches=trim_mismatches,
+                              trim_min_overlap=trim_min_overlap)
+
+  def get_counts(self):
+    """Return the counts as a dict, plus "passed", the number of pairs that passed, and "trimmed",
+    the number of reads trimmed."""
+    counts = dict((name, getattr(self, name)) for name in self.COUNTS)
+    counts['passed'] = counts['pairs'] - sum(counts[name] for name in self.COUNTS[1:])
+    counts['trimmed'] = self.trimmed
+    return counts
+
+
+families = ctypes.cdll.LoadLibrary(library_path)
+families.open_pair_reader.restype = ctypes.c_void_p
+families.open_pair_reader.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int]
+families.open_interleaved_reader.restype = ctypes.c_void_p
+families.open_interleaved_reader.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int]
+families.close_pair_reader.argtypes = [ctypes.c_void_p]
+families.set_read_limits.argtypes = [ctypes.c_void_p, ctypes.c_longlong, ctypes.c_longlong]
+families.families_chunk.argtypes = [ctypes.c_void_p, ctypes.POINTER(Filters), ctypes.c_char_p,
+                                     ctypes.c_int]
+families.read_batch.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int,
+                                ctypes.POINTER(ctypes.c_int), ctypes.c_int]
+
+CHUNK_SIZE = 4*1024*1024
+BATCH_SIZE = 1024*1024
+BATCH_RECORDS = 4096
+# Error codes from families.c.
+ERR_FORMAT = -1
+ERR_TOO_BIG = -2
+ERR_NAMES = -3
+# Input formats for interleaved readers, from families.c.
+FORMATS = {'fastq':0, 'bam':1}
+
+
+class FormatError(Exception):
+  def __init__(self, message=None):
+    if message:
+      Exception.__init__(self, message)
+
+
+def _check_error(code):
+  if code == ERR_FORMAT:
+    raise FormatError('Invalid or truncated input, the two files have different numbers of reads, or '
+                      'an interleaved file has a read without its mate.')
+  elif code == ERR_NAMES:
+    raise FormatError('Read pair mismatch: the names of two mates are different.')
+
+
+def _open_reader(infile1, infile2, validate_names, input_format):
+  """Open a C pair reader. If infile2 is None, infile1 has both mates of each pair, as interleaved
+  FASTQ or (decompressed) BAM, depending on input_format."""
+  if infile2 is None:
+    return families.open_interleaved_reader(infile1.fileno(), FORMATS[input_format], validate_names)
+  return families.open_pair_reader(infile1.fileno(), infile2.fileno(), validate_names)
+
+
+def read_family_chunks(fastq1, fastq2, tag_len=12, invariant=5, chunk_size=CHUNK_SIZE,
+                       validate_names=False, filters=None, limits=None, input_format='fastq'):
+  """Read pairs from two open FASTQ files and yield families.tsv lines (see make-barcodes.awk).
+  Each yield is a str of multiple complete lines (all ending in a newline).
+  The files must be real file objects (with file descriptors). If validate_names is True, raise a
+  FormatError if the ids of two mates don't match (ignoring any "/1" and "/2" suffixes).
+  To read pairs from a single file, give None for fastq2. Then input_format says whether fastq1 is
+  interleaved FASTQ ('fastq') or unaligned BAM ('bam'), already decompressed (like from
+  bgzf.open_input()). BAM reads are named without the "@", and their bases and quality scores are
+  put back in their original orientation if they're flagged as reverse-complemented.
+  Give a Filters object to remove pairs with bad barcodes. Its tag_len and invariant override the
+  arguments, and its counts are updated as the pairs are read.
+  To read only part of the files, seek their descriptors to the start of the part, and give limits,
+  a tuple of the number of bytes to read from each (-1 for no limit)."""
+  if filters is None:
+    filters = Filters(tag_len=tag_len, invariant=invariant)
+  reader = _open_reader(fastq1, fastq2, validate_names, input_format)
+  if limits is not None:
+    families.set_read_limits(reader, *limits)
+  try:
+    buf = ctypes.create_string_buffer(chunk_size)
+    while True:
+      written = families.families_chunk(reader, ctypes.byref(filters), buf, len(buf))
+      if written == 0:
+        break
+      elif written == ERR_TOO_BIG:
+        buf = ctypes.create_string_buffer(len(buf)*2)
+        continue
+      _check_error(written)
+      yield buf.raw[:written]
+  finally:
+    families.close_pair_reader(reader)
+
+
+def read_pairs(fastq1, fastq2, validate_names=False, input_format='fastq'):
+  """Read two open FASTQ files in lockstep and yield each pair of reads as a tuple:
+    (name1, seq1, qual1, name2, seq2, qual2)
+  The names don't include the "@". Records can span multiple lines, and lines can end in CRLF.
+  The files must be real file objects (with file descriptors). If validate_names is True, raise a
+  FormatError if the ids of two mates don't match (ignoring any "/1" and "/2" suffixes).
+  Give None for fastq2 to read pairs from one interleaved file, as in read_family_chunks()."""
+  return _read_batches(fastq1, fastq2, validate_names, input_format, paired=True)
+
+
+def read_fastq(fastq):
+  """Read an open FASTQ file and yield each read as a (name, seq, qual) tuple. Otherwise the same as
+  read_pairs()."""
+  return _read_batches(fastq, None, False, 'fastq', paired=False)
+
+
+def _read_batches(fastq1, fastq2, validate_names, input_format, paired):
+  # The reads are copied out of the C buffers a batch at a time, so there's one ctypes call and one
+  # copy per batch, and the only per-read work left in Python is slicing the fields out of it.
+  # (This keeps references to the file objects, so they aren't closed while it's reading them.)
+  if paired:
+    fields = 6
+    reader = _open_reader(fastq1, fastq2, validate_names, input_format)
+  else:
+    fields = 3
+    reader = families.open_pair_reader(fastq1.fileno(), -1, False)
+  try:
+    buf = ctypes.create_string_buffer(BATCH_SIZE)
+    lens_array = (ctypes.c_int * (BATCH_RECORDS * fields))()
+    while True:
+      records = families.read_batch(reader, buf, len(buf), lens_array, BATCH_RECORDS)
+      if records == 0:
+        break
+      elif records == ERR_TOO_BIG:
+        buf = ctypes.create_string_buffer(len(buf)*2)
+        continue
+      _check_error(records)
+      lens = lens_array[:records*fields]
+      data = ctypes.string_at(buf, sum(lens))
+      start = 0
+      for i in range(0, len(lens), fields):
+        record = []
+        for length in lens[i:i+fields]:
+          record.append(data[start:start+length])
+          start += length
+        yield tuple(record)
+  finally:
+    families.close_pair_reader(reader)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""Index a families.tsv or families.msa.tsv file by barcode, so single families can be read without
+scanning the whole file.
+
+The index is a tab-delimited sidecar file (by default, the families file's path plus ".fidx"). After
+a "#" header line, there's one line per (barcode, order) block of lines, sorted by barcode and order:
+  barcode, order, offset, number of lines
+The offset is the byte offset of the block's first line. If the families file is BGZF-compressed
+(see bgzf.py), it's a virtual offset instead.
+
+Run as a script, this writes the index for a families file, or, if barcodes are given, prints those
+families using an existing index.
+"""
+from __future__ import division
+import os
+import sys
+import bisect
+import argparse
+import bgzf
+
+INDEX_EXT = '.fidx'
+HEADER = '#barcode\torder\toffset\tlines\n'
+
+
+def make_argparser():
+  parser = argparse.ArgumentParser(description='Index a families.tsv or families.msa.tsv file by '
+                                               'barcode, or print families from an indexed file.')
+  parser.add_argument('families',
+    help='The families file. It must be grouped by barcode (as sorted by make_families.py). It can '
+         'be plain text or BGZF-compressed.')
+  parser.add_argument('barcodes', nargs='*',
+    help='Print the families with these barcodes instead of making the index.')
+  parser.add_argument('-r', '--range', nargs=2, metavar=('START', 'END'),
+    help='Print all families with barcodes from START up to (but not including) END instead of '
+         'making the index.')
+  parser.add_argument('-o', '--order', choices=('ab', 'ba'),
+    help='Only print the reads from this strand.')
+  parser.add_argument('-i', '--index',
+    help='The index file. Default: the families path plus "'+INDEX_EXT+'".')
+  return parser
+
+
+def main(argv):
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+  index_path = args.index or get_index_path(args.families)
+  infile = open_families(args.families)
+  try:
+    if not (args.barcodes or args.range):
+      with open(index_path, 'w') as index_file:
+        write_index(make_index(infile), index_file)
+      return
+    try:
+      index = FamilyIndex.load(index_path)
+    except IOError as error:
+      fail('Error reading index file "{}": {}'.format(index_path, error.strerror))
+    for barcode in args.barcodes:
+      sys.stdout.writelines(read_family(infile, index, barcode, args.order))
+    if args.range:
+      sys.stdout.writelines(read_range(infile, index, args.range[0], args.range[1], args.order))
+  except IOError as error:
+    # Let the output be piped to `head`.
+    if error.errno != 32:
+      raise
+  finally:
+    infile.close()
+
+
+def get_index_path(families_path):
+  return families_path+INDEX_EXT
+
+
+def open_families(path):
+  """Open a families file for reading lines at indexed offsets, whether plain text or BGZF."""
+  infile = open(path, 'rb')
+  if bgzf.is_bgzf(infile):
+    return bgzf.BgzfReader(infile)
+  return infile
+
+
+def make_index(infile):
+  """Read a families file and yield an index entry for each block of lines with the same barcode and
+  order: (barcode, order, offset, lines). "infile" must be a plain file or a BgzfReader."""
+  compressed = isinstance(infile, bgzf.BgzfReader)
+  offset = infile.tell()
+  last_key = None
+  start = None
+  lines = 0
+  # Don't iterate with `for line in infile`, since the read-ahead buffer makes tell() useless.
+  while True:
+    line = infile.readline()
+    if not line:
+      break
+    fields = line.split('\t', 2)
+    key = (fields[0], fields[1])
+    if key != last_key:
+      if last_key is not None:
+        yield last_key[0], last_key[1], start, lines
+      last_key = key
+      start = offset
+      lines = 0
+    lines += 1
+    if compressed:
+      offset = infile.tell()
+    else:
+      offset += len(line)
+  if last_key is not None:
+    yield last_key[0], last_key[1], start, lines
+
+
+def write_index(entries, outfile):
+  """Write index entries in sorted order. A file grouped by barcode but not sorted (or with a
+  barcode split into several blocks) still gets a correct index this way."""
+  outfile.write(HEADER)
+  for entry in sorted(entries):
+    outfile.write('{}\t{}\t{}\t{}\n'.format(*entry))
+
+
+class FamilyIndex(object):
+  """The entries of a .fidx file, as parallel lists sorted by barcode and order."""
+
+  def __init__(self, entries=()):
+    self.barcodes = []
+    self.orders = []
+    self.offsets = []
+    self.lines = []
+    for barcode, order, offset, lines in sorted(entries):
+      self.barcodes.append(barcode)
+      self.orders.append(order)
+      self.offsets.append(offset)
+      self.lines.append(lines)
+
+  @classmethod
+  def load(cls, path):
+    entries = []
+    with open(path) as index_file:
+      for line in index_file:
+        if line.startswith('#'):
+          continue
+        barcode, order, offset, lines = line.rstrip('\r\n').split('\t')
+        entries.append((barcode, order, int(offset), int(lines)))
+    return cls(entries)
+
+  def __len__(self):
+    return len(self.barcodes)
+
+  def find(self, start, end=None, order=None):
+    """Return the list indices of the entries for barcodes from "start" up to (not including) "end",
+    or just the barcode "start" if "end" is None."""
+    first = bisect.bisect_left(self.barcodes, start)
+    if end is None:
+      last = bisect.bisect_right(self.barcodes, start)
+    else:
+      last = bisect.bisect_left(self.barcodes, end)
+    return [i for i in range(first, last) if order is None or self.orders[i] == order]
+
+  def family_counts(self):
+    """Return the number of read pairs on each strand of each family, as a dict mapping barcodes to
+    {'ab':count, 'ba':count, 'all':count} dicts, plus the total number of read pairs."""
+    counts = {}
+    total = 0
+    for barcode, order, lines in zip(self.barcodes, self.orders, self.lines):
+      family_counts = counts.setdefault(barcode, {'ab':0, 'ba':0, 'all':0})
+      family_counts[order] += lines
+      family_counts['all'] += lines
+      total += lines
+    return counts, total
+
+
+def _read_entries(infile, index, entries):
+  for i in entries:
+    infile.seek(index.offsets[i])
+    for j in range(index.lines[i]):
+      yield infile.readline()
+
+
+def read_family(infile, index, barcode, order=None):
+  """Yield the lines of the family with this barcode (or only its "order" strand), in file order.
+  "infile" should come from open_families()."""
+  return _read_entries(infile, index, index.find(barcode, order=order))
+
+
+def read_range(infile, index, start, end, order=None):
+  """Yield the lines of all families with barcodes from "start" up to (not including) "end"."""
+  return _read_entries(infile, index, index.find(start, end, order=order))
+
+
+def load_index_for(families_path):
+  """Return the FamilyIndex for this families file if its .fidx exists and is newer, else None."""
+  index_path = get_index_path(families_path)
+  try:
+    if os.path.getmtime(index_path) < os.path.getmtime(families_path):
+      return None
+  except OSError:
+    return None
+  return FamilyIndex.load(index_path)
+
+
+def fail(message):
+  sys.stderr.write(message+"\n")
+  sys.exit(1)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""Split a pair of FASTQ files into aligned ranges which can be read in parallel.
+
+Each range of the first file starts at a record boundary, and the same range of the second file
+starts at that read's mate, so reading both ranges in lockstep gives complete, correctly paired
+reads. Boundaries are found by seeking to evenly spaced points in the first file, finding the next
+record, then searching near the same relative point of the second file for a read with the same id
+(ignoring any "/1" and "/2" suffixes).
+
+Only files which can be read from an arbitrary point can be split: uncompressed files (where
+positions are byte offsets) and BGZF files (where they're virtual offsets). This also requires plain
+4-line FASTQ records, and mates with matching ids. If the files don't qualify, split_pairs() returns
+None, and they have to be read from start to end as usual.
+
+Run as a script, this prints the ranges it would use.
+"""
+from __future__ import division
+import os
+import sys
+import argparse
+import bgzf
+
+# Don't make ranges smaller than this (in bytes of the first file).
+MIN_RANGE_SIZE = 1024*1024
+# How much of a file to read when looking for a boundary, and the most to read when searching the
+# second file for the mate.
+WINDOW = 64*1024
+MAX_WINDOW = 16*1024*1024
+
+
+def make_argparser():
+  parser = argparse.ArgumentParser(description='Print the ranges a pair of FASTQ files would be '
+                                               'split into for parallel reading.')
+  parser.add_argument('fastq1', metavar='reads_1.fq')
+  parser.add_argument('fastq2', metavar='reads_2.fq')
+  parser.add_argument('-n', '--parts', type=int, default=4,
+    help='The number of ranges to split the files into. Default: %(default)s')
+  return parser
+
+
+def main(argv):
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+  ranges = split_pairs(args.fastq1, args.fastq2, args.parts)
+  if ranges is None:
+    sys.stderr.write('These files can\'t be split.\n')
+    return 1
+  for (start1, end1), (start2, end2) in ranges:
+    print '{}\t{}\t{}\t{}'.format(start1, end1, start2, end2)
+
+
+def split_pairs(path1, path2, parts):
+  """Split two paired FASTQ files into up to "parts" aligned ranges.
+  Returns a list of ((start1, end1), (start2, end2)) tuples, with positions in each file. An end of
+  None means the end of the file. Returns None if the files can't be split."""
+  files = [open_splittable(path) for path in (path1, path2)]
+  if None in files:
+    return None
+  parts = min(parts, files[0].size // MIN_RANGE_SIZE)
+  if parts < 2:
+    return None
+  starts = [(0, 0)]
+  for part in range(1, parts):
+    boundary = find_boundary(files[0], files[1], part/parts)
+    if boundary is None:
+      return None
+    if boundary[0] > starts[-1][0]:
+      starts.append(boundary)
+  ends = starts[1:] + [(files[0].end, files[1].end)]
+  return [((start1, end1), (start2, end2)) for (start1, start2), (end1, end2) in zip(starts, ends)]
+
+
+def open_range(path, start, end):
+  """Open a range of a file from split_pairs(). Returns a file object with a real file descriptor,
+  positioned at the start of the range, and the number of bytes in the range (or -1 if the file
+  object stops at the end of the range itself)."""
+  if bgzf.is_bgzf_path(path):
+    reader = bgzf.BgzfReader(open(path, 'rb'))
+    reader.seek(start)
+    return bgzf.get_fd_file(BgzfRange(reader, end)), -1
+  infile = open(path, 'rb')
+  os.lseek(infile.fileno(), start, os.SEEK_SET)
+  if end is None:
+    return infile, -1
+  return infile, end - start
+
+
+def find_boundary(file1, file2, fraction):
+  """Find the first record at or after "fraction" of the way through file1, and its mate in file2.
+  Returns their positions, or None if they can't be found."""
+  data, position, line_start, eof = file1.window(int(file1.size * fraction), WINDOW)
+  records = find_records(data, line_start, eof)
+  if not records or not records[0][1]:
+    return None
+  index1, read_id = records[0]
+  center = int(file2.size * fraction)
+  window = WINDOW
+  while window <= MAX_WINDOW:
+    data2, position2, line_start2, eof2 = file2.window(max(0, center - window//2), window)
+    records2 = find_records(data2, line_start2, eof2)
+    if records2 is None:
+      return None
+    for index2, read_id2 in records2:
+      if read_id2 == read_id:
+        return position(index1), position2(index2)
+    window *= 4
+  return None
+
+
+def find_records(data, line_start=False, eof=False):
+  """Find the 4-line FASTQ records in a window of a file.
+  "line_start" says whether the window starts at the start of a line, and "eof" whether it ends at
+  the end of the file. Returns a list of (index, id) tuples, one for each complete record, giving
+  the index of its start in "data" and its read id. Returns None if the data doesn't look like
+  4-line FASTQ (like multi-line records)."""
+  lines = []
+  start = 0 if line_start else data.find('\n') + 1
+  if start == 0 and not line_start:
+    return []
+  while start < len(data):
+    end = data.find('\n', start)
+    if end == -1:
+      if eof:
+        lines.append((start, len(data)))
+      break
+    lines.append((start, end))
+    start = end + 1
+  def line(i):
+    start, end = lines[i]
+    return data[start:end].rstrip('\r')
+  # Find the first name line. It has to be one of the first 4 lines.
+  first = None
+  for i in range(min(4, len(lines) - 3)):
+    if is_record(line, i, len(lines), eof):
+      first = i
+      break
+  if first is None:
+    if len(lines) >= 8:
+      return None
+    return []
+  records = []
+  for i in range(first, len(lines) - 3, 4):
+    if not is_record(line, i, len(lines), eof):
+      if i + 4 < len(lines):
+        return None
+      break
+    records.append((lines[i][0], get_id(line(i)[1:])))
+  return records
+
+
+def is_record(line, i, num_lines, eof):
+  if i + 4 > num_lines or not line(i).startswith('@') or not line(i+2).startswith('+'):
+    return False
+  if len(line(i+1)) != len(line(i+3)):
+    return False
+  if i + 4 < num_lines:
+    return line(i+4).startswith('@')
+  return eof
+
+
+def get_id(name):
+  """The read id in a name line (without the "@"): everything before the first whitespace, minus any
+  "/1" or "/2" mate suffix. This matches id_len() in families.c."""
+  fields = name.split(None, 1)
+  if not fields:
+    return ''
+  read_id = fields[0]
+  if read_id[-2:] in ('/1', '/2'):
+    read_id = read_id[:-2]
+  return read_id
+
+
+def open_splittable(path):
+  """Return a PlainFile or BgzfFile for the path, or None if it can't be split."""
+  if not os.path.isfile(path):
+    return None
+  if bgzf.is_bgzf_path(path):
+    return BgzfFile(path)
+  with open(path, 'rb') as infile:
+    if infile.read(2) == bgzf.GZIP_MAGIC:
+      return None
+  return PlainFile(path)
+
+
+class PlainFile(object):
+  """An uncompressed file, where positions are byte offsets."""
+
+  def __init__(self, path):
+    self.path = path
+    self.size = os.path.getsize(path)
+    self.end = self.size
+
+  def window(self, start, size):
+    """Read about "size" bytes starting at "start". Returns the data, a function converting an index
+    into the data into a position in the file, whether it starts at the start of a line, and whether
+    it reaches the end of the file."""
+    with open(self.path, 'rb') as infile:
+      infile.seek(start)
+      data = infile.read(size)
+    line_start = start == 0
+    if not line_start:
+      # Include the preceding character so a line starting right at "start" isn't missed.
+      with open(self.path, 'rb') as infile:
+        infile.seek(start-1)
+        line_start = infile.read(1) == '\n'
+    return data, lambda index: start + index, line_start, start + len(data) >= self.size
+
+
+class BgzfFile(object):
+  """A BGZF file, where positions are virtual offsets, and sizes are compressed sizes."""
+
+  def __init__(self, path):
+    self.path = path
+    self.size = os.path.getsize(path)
+    self.end = None
+
+  def window(self, start, size):
+    """Like PlainFile.window(), but "start" and "size" are in compressed bytes, and the window starts
+    at the first block at or after "start"."""
+    blocks = []
+    chunks = []
+    with open(self.path, 'rb') as infile:
+      block_start = self._find_block(infile, start)
+      infile.seek(block_start)
+      data_size = 0
+      eof = False
+      while infile.tell() - block_start < size:
+        data, block_size = bgzf.read_block(infile)
+        if data is None:
+          eof = True
+          break
+        blocks.append((data_size, infile.tell() - block_size))
+        chunks.append(data)
+        data_size += len(data)
+      if not eof:
+        rest = infile.read(len(bgzf.EOF_BLOCK)+1)
+        eof = rest == '' or rest == bgzf.EOF_BLOCK
+    def position(index):
+      for data_start, block_start in reversed(blocks):
+        if data_start <= index:
+          return bgzf.make_virtual_offset(block_start, index - data_start)
+    # A window starting at the first block starts at the start of a line.
+    return ''.join(chunks), position, block_start == 0, eof
+
+  def _find_block(self, infile, start):
+    """Find the first block that starts at or after "start". Blocks are at most 64KB, so there will
+    be a header in the next 64KB. A candidate is checked by making sure another block (or the end
+    of the file) follows it."""
+    infile.seek(start)
+    data = infile.read(2*65536)
+    position = data.find(bgzf.HEADER_MAGIC)
+    while position != -1:
+      header = data[position:position+bgzf.HEADER.size]
+      if len(header) == bgzf.HEADER.size and header[12:14] == 'BC':
+        next_start = start + position + bgzf.HEADER.unpack(header)[-1] + 1
+        infile.seek(next_start)
+        next_header = infile.read(16)
+        if not next_header or (next_header.startswith(bgzf.HEADER_MAGIC) and
+                               next_header[12:14] == 'BC'):
+          return start + position
+      position = data.find(bgzf.HEADER_MAGIC, position+1)
+    return self.size
+
+
+class BgzfRange(object):
+  """Read a BgzfReader from its current position up to a virtual offset (or the end, for None)."""
+
+  def __init__(self, reader, end):
+    self.reader = reader
+    self.end = end
+
+  def read(self, size=bgzf.MAX_BLOCK_DATA):
+    if self.end is None:
+      return self.reader.read(size)
+    return self.reader.read_until(self.end, size)
+
+  def close(self):
+    self.reader.close()
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -40,10 +40,7 @@ function main {
   fi
   script_dir=$(dirname "$script_path")
 
-  paste "$fastq1" "$fastq2" \
-    | paste - - - - \
-    | awk -f "$script_dir/make-barcodes.awk" -v TAG_LEN=$taglen -v INVARIANT=$invariant \
-    | sort
+  python2 "$script_dir/make_families.py" -t $taglen -i $invariant "$fastq1" "$fastq2"
 
 }
 
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+from __future__ import division
+import os
+import sys
+import zlib
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from lib import simplewrap
+from lib import version
+import families
+import extsort
+import famfile
+import bgzf
+import famcounts
+import fqsplit
+import bam
+
+OPT_DEFAULTS = dict(extsort.OPT_DEFAULTS, tag_len=12, invariant=5, shards=0,
+                    shard_prefix='families', processes=1, binary=False,
+                    compress_output=False, validate=False, max_n=None, min_tag_qual=None,
+                    invariant_seq=None, invariant_mismatches=1, max_repeat=None, filter_log='-',
+                    counts=None, interleaved=False, bam=False, trim=False, trim_mismatches=1,
+                    trim_min_overlap=10)
+DESCRIPTION = """Read raw duplex sequencing reads, extract their barcodes, and group them by barcode.
+This does the same thing as make-families.sh (paste | awk -f make-barcodes.awk | sort), but in one
+process. The output is identical. Sorting is done in bounded memory: once the --mem budget is
+reached, sorted runs are compressed and spilled to temporary files, then merged.
+With --shards, the families are instead split into independent files by a hash of the barcode. Each
+one is grouped by barcode (but they are not sorted relative to each other), so downstream jobs can
+start on each shard as soon as it's written.
+With --processes, uncompressed or BGZF input is split into ranges which are read by separate
+processes (see fqsplit.py). Each one sorts its pairs into runs, and they're all merged into the
+output at the end.
+The input can also be a single file with both mates of each pair: interleaved FASTQ (with
+--interleaved) or unaligned BAM (detected automatically, or give --bam). BAM is decoded directly,
+without needing samtools.
+Read pairs with bad barcodes can be filtered out here with the --max-n, --min-tag-qual,
+--invariant-seq, and --max-repeat options, so they don't make it into any family. Counts of the
+pairs removed by each filter are printed to stderr (or the --filter-log file).
+With --trim, reads from inserts shorter than the read length are trimmed where they run through into
+the mate's barcode (and the adapter after it), so that sequence doesn't make it into the alignments."""
+
+
+def main(argv):
+
+  wrapper = simplewrap.Wrapper()
+  wrap = wrapper.wrap
+
+  parser = argparse.ArgumentParser(description=wrap(DESCRIPTION),
+                                   formatter_class=argparse.RawTextHelpFormatter)
+  parser.set_defaults(**OPT_DEFAULTS)
+
+  wrapper.width = wrapper.width - 24
+  parser.add_argument('fastq1', metavar='reads_1.fq',
+    help=wrap('The first mates in the read pairs. Can be gzipped (BGZF or regular gzip). Records '
+              'can span multiple lines. Or, with no reads_2.fq, a file with both mates of each '
+              'pair (see --interleaved and --bam).'))
+  parser.add_argument('fastq2', metavar='reads_2.fq', nargs='?',
+    help=wrap('The second mates in the read pairs.'))
+  parser.add_argument('-n', '--interleaved', action='store_true',
+    help=wrap('The input is one interleaved FASTQ file, where each read is followed by its mate.'))
+  parser.add_argument('-B', '--bam', action='store_true',
+    help=wrap('The input is one unaligned BAM file, with the mates of each pair in consecutive '
+              'records, flagged as the first and second reads. BAM files are detected '
+              'automatically, so this is only needed for input that can\'t be checked beforehand, '
+              'like a pipe. Secondary and supplementary records are skipped.'))
+  parser.add_argument('-t', '--tag-len', type=int,
+    help=wrap('The length of the barcode portion of each read. Default: %(default)s.'))
+  parser.add_argument('-i', '--invariant', type=int,
+    help=wrap('The length of the invariant (ligation) portion of each read. '
+              'Default: %(default)s.'))
+  parser.add_argument('-V', '--validate', action='store_true',
+    help=wrap('Check that the two reads in each pair have the same name (ignoring any "/1" and "/2" '
+              'suffixes), and fail if they don\'t.'))
+  parser.add_argument('-N', '--max-n', type=int,
+    help=wrap('Remove pairs with more than this many N\'s in the barcode (both tags). Default: no '
+              'limit.'))
+  parser.add_argument('-Q', '--min-tag-qual', type=int,
+    help=wrap('Remove pairs with any tag base with a lower quality score than this (PHRED score, '
+              'Sanger format). Default: no minimum.'))
+  parser.add_argument('-I', '--invariant-seq',
+    help=wrap('The expected sequence of the invariant region. Remove pairs where it doesn\'t match '
+              'in either read. It must be --invariant bases long. Default: don\'t check.'))
+  parser.add_argument('-M', '--invariant-mismatches', type=int,
+    help=wrap('The number of mismatches to --invariant-seq allowed in each read. Default: '
+              '%(default)s.'))
+  parser.add_argument('-r', '--max-repeat', type=int,
+    help=wrap('Remove pairs where either tag has a single-base repeat longer than this (like '
+              'utils/filter_barcodes.py --repeats). Default: no limit.'))
+  parser.add_argument('-R', '--trim', action='store_true',
+    help=wrap('Trim read-through: where a read continues past the end of the insert into the '
+              'reverse complement of its mate\'s invariant and tag. The read and its quality scores '
+              'are cut at the start of it.'))
+  parser.add_argument('--trim-mismatches', type=int,
+    help=wrap('The number of mismatches allowed when matching the mate\'s tag and invariant for '
+              '--trim. Default: %(default)s'))
+  parser.add_argument('--trim-min-overlap', type=int,
+    help=wrap('Also trim reads that end with at least this many bases of the start of the '
+              'read-through, for --trim. Default: %(default)s'))
+  parser.add_argument('-l', '--filter-log',
+    help=wrap('Print counts of the pairs removed by each filter to this file, if any filters are '
+              'used (or --trim, which adds a count of trimmed reads). Use "-" for stderr. Default: '
+              '%(default)s'))
+  parser.add_argument('-c', '--counts', metavar='COUNTS_FILE',
+    help=wrap('Also write a table of the number of read pairs in each family to this file (see '
+              'famcounts.py). Later stages can read family sizes from it instead of from the '
+              'reads. With --shards, it has the barcodes of each shard in turn, so it\'s only '
+              'sorted within each shard.'))
+  parser.add_argument('-s', '--shards', type=int,
+    help=wrap('Split the output into this many shard files, by a hash of the barcode, instead of '
+              'printing one sorted file to stdout.'))
+  parser.add_argument('-o', '--shard-prefix',
+    help=wrap('Name the shard files like {prefix}.{number}.tsv. Each one is written to a '
+              'temporary name and renamed when complete. Default: %(default)s'))
+  parser.add_argument('-b', '--binary', action='store_true',
+    help=wrap('Write the output in the compact binary families format (see famfile.py) instead of '
+              'text. Binary shards are named {prefix}.{number}.fam.'))
+  parser.add_argument('-z', '--compress-output', action='store_true',
+    help=wrap('Compress the output with BGZF (gzip-compatible). Shards are named '
+              '{prefix}.{number}.tsv.gz.'))
+  parser.add_argument('-p', '--processes', type=int,
+    help=wrap('Number of processes to use to read the input and to group the shards. The input can '
+              'only be read in parallel if it\'s two FASTQ files, uncompressed or BGZF, 4 lines per '
+              'read, and the two reads in each pair have the same name (apart from any "/1" and "/2" '
+              'suffixes). Otherwise, it\'s read by one process. Default: %(default)s'))
+  extsort.add_sort_args(parser, wrap=wrap)
+  parser.add_argument('-v', '--version', action='version', version=str(version.get_version()),
+    help=wrap('Print the version number and exit.'))
+
+  args = parser.parse_args(argv[1:])
+
+  if args.shards < 0 or args.processes < 1:
+    fail('Error: --shards must be positive and --processes must be at least 1.')
+  if args.binary and args.compress_output:
+    fail('Error: The --binary format is already compressed. Don\'t give --compress-output too.')
+
+  try:
+    sorter_kwargs = extsort.sorter_kwargs(args)
+    sorter = extsort.ExternalSorter(**sorter_kwargs)
+    min_qual = None if args.min_tag_qual is None else chr(args.min_tag_qual + 33)
+    filter_kwargs = dict(tag_len=args.tag_len, invariant=args.invariant, max_n=args.max_n,
+                         min_qual=min_qual, invariant_seq=args.invariant_seq,
+                         max_mismatches=args.invariant_mismatches, max_repeat=args.max_repeat,
+                         trim=args.trim, trim_mismatches=args.trim_mismatches,
+                         trim_min_overlap=args.trim_min_overlap)
+    filters = families.Filters(**filter_kwargs)
+  except ValueError as error:
+    fail('Error: '+str(error))
+  filtering = any(value is not None for value in (args.max_n, args.min_tag_qual,
+                                                    args.invariant_seq, args.max_repeat))
+
+  input_format = get_input_format(args.fastq1, args.fastq2, args.interleaved, args.bam)
+
+  ranges = None
+  if args.processes > 1 and args.fastq2 is not None:
+    ranges = fqsplit.split_pairs(args.fastq1, args.fastq2, args.processes)
+
+  temp_dir = None
+  try:
+    if ranges:
+      temp_dir = tempfile.mkdtemp(prefix='ranges.', dir=sorter_kwargs['temp_dir'])
+      try:
+        outputs, filter_counts = read_ranges(ranges, args.fastq1, args.fastq2, filter_kwargs,
+                                             args.validate, temp_dir, sorter_kwargs, args.shards)
+      except families.FormatError as error:
+        fail('Error: '+str(error))
+      if args.shards:
+        sort_shards(outputs, temp_dir, args.shard_prefix, sorter_kwargs, args.processes,
+                    args.binary, args.compress_output, args.counts)
+      else:
+        sorter.add_runs(outputs)
+    else:
+      fastq1 = bgzf.get_fd_file(bgzf.open_input(args.fastq1))
+      fastq2 = None
+      if args.fastq2 is not None:
+        fastq2 = bgzf.get_fd_file(bgzf.open_input(args.fastq2))
+      try:
+        chunks = families.read_family_chunks(fastq1, fastq2, validate_names=args.validate,
+                                             filters=filters, input_format=input_format)
+        if args.shards:
+          make_shards(chunks, args.shards, args.shard_prefix, sorter_kwargs, args.processes,
+                      args.binary, args.compress_output, args.counts)
+        else:
+          for chunk in chunks:
+            sorter.add_chunk(chunk)
+      except families.FormatError as error:
+        # If an input failed to decompress, closing it reports that, which explains the bad format.
+        close_inputs(fastq1, fastq2)
+        fail('Error: '+str(error))
+      close_inputs(fastq1, fastq2)
+      filter_counts = filters.get_counts()
+    if filtering or args.trim:
+      write_filter_log(filter_counts, args.filter_log)
+    if args.shards:
+      return
+    # Whole-line sorting puts the lines in the same order `sort` would: by barcode, then by the
+    # rest of the line (order, then read names, etc).
+    outfile = bgzf.open_output(compress=args.compress_output)
+    if args.counts:
+      with open(args.counts, 'w') as counts_file:
+        counter = famcounts.FamilyCounter(counts_file)
+        write_families(counter.add_lines(sorter), outfile, args.binary)
+        counter.close()
+    else:
+      write_families(sorter, outfile, args.binary)
+    bgzf.close_output(outfile)
+  finally:
+    sorter.cleanup()
+    if temp_dir is not None:
+      shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def get_input_format(fastq1_path, fastq2_path, interleaved=False, force_bam=False):
+  """Check the combination of input files and options, and return the format of a single input file
+  ('fastq' for interleaved FASTQ or 'bam'), or None for a pair of FASTQ files."""
+  if fastq2_path is not None:
+    if interleaved or force_bam:
+      fail('Error: --interleaved and --bam take a single input file.')
+    return None
+  if interleaved and force_bam:
+    fail('Error: --interleaved and --bam are mutually exclusive.')
+  if force_bam or (not interleaved and bam.is_bam_path(fastq1_path)):
+    return 'bam'
+  if interleaved:
+    return 'fastq'
+  fail('Error: Give two FASTQ files, or one with --interleaved, or a BAM file.')
+
+
+def write_filter_log(counts, log_path):
+  if log_path == '-':
+    log_file = sys.stderr
+  else:
+    log_file = open(log_path, 'w')
+  log_file.write("""Read pairs:\t{pairs}
+Passed filters:\t{passed}
+Removed for:
+\tEmpty reads:\t{empty}
+\tN's in barcode:\t{failed_n}
+\tLow quality tag bases:\t{failed_qual}
+\tInvariant mismatches:\t{failed_invariant}
+\tBarcode repeats:\t{failed_repeat}
+Reads trimmed for read-through:\t{trimmed}
+""".format(**counts))
+  if log_file is not sys.stderr:
+    log_file.close()
+
+
+def get_shard(barcode, shards):
+  """Return the shard number for this barcode. This is stable between runs and machines."""
+  return (zlib.crc32(barcode) & 0xffffffff) % shards
+
+
+def write_families(lines, outfile, binary=False):
+  """Write sorted families.tsv lines to outfile, as text or in the binary format."""
+  if binary:
+    writer = famfile.BinaryWriter(outfile, kind='families')
+    for line in lines:
+      writer.write_row(line.rstrip('\r\n').split('\t'))
+    writer.close()
+  else:
+    outfile.writelines(lines)
+
+
+def read_ranges(ranges, fastq1_path, fastq2_path, filter_kwargs, validate, temp_dir, sorter_kwargs,
+                shards=0):
+  """Read each pair of ranges from fqsplit.split_pairs() in a separate process.
+  Without shards, each process sorts its lines into runs in temp_dir, and this returns a list of
+  all the run files. With shards, each process distributes its lines into its own unsorted file for
+  each shard, and this returns a list of the files for each shard. Also returns the combined counts
+  of the filters."""
+  # Split the memory budget between the processes sorting at once.
+  sorter_kwargs = dict(sorter_kwargs, mem=sorter_kwargs['mem']//len(ranges), temp_dir=temp_dir)
+  jobs = []
+  for i, (range1, range2) in enumerate(ranges):
+    jobs.append((i, fastq1_path, range1, fastq2_path, range2, filter_kwargs, validate, temp_dir,
+                 sorter_kwargs, shards))
+  pool = multiprocessing.Pool(len(ranges))
+  try:
+    results = pool.map(read_range, jobs, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+  filter_counts = {}
+  for outputs, counts in results:
+    for name, count in counts.items():
+      filter_counts[name] = filter_counts.get(name, 0) + count
+  if shards:
+    return [[outputs[shard] for outputs, counts in results] for shard in range(shards)], filter_counts
+  else:
+    return [path for outputs, counts in results for path in outputs], filter_counts
+
+
+def read_range(job):
+  """Read one pair of ranges of the input files and either sort the lines into runs, or distribute
+  them into unsorted shard files."""
+  (i, fastq1_path, range1, fastq2_path, range2, filter_kwargs, validate, temp_dir, sorter_kwargs,
+   shards) = job
+  filters = families.Filters(**filter_kwargs)
+  fastq1, limit1 = fqsplit.open_range(fastq1_path, *range1)
+  fastq2, limit2 = fqsplit.open_range(fastq2_path, *range2)
+  try:
+    chunks = families.read_family_chunks(fastq1, fastq2, validate_names=validate, filters=filters,
+                                         limits=(limit1, limit2))
+    if shards:
+      outputs = [os.path.join(temp_dir, 'raw.{}.{}.tsv'.format(shard, i)) for shard in range(shards)]
+      distribute_lines(chunks, outputs)
+    else:
+      sorter = extsort.ExternalSorter(**sorter_kwargs)
+      try:
+        for chunk in chunks:
+          sorter.add_chunk(chunk)
+        outputs = sorter.dump_runs()
+      finally:
+        sorter.cleanup()
+  finally:
+    fastq1.close()
+    fastq2.close()
+  return outputs, filters.get_counts()
+
+
+def distribute_lines(chunks, raw_paths):
+  """Write the families.tsv lines into one unsorted file per shard."""
+  raw_files = [open(raw_path, 'w') for raw_path in raw_paths]
+  buffers = [[] for raw_path in raw_paths]
+  for chunk in chunks:
+    for line in chunk.splitlines(True):
+      buffers[get_shard(line[:line.index('\t')], len(raw_paths))].append(line)
+    for raw_file, buffer in zip(raw_files, buffers):
+      raw_file.writelines(buffer)
+      del buffer[:]
+  for raw_file in raw_files:
+    raw_file.close()
+
+
+def make_shards(chunks, shards, prefix, sorter_kwargs, processes=1, binary=False, compress=False,
+                counts_path=None):
+  """Split the families.tsv lines into "shards" files by barcode, and group each by barcode.
+  First, the lines are distributed into unsorted temporary files, then each of those is sorted
+  into its final shard file (in parallel if processes > 1). If counts_path is given, the family
+  size tables of the shards are combined into that file."""
+  temp_dir = tempfile.mkdtemp(prefix='shards.', dir=sorter_kwargs['temp_dir'])
+  try:
+    raw_paths = [os.path.join(temp_dir, 'raw.{}.tsv'.format(i)) for i in range(shards)]
+    distribute_lines(chunks, raw_paths)
+    sort_shards([[raw_path] for raw_path in raw_paths], temp_dir, prefix, sorter_kwargs, processes,
+                binary, compress, counts_path)
+  finally:
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def sort_shards(raw_path_lists, temp_dir, prefix, sorter_kwargs, processes=1, binary=False,
+                compress=False, counts_path=None):
+  """Sort the unsorted files of each shard into its final shard file. raw_path_lists has a list of
+  files for each shard."""
+  # Split the memory budget between the processes sorting shards at once.
+  sorter_kwargs = dict(sorter_kwargs, mem=sorter_kwargs['mem']//processes)
+  jobs = []
+  for i, raw_paths in enumerate(raw_path_lists):
+    if binary:
+      shard_path = '{}.{}.fam'.format(prefix, i)
+    elif compress:
+      shard_path = '{}.{}.tsv.gz'.format(prefix, i)
+    else:
+      shard_path = '{}.{}.tsv'.format(prefix, i)
+    shard_counts_path = None
+    if counts_path:
+      shard_counts_path = os.path.join(temp_dir, 'counts.{}.tsv'.format(i))
+    jobs.append((raw_paths, shard_path, sorter_kwargs, binary, compress, shard_counts_path))
+  if processes > 1:
+    pool = multiprocessing.Pool(processes)
+    try:
+      pool.map(sort_shard, jobs, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    for job in jobs:
+      sort_shard(job)
+  if counts_path:
+    with open(counts_path, 'w') as counts_file:
+      counts_file.write(famcounts.HEADER)
+      for job in jobs:
+        with open(job[-1]) as shard_counts_file:
+          for line in shard_counts_file:
+            if not line.startswith('#'):
+              counts_file.write(line)
+
+
+def sort_shard(job):
+  """Group the lines of the unsorted files of a shard into its final file."""
+  raw_paths, shard_path, sorter_kwargs, binary, compress, counts_path = job
+  sorter = extsort.ExternalSorter(**sorter_kwargs)
+  try:
+    for raw_path in raw_paths:
+      with open(raw_path) as raw_file:
+        sorter.add_lines(raw_file)
+      os.remove(raw_path)
+    temp_path = shard_path+'.tmp'
+    shard_file = bgzf.open_output(temp_path, compress=compress)
+    if counts_path:
+      with open(counts_path, 'w') as counts_file:
+        counter = famcounts.FamilyCounter(counts_file)
+        write_families(counter.add_lines(sorter), shard_file, binary)
+        counter.close()
+    else:
+      write_families(sorter, shard_file, binary)
+    bgzf.close_output(shard_file)
+    os.rename(temp_path, shard_path)
+  finally:
+    sorter.cleanup()
+
+
+def close_inputs(*infiles):
+  """Close the input files. An error that only shows up on closing one, like the decompression
+  command failing (see bgzf.ProcessReader), ends the run with fail() instead of a traceback."""
+  try:
+    for infile in infiles:
+      if infile is not None:
+        infile.close()
+  except IOError as error:
+    fail(str(error))
+  except bgzf.FormatError as error:
+    fail('Error: '+str(error))
+
+
+def fail(message):
+  sys.stderr.write(message+"\n")
+  sys.exit(1)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
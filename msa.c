@@ -0,0 +1,280 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <ctype.h>
+
+// A built-in multiple sequence aligner for the reads in a family, as an alternative to running
+// MAFFT on each one. The reads in a family are copies of the same molecule, so they're nearly
+// identical and already start at the same position. That makes a simple progressive alignment
+// enough: each read is aligned to the profile of the reads added so far (the base counts of each
+// column) with a global dynamic programming alignment, and any insertions it has become new columns.
+// Scoring is sum-of-pairs with linear gap penalties. Gaps at the end of a read are free, since reads
+// in a family can be trimmed to different lengths.
+
+#define MATCH 2.0
+#define MISMATCH -1.0
+#define GAP -3.0
+#define NUM_CODES 5  // A, C, G, T, and anything else (N).
+
+// Error codes.
+#define ERR_TOO_BIG -1
+
+// Traceback moves.
+#define MOVE_MATCH 1   // Read base in an existing column.
+#define MOVE_DELETE 2  // Gap in the read, across an existing column.
+#define MOVE_INSERT 3  // Read base in a new column.
+
+typedef struct {
+  int n_rows;      // The number of reads in the profile.
+  int n_cols;
+  int capacity;
+  int (*counts)[NUM_CODES];  // The number of each base in each column. The rest of the rows are gaps.
+} profile_t;
+
+int align_msa(char *seqs[], int n_seqs, char *out, int out_size);
+
+
+static int base_code(char base) {
+  switch (toupper(base)) {
+    case 'A': return 0;
+    case 'C': return 1;
+    case 'G': return 2;
+    case 'T': return 3;
+    default: return 4;
+  }
+}
+
+
+static void ensure_capacity(profile_t *profile, int n_cols) {
+  if (n_cols > profile->capacity) {
+    profile->capacity = n_cols * 2;
+    profile->counts = realloc(profile->counts, sizeof(*profile->counts) * profile->capacity);
+  }
+}
+
+
+static int non_gaps(profile_t *profile, int col) {
+  int total = 0;
+  int code;
+  for (code = 0; code < NUM_CODES; code++) {
+    total += profile->counts[col][code];
+  }
+  return total;
+}
+
+
+// The average score of aligning a base with code "code" to every row of a column.
+static double column_score(profile_t *profile, int col, int code) {
+  int *counts = profile->counts[col];
+  int residues = non_gaps(profile, col);
+  double score = GAP * (profile->n_rows - residues);
+  if (code < 4) {
+    score += MATCH * counts[code] + MISMATCH * (residues - counts[code] - counts[4]);
+  }
+  return score / profile->n_rows;
+}
+
+
+// The average score of a gap in the read across a column.
+static double deletion_score(profile_t *profile, int col) {
+  return GAP * non_gaps(profile, col) / profile->n_rows;
+}
+
+
+// Align a read to the profile. Writes the moves to "moves" (in order, from the start) and returns
+// how many there are.
+static int align_to_profile(profile_t *profile, char *seq, int seq_len, char *moves) {
+  int n_cols = profile->n_cols;
+  int width = n_cols + 1;
+  double *scores = malloc(sizeof(double) * (seq_len + 1) * width);
+  char *trace = malloc(sizeof(char) * (seq_len + 1) * width);
+  // Score each column against each base once, up front.
+  double *deletions = malloc(sizeof(double) * (n_cols + 1));
+  double (*col_scores)[NUM_CODES] = malloc(sizeof(*col_scores) * (n_cols + 1));
+  int i, j, code;
+  for (j = 0; j < n_cols; j++) {
+    deletions[j] = deletion_score(profile, j);
+    for (code = 0; code < NUM_CODES; code++) {
+      col_scores[j][code] = column_score(profile, j, code);
+    }
+  }
+  scores[0] = 0;
+  trace[0] = 0;
+  for (j = 1; j <= n_cols; j++) {
+    scores[j] = scores[j-1] + deletions[j-1];
+    trace[j] = MOVE_DELETE;
+  }
+  for (i = 1; i <= seq_len; i++) {
+    code = base_code(seq[i-1]);
+    double *row = scores + i * width;
+    double *prev_row = scores + (i-1) * width;
+    char *trace_row = trace + i * width;
+    row[0] = prev_row[0] + GAP;
+    trace_row[0] = MOVE_INSERT;
+    for (j = 1; j <= n_cols; j++) {
+      // Ties go to the match, then the deletion, which puts gaps as far left as possible.
+      double best = prev_row[j-1] + col_scores[j-1][code];
+      char move = MOVE_MATCH;
+      double score = row[j-1] + deletions[j-1];
+      if (score > best) {
+        best = score;
+        move = MOVE_DELETE;
+      }
+      score = prev_row[j] + GAP;
+      if (score > best) {
+        best = score;
+        move = MOVE_INSERT;
+      }
+      row[j] = best;
+      trace_row[j] = move;
+    }
+  }
+  // The read can end anywhere: deletions after its last base are free.
+  double *last_row = scores + seq_len * width;
+  int end = n_cols;
+  for (j = n_cols - 1; j >= 0; j--) {
+    if (last_row[j] > last_row[end]) {
+      end = j;
+    }
+  }
+  // Trace back, writing the moves from the end of "moves" backward.
+  int n_moves = seq_len + n_cols;
+  int pos = n_moves;
+  for (j = n_cols; j > end; j--) {
+    moves[--pos] = MOVE_DELETE;
+  }
+  i = seq_len;
+  j = end;
+  while (i > 0 || j > 0) {
+    char move = trace[i * width + j];
+    moves[--pos] = move;
+    if (move == MOVE_MATCH) {
+      i--;
+      j--;
+    } else if (move == MOVE_DELETE) {
+      j--;
+    } else {
+      i--;
+    }
+  }
+  free(scores);
+  free(trace);
+  free(deletions);
+  free(col_scores);
+  int count = n_moves - pos;
+  memmove(moves, moves + pos, count);
+  return count;
+}
+
+
+// Add a read to the profile, given its alignment to it. Existing columns can get new column numbers
+// since insertions are added between them. Fills in "col_map" with the new number of each existing
+// column, and "positions" with the column of each base in the read. Returns the new number of
+// columns.
+static int add_to_profile(profile_t *profile, char *seq, char *moves, int n_moves, int *col_map,
+                          int *positions) {
+  // Every move is a column: an existing one for matches and deletions, or a new one for insertions.
+  int old_cols = profile->n_cols;
+  int new_cols = n_moves;
+  int m;
+  ensure_capacity(profile, new_cols);
+  // Fill in the new columns from the end backward, so the old ones can be moved in place.
+  int col = new_cols;
+  int old_col = old_cols;
+  int base = 0;
+  for (m = 0; m < n_moves; m++) {
+    if (moves[m] != MOVE_DELETE) {
+      base++;
+    }
+  }
+  for (m = n_moves - 1; m >= 0; m--) {
+    col--;
+    if (moves[m] == MOVE_INSERT) {
+      memset(profile->counts[col], 0, sizeof(*profile->counts));
+    } else {
+      old_col--;
+      col_map[old_col] = col;
+      memmove(profile->counts[col], profile->counts[old_col], sizeof(*profile->counts));
+    }
+    if (moves[m] != MOVE_DELETE) {
+      base--;
+      positions[base] = col;
+      profile->counts[col][base_code(seq[base])]++;
+    }
+  }
+  profile->n_cols = new_cols;
+  profile->n_rows++;
+  return new_cols;
+}
+
+
+// Align the sequences in "seqs" and write the aligned rows to "out", back to back, in the same order,
+// with "-" for gaps. Bases are uppercased. The rows are all the same length, and aren't
+// null-terminated.
+// Returns the length of the alignment, or ERR_TOO_BIG if the rows won't fit in "out_size" characters.
+int align_msa(char *seqs[], int n_seqs, char *out, int out_size) {
+  if (n_seqs <= 0) {
+    return 0;
+  }
+  int *lens = malloc(sizeof(int) * n_seqs);
+  int *order = malloc(sizeof(int) * n_seqs);
+  int **positions = malloc(sizeof(int *) * n_seqs);
+  int total_len = 0;
+  int max_len = 0;
+  int i, j, k;
+  for (i = 0; i < n_seqs; i++) {
+    lens[i] = strlen(seqs[i]);
+    total_len += lens[i];
+    if (lens[i] > max_len) {
+      max_len = lens[i];
+    }
+    positions[i] = malloc(sizeof(int) * (lens[i] + 1));
+    order[i] = i;
+  }
+  // Add the reads from longest to shortest (keeping the input order for equal lengths), so the
+  // profile starts out covering as much of the alignment as possible.
+  for (i = 1; i < n_seqs; i++) {
+    int seq_i = order[i];
+    for (j = i; j > 0 && lens[order[j-1]] < lens[seq_i]; j--) {
+      order[j] = order[j-1];
+    }
+    order[j] = seq_i;
+  }
+  profile_t profile = {0, 0, 0, NULL};
+  char *moves = malloc(sizeof(char) * (total_len + max_len + 1));
+  int *col_map = malloc(sizeof(int) * (total_len + 1));
+  for (k = 0; k < n_seqs; k++) {
+    int seq_i = order[k];
+    int n_moves = align_to_profile(&profile, seqs[seq_i], lens[seq_i], moves);
+    add_to_profile(&profile, seqs[seq_i], moves, n_moves, col_map, positions[seq_i]);
+    // Renumber the columns of the reads already added.
+    for (i = 0; i < k; i++) {
+      int added_i = order[i];
+      for (j = 0; j < lens[added_i]; j++) {
+        positions[added_i][j] = col_map[positions[added_i][j]];
+      }
+    }
+  }
+  int aln_len = profile.n_cols;
+  if ((long long) aln_len * n_seqs <= out_size) {
+    for (i = 0; i < n_seqs; i++) {
+      char *row = out + i * aln_len;
+      memset(row, '-', aln_len);
+      for (j = 0; j < lens[i]; j++) {
+        row[positions[i][j]] = toupper(seqs[i][j]);
+      }
+    }
+  } else {
+    aln_len = ERR_TOO_BIG;
+  }
+  for (i = 0; i < n_seqs; i++) {
+    free(positions[i]);
+  }
+  free(positions);
+  free(lens);
+  free(order);
+  free(moves);
+  free(col_map);
+  free(profile.counts);
+  return aln_len;
+}
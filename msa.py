@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""A built-in multiple sequence aligner for the reads of a family (see msa.c). It aligns in-process,
+without writing temporary files or starting a MAFFT process for each family."""
+import os
+import sys
+import errno
+import ctypes
+import argparse
+
+# Locate the library file.
+LIBFILE = 'libmsa.so'
+script_dir = os.path.dirname(os.path.realpath(__file__))
+library_path = os.path.join(script_dir, LIBFILE)
+if not os.path.isfile(library_path):
+  library_path = os.path.join(script_dir, '..', 'lib', LIBFILE)
+  if not os.path.isfile(library_path):
+    ioe = IOError('Library file "'+LIBFILE+'" not found.')
+    ioe.errno = errno.ENOENT
+    raise ioe
+
+msa = ctypes.cdll.LoadLibrary(library_path)
+msa.align_msa.argtypes = [ctypes.POINTER(ctypes.c_char_p), ctypes.c_int, ctypes.c_char_p,
+                          ctypes.c_int]
+
+# Error codes from msa.c.
+ERR_TOO_BIG = -1
+
+
+def make_argparser():
+  parser = argparse.ArgumentParser(description='Align a set of sequences with the built-in aligner.')
+  parser.add_argument('fasta', type=argparse.FileType('r'), nargs='?', default=sys.stdin,
+    help='The sequences, in FASTA format (but no multi-line sequences). Omit to read from stdin.')
+  return parser
+
+
+def main(argv):
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+  names = []
+  seqs = []
+  for line in args.fasta:
+    if line.startswith('>'):
+      names.append(line.rstrip('\r\n')[1:])
+    else:
+      seqs.append(line.rstrip('\r\n'))
+  for name, aligned in zip(names, align(seqs)):
+    print '>'+name
+    print aligned
+
+
+def align(seqs):
+  """Align a list of sequences. Returns a list of the aligned sequences, in the same order, in upper
+  case, with "-" for gaps."""
+  n_seqs = len(seqs)
+  if n_seqs == 0:
+    return []
+  seqs_c = (ctypes.c_char_p * n_seqs)()
+  for i, seq in enumerate(seqs):
+    seqs_c[i] = ctypes.c_char_p(seq)
+  # Start with room for every row to be twice as long as the longest sequence.
+  buf = ctypes.create_string_buffer(n_seqs * max(1, 2*max(len(seq) for seq in seqs)))
+  while True:
+    aln_len = msa.align_msa(seqs_c, n_seqs, buf, len(buf))
+    if aln_len != ERR_TOO_BIG:
+      break
+    buf = ctypes.create_string_buffer(len(buf)*2)
+  data = buf.raw[:n_seqs*aln_len]
+  return [data[i*aln_len:(i+1)*aln_len] for i in range(n_seqs)]
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,506 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <ctype.h>
+#include <limits.h>
+
+// Partial-order alignment (POA) of the reads in a family. The reads are added one at a time to a
+// directed acyclic graph of bases: each read is aligned to the graph with dynamic programming, then
+// threaded through it, reusing the nodes it matches and adding nodes for its mismatches and
+// insertions. Nodes for different bases at the same position are linked as "aligned" to each other,
+// so they end up in the same column. From the finished graph, this gives both a row-wise multiple
+// sequence alignment (like MAFFT's) and a consensus sequence, from the heaviest path through it.
+
+#define MATCH 2
+#define MISMATCH -1
+#define GAP -3
+
+// Error codes.
+#define ERR_TOO_BIG -1
+#define ERR_CYCLE -2
+
+// Traceback moves.
+#define MOVE_MATCH 1   // Read base aligned to the node.
+#define MOVE_DELETE 2  // Node skipped by the read.
+#define MOVE_INSERT 3  // Read base not aligned to any node.
+
+typedef struct {
+  int *items;
+  int len;
+  int capacity;
+} int_list_t;
+
+typedef struct {
+  char base;
+  int reads;             // The number of reads through this node.
+  int good;              // How many of them have a quality score at or above the threshold here.
+  int_list_t preds;      // Predecessor nodes.
+  int_list_t weights;    // The number of reads along the edge from each predecessor.
+  int_list_t succs;      // Successor nodes.
+  int_list_t aligned;    // Other nodes in the same column.
+} node_t;
+
+typedef struct {
+  node_t *nodes;
+  int n_nodes;
+  int capacity;
+  int *order;  // The nodes in topological order.
+  int *ranks;  // The position of each node in "order".
+} graph_t;
+
+int poa(char *seqs[], char *quals[], int n_seqs, char qual_thres, char *out, int out_size,
+        char *cons, int cons_size);
+
+
+static void list_append(int_list_t *list, int item) {
+  if (list->len >= list->capacity) {
+    list->capacity = list->capacity ? list->capacity * 2 : 4;
+    list->items = realloc(list->items, sizeof(int) * list->capacity);
+  }
+  list->items[list->len++] = item;
+}
+
+
+static int add_node(graph_t *graph, char base) {
+  if (graph->n_nodes >= graph->capacity) {
+    graph->capacity = graph->capacity ? graph->capacity * 2 : 64;
+    graph->nodes = realloc(graph->nodes, sizeof(node_t) * graph->capacity);
+  }
+  node_t *node = &graph->nodes[graph->n_nodes];
+  memset(node, 0, sizeof(node_t));
+  node->base = base;
+  return graph->n_nodes++;
+}
+
+
+static void add_edge(graph_t *graph, int from, int to) {
+  node_t *node = &graph->nodes[to];
+  int i;
+  for (i = 0; i < node->preds.len; i++) {
+    if (node->preds.items[i] == from) {
+      node->weights.items[i]++;
+      return;
+    }
+  }
+  list_append(&node->preds, from);
+  list_append(&node->weights, 1);
+  list_append(&graph->nodes[from].succs, to);
+}
+
+
+// Make a new node for "base" aligned to "node" and everything already aligned to it.
+static int add_aligned_node(graph_t *graph, int node_id, char base) {
+  int new_id = add_node(graph, base);
+  node_t *node = &graph->nodes[node_id];
+  node_t *new_node = &graph->nodes[new_id];
+  int i;
+  for (i = 0; i < node->aligned.len; i++) {
+    int other_id = node->aligned.items[i];
+    list_append(&graph->nodes[other_id].aligned, new_id);
+    list_append(&new_node->aligned, other_id);
+  }
+  list_append(&node->aligned, new_id);
+  list_append(&new_node->aligned, node_id);
+  return new_id;
+}
+
+
+static void free_graph(graph_t *graph) {
+  int i;
+  for (i = 0; i < graph->n_nodes; i++) {
+    node_t *node = &graph->nodes[i];
+    free(node->preds.items);
+    free(node->weights.items);
+    free(node->succs.items);
+    free(node->aligned.items);
+  }
+  free(graph->nodes);
+  free(graph->order);
+  free(graph->ranks);
+}
+
+
+// Sort the nodes topologically (Kahn's algorithm), into graph->order and graph->ranks.
+static void sort_graph(graph_t *graph) {
+  int n_nodes = graph->n_nodes;
+  graph->order = realloc(graph->order, sizeof(int) * (n_nodes + 1));
+  graph->ranks = realloc(graph->ranks, sizeof(int) * (n_nodes + 1));
+  int *in_degrees = malloc(sizeof(int) * (n_nodes + 1));
+  int head = 0;
+  int tail = 0;
+  int i, j;
+  for (i = 0; i < n_nodes; i++) {
+    in_degrees[i] = graph->nodes[i].preds.len;
+    if (in_degrees[i] == 0) {
+      graph->order[tail++] = i;
+    }
+  }
+  while (head < tail) {
+    int node_id = graph->order[head++];
+    graph->ranks[node_id] = head - 1;
+    node_t *node = &graph->nodes[node_id];
+    for (j = 0; j < node->succs.len; j++) {
+      int succ = node->succs.items[j];
+      in_degrees[succ]--;
+      if (in_degrees[succ] == 0) {
+        graph->order[tail++] = succ;
+      }
+    }
+  }
+  free(in_degrees);
+}
+
+
+static int score_bases(char base1, char base2) {
+  if (base1 == 'N' || base2 == 'N') {
+    return 0;
+  }
+  return base1 == base2 ? MATCH : MISMATCH;
+}
+
+
+// Align a read to the graph. Fills "matches" with the node each base aligns to, or -1 for bases
+// that don't align to any node (insertions).
+// Rows of the dynamic programming matrix are nodes (in topological order, after a row 0 for the
+// start), and columns are bases of the read. The read has to start at the start of the graph (a
+// node with no predecessors), but it can end at any node.
+static void align_to_graph(graph_t *graph, char *seq, int seq_len, int *matches) {
+  int n_rows = graph->n_nodes + 1;
+  int width = seq_len + 1;
+  int *scores = malloc(sizeof(int) * n_rows * width);
+  char *moves = malloc(sizeof(char) * n_rows * width);
+  int *from = malloc(sizeof(int) * n_rows * width);
+  int start_row = 0;
+  int r, i, p;
+  for (i = 0; i <= seq_len; i++) {
+    scores[i] = i * GAP;
+    moves[i] = MOVE_INSERT;
+    from[i] = 0;
+  }
+  for (r = 1; r < n_rows; r++) {
+    node_t *node = &graph->nodes[graph->order[r-1]];
+    int *row = scores + r * width;
+    int n_preds = node->preds.len;
+    for (i = 0; i <= seq_len; i++) {
+      int best = INT_MIN;
+      char move = 0;
+      int best_from = 0;
+      int best_weight = 0;
+      // A node with no predecessors follows the start row. Ties between predecessors go to the
+      // heavier edge, so reads with the same bases follow the same path instead of splitting
+      // between equivalent branches.
+      for (p = 0; p < (n_preds ? n_preds : 1); p++) {
+        int pred_row = n_preds ? graph->ranks[node->preds.items[p]] + 1 : start_row;
+        int weight = n_preds ? node->weights.items[p] : 0;
+        int *prev_row = scores + pred_row * width;
+        if (i > 0) {
+          int score = prev_row[i-1] + score_bases(node->base, toupper(seq[i-1]));
+          if (score > best || (score == best && move == MOVE_MATCH && weight > best_weight)) {
+            best = score;
+            move = MOVE_MATCH;
+            best_from = pred_row;
+            best_weight = weight;
+          }
+        }
+      }
+      for (p = 0; p < (n_preds ? n_preds : 1); p++) {
+        int pred_row = n_preds ? graph->ranks[node->preds.items[p]] + 1 : start_row;
+        int weight = n_preds ? node->weights.items[p] : 0;
+        int score = scores[pred_row * width + i] + GAP;
+        if (score > best || (score == best && move == MOVE_DELETE && weight > best_weight)) {
+          best = score;
+          move = MOVE_DELETE;
+          best_from = pred_row;
+          best_weight = weight;
+        }
+      }
+      if (i > 0 && row[i-1] + GAP > best) {
+        best = row[i-1] + GAP;
+        move = MOVE_INSERT;
+        best_from = r;
+      }
+      row[i] = best;
+      moves[r * width + i] = move;
+      from[r * width + i] = best_from;
+    }
+  }
+  // End at whichever node gives the best score (skipping the rest of the graph is free). Ties go to
+  // the node with more reads.
+  int end_row = 0;
+  for (r = 1; r < n_rows; r++) {
+    int score = scores[r * width + seq_len];
+    int end_score = scores[end_row * width + seq_len];
+    if (end_row == 0 || score > end_score || (score == end_score &&
+        graph->nodes[graph->order[r-1]].reads > graph->nodes[graph->order[end_row-1]].reads)) {
+      end_row = r;
+    }
+  }
+  r = end_row;
+  i = seq_len;
+  while (i > 0) {
+    char move = moves[r * width + i];
+    int next_row = from[r * width + i];
+    if (r == 0 || move == MOVE_INSERT) {
+      matches[i-1] = -1;
+      i--;
+    } else if (move == MOVE_MATCH) {
+      matches[i-1] = graph->order[r-1];
+      i--;
+    }
+    r = r == 0 ? 0 : next_row;
+  }
+  free(scores);
+  free(moves);
+  free(from);
+}
+
+
+// Thread a read through the graph, given its alignment to it. Fills "path" with the node of each
+// base.
+static void add_read(graph_t *graph, char *seq, char *qual, int seq_len, char qual_thres,
+                     int *matches, int *path) {
+  int prev = -1;
+  int i, j;
+  for (i = 0; i < seq_len; i++) {
+    char base = toupper(seq[i]);
+    int node_id = -1;
+    int match = matches[i];
+    if (match >= 0) {
+      // Use the matched node, or the node aligned to it with the same base, if any.
+      if (graph->nodes[match].base == base) {
+        node_id = match;
+      } else {
+        node_t *node = &graph->nodes[match];
+        for (j = 0; j < node->aligned.len; j++) {
+          if (graph->nodes[node->aligned.items[j]].base == base) {
+            node_id = node->aligned.items[j];
+            break;
+          }
+        }
+        if (node_id < 0) {
+          node_id = add_aligned_node(graph, match, base);
+        }
+      }
+    } else {
+      node_id = add_node(graph, base);
+    }
+    graph->nodes[node_id].reads++;
+    if (qual == NULL || qual[i] >= qual_thres) {
+      graph->nodes[node_id].good++;
+    }
+    if (prev >= 0) {
+      add_edge(graph, prev, node_id);
+    }
+    path[i] = node_id;
+    prev = node_id;
+  }
+}
+
+
+// The column group of a node: the lowest id of the nodes aligned with it (including itself).
+static int get_group(graph_t *graph, int node_id) {
+  node_t *node = &graph->nodes[node_id];
+  int group = node_id;
+  int i;
+  for (i = 0; i < node->aligned.len; i++) {
+    if (node->aligned.items[i] < group) {
+      group = node->aligned.items[i];
+    }
+  }
+  return group;
+}
+
+
+// Assign each node a column of the alignment by sorting the groups of aligned nodes topologically.
+// Fills "columns" and returns the number of columns, or ERR_CYCLE if the groups can't be ordered.
+static int get_columns(graph_t *graph, int *columns) {
+  int n_nodes = graph->n_nodes;
+  int *groups = malloc(sizeof(int) * (n_nodes + 1));
+  int *in_degrees = calloc(n_nodes + 1, sizeof(int));
+  int *queue = malloc(sizeof(int) * (n_nodes + 1));
+  int i, j, k;
+  for (i = 0; i < n_nodes; i++) {
+    groups[i] = get_group(graph, i);
+  }
+  for (i = 0; i < n_nodes; i++) {
+    node_t *node = &graph->nodes[i];
+    for (j = 0; j < node->preds.len; j++) {
+      if (groups[node->preds.items[j]] != groups[i]) {
+        in_degrees[groups[i]]++;
+      }
+    }
+  }
+  int head = 0;
+  int tail = 0;
+  int n_groups = 0;
+  for (i = 0; i < n_nodes; i++) {
+    if (groups[i] == i) {
+      n_groups++;
+      if (in_degrees[i] == 0) {
+        queue[tail++] = i;
+      }
+    }
+  }
+  while (head < tail) {
+    int group = queue[head++];
+    columns[group] = head - 1;
+    // Visit the successors of every node in the group.
+    node_t *first = &graph->nodes[group];
+    for (k = -1; k < first->aligned.len; k++) {
+      int node_id = k < 0 ? group : first->aligned.items[k];
+      node_t *node = &graph->nodes[node_id];
+      for (j = 0; j < node->succs.len; j++) {
+        int succ_group = groups[node->succs.items[j]];
+        if (succ_group == group) {
+          continue;
+        }
+        in_degrees[succ_group]--;
+        if (in_degrees[succ_group] == 0) {
+          queue[tail++] = succ_group;
+        }
+      }
+    }
+  }
+  int result = tail == n_groups ? n_groups : ERR_CYCLE;
+  if (result >= 0) {
+    for (i = 0; i < n_nodes; i++) {
+      columns[i] = columns[groups[i]];
+    }
+  }
+  free(groups);
+  free(in_degrees);
+  free(queue);
+  return result;
+}
+
+
+// Find the heaviest path through the graph, where each edge weighs the number of reads along it,
+// and write its bases to "cons" (null-terminated). Like the vote counting in consensus.c, each node
+// on the path is a column, where the votes are the reads with a base there (and a quality score at
+// or above the threshold), plus the reads with a gap. Columns where gaps have the majority are left
+// out, and the base with the most votes is called if it has a majority (otherwise it's an N). So the
+// path only decides which columns are in the consensus; the bases are still decided by votes.
+// Returns the length of the consensus, or ERR_TOO_BIG if it won't fit in "cons_size" characters.
+static int heaviest_path(graph_t *graph, int n_seqs, char *cons, int cons_size) {
+  int n_nodes = graph->n_nodes;
+  int *weights = malloc(sizeof(int) * (n_nodes + 1));
+  int *best_preds = malloc(sizeof(int) * (n_nodes + 1));
+  int *path = malloc(sizeof(int) * (n_nodes + 1));
+  int end = -1;
+  int r, i, j;
+  for (r = 0; r < n_nodes; r++) {
+    int node_id = graph->order[r];
+    node_t *node = &graph->nodes[node_id];
+    weights[node_id] = 0;
+    best_preds[node_id] = -1;
+    for (i = 0; i < node->preds.len; i++) {
+      int weight = weights[node->preds.items[i]] + node->weights.items[i];
+      if (best_preds[node_id] < 0 || weight > weights[node_id]) {
+        weights[node_id] = weight;
+        best_preds[node_id] = node->preds.items[i];
+      }
+    }
+    if (end < 0 || weights[node_id] > weights[end]) {
+      end = node_id;
+    }
+  }
+  int path_len = 0;
+  for (i = end; i >= 0; i = best_preds[i]) {
+    path[path_len++] = i;
+  }
+  int cons_len = 0;
+  for (i = path_len - 1; i >= 0; i--) {
+    node_t *node = &graph->nodes[path[i]];
+    node_t *best = node;
+    int column_reads = node->reads;
+    int votes = node->good;
+    for (j = 0; j < node->aligned.len; j++) {
+      node_t *other = &graph->nodes[node->aligned.items[j]];
+      column_reads += other->reads;
+      votes += other->good;
+      if (other->good > best->good) {
+        best = other;
+      }
+    }
+    // The reads that don't go through this column have a gap here.
+    int gaps = n_seqs - column_reads;
+    votes += gaps;
+    if (gaps * 2 > votes) {
+      continue;
+    }
+    if (cons_len + 1 >= cons_size) {
+      cons_len = ERR_TOO_BIG;
+      break;
+    }
+    cons[cons_len++] = best->good * 2 > votes ? best->base : 'N';
+  }
+  if (cons_len >= 0) {
+    cons[cons_len] = '\0';
+  }
+  free(weights);
+  free(best_preds);
+  free(path);
+  return cons_len;
+}
+
+
+// Align the reads in "seqs" with partial-order alignment.
+// If "out" isn't NULL, the aligned rows are written to it back to back, in the same order, with "-"
+// for gaps, and upper case bases. They aren't null-terminated.
+// If "cons" isn't NULL, the heaviest-path consensus is written to it (see heaviest_path()). "quals"
+// can be NULL, or the quality scores of the reads, in which case bases with quality scores below
+// "qual_thres" don't count as votes in the consensus.
+// Returns the length of the alignment, ERR_TOO_BIG if the rows won't fit in "out_size" characters or
+// the consensus in "cons_size", or ERR_CYCLE if the graph can't be laid out as an alignment.
+int poa(char *seqs[], char *quals[], int n_seqs, char qual_thres, char *out, int out_size,
+        char *cons, int cons_size) {
+  graph_t graph = {NULL, 0, 0, NULL, NULL};
+  int *lens = malloc(sizeof(int) * (n_seqs + 1));
+  int **paths = malloc(sizeof(int *) * (n_seqs + 1));
+  int max_len = 0;
+  int i, j;
+  for (i = 0; i < n_seqs; i++) {
+    lens[i] = strlen(seqs[i]);
+    if (lens[i] > max_len) {
+      max_len = lens[i];
+    }
+    paths[i] = malloc(sizeof(int) * (lens[i] + 1));
+  }
+  int *matches = malloc(sizeof(int) * (max_len + 1));
+  for (i = 0; i < n_seqs; i++) {
+    sort_graph(&graph);
+    align_to_graph(&graph, seqs[i], lens[i], matches);
+    add_read(&graph, seqs[i], quals == NULL ? NULL : quals[i], lens[i], qual_thres, matches,
+             paths[i]);
+  }
+  sort_graph(&graph);
+  int *columns = malloc(sizeof(int) * (graph.n_nodes + 1));
+  int aln_len = get_columns(&graph, columns);
+  if (aln_len >= 0 && out != NULL) {
+    if ((long long) aln_len * n_seqs > out_size) {
+      aln_len = ERR_TOO_BIG;
+    } else {
+      for (i = 0; i < n_seqs; i++) {
+        char *row = out + i * aln_len;
+        memset(row, '-', aln_len);
+        for (j = 0; j < lens[i]; j++) {
+          row[columns[paths[i][j]]] = toupper(seqs[i][j]);
+        }
+      }
+    }
+  }
+  if (aln_len >= 0 && cons != NULL) {
+    if (heaviest_path(&graph, n_seqs, cons, cons_size) < 0) {
+      aln_len = ERR_TOO_BIG;
+    }
+  }
+  for (i = 0; i < n_seqs; i++) {
+    free(paths[i]);
+  }
+  free(paths);
+  free(lens);
+  free(matches);
+  free(columns);
+  free_graph(&graph);
+  return aln_len;
+}
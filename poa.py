@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Partial-order alignment (POA) of the reads in a family (see poa.c). One pass builds a graph of the
+reads, which gives both a multiple sequence alignment and a consensus sequence (the heaviest path
+through the graph). So a family can be aligned and called without a separate MSA and vote count."""
+import os
+import sys
+import errno
+import ctypes
+import argparse
+
+# Locate the library file.
+LIBFILE = 'libpoa.so'
+script_dir = os.path.dirname(os.path.realpath(__file__))
+library_path = os.path.join(script_dir, LIBFILE)
+if not os.path.isfile(library_path):
+  library_path = os.path.join(script_dir, '..', 'lib', LIBFILE)
+  if not os.path.isfile(library_path):
+    ioe = IOError('Library file "'+LIBFILE+'" not found.')
+    ioe.errno = errno.ENOENT
+    raise ioe
+
+poa = ctypes.cdll.LoadLibrary(library_path)
+poa.poa.argtypes = [ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_char_p), ctypes.c_int,
+                    ctypes.c_char, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+
+# Error codes from poa.c.
+ERR_TOO_BIG = -1
+ERR_CYCLE = -2
+
+
+class PoaError(Exception):
+  pass
+
+
+def make_argparser():
+  parser = argparse.ArgumentParser(description='Align a set of sequences with partial-order '
+                                               'alignment, and print the alignment and consensus.')
+  parser.add_argument('fasta', type=argparse.FileType('r'), nargs='?', default=sys.stdin,
+    help='The sequences, in FASTA format (but no multi-line sequences). Omit to read from stdin.')
+  parser.add_argument('-c', '--consensus-only', action='store_true',
+    help='Only print the consensus sequence.')
+  return parser
+
+
+def main(argv):
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+  names = []
+  seqs = []
+  for line in args.fasta:
+    if line.startswith('>'):
+      names.append(line.rstrip('\r\n')[1:])
+    else:
+      seqs.append(line.rstrip('\r\n'))
+  aligned_seqs, cons = align(seqs)
+  if not args.consensus_only:
+    for name, aligned in zip(names, aligned_seqs):
+      print '>'+name
+      print aligned
+  print '>consensus'
+  print cons
+
+
+def align(seqs, quals=None, qual_thres=' '):
+  """Align a list of sequences and build their consensus. Returns a list of the aligned sequences
+  (in the same order, in upper case, with "-" for gaps) and the consensus sequence. See
+  get_consensus() for "quals" and "qual_thres"."""
+  return _poa(seqs, quals, qual_thres, rows=True)
+
+
+def get_consensus(seqs, quals=None, qual_thres=' '):
+  """Build the consensus of a list of sequences with partial-order alignment. This can stand in for
+  consensus.get_consensus(), except the sequences don't have to be aligned: any gaps ("-") are
+  removed first, along with the corresponding quality scores.
+  Like consensus.get_consensus(), each column gets the base held by a majority of the reads, or an N
+  if no base has a majority, and columns where most reads have a gap are left out. Bases with a
+  quality score below "qual_thres" don't count as votes. "quals" is optional, but if given, it must
+  have one quality string per sequence, the same length as it."""
+  if quals:
+    assert len(quals) == len(seqs), 'Different number of sequences and quals.'
+    ungapped_quals = []
+    for seq, qual in zip(seqs, quals):
+      assert len(seq) == len(qual), 'Sequence and quality scores must be the same length.'
+      ungapped_quals.append(''.join(score for base, score in zip(seq, qual) if base != '-'))
+    quals = ungapped_quals
+  seqs = [seq.replace('-', '') for seq in seqs]
+  return _poa(seqs, quals, qual_thres, rows=False)[1]
+
+
+def _poa(seqs, quals, qual_thres, rows=True):
+  n_seqs = len(seqs)
+  if n_seqs == 0:
+    return [], ''
+  seqs_c = (ctypes.c_char_p * n_seqs)()
+  for i, seq in enumerate(seqs):
+    seqs_c[i] = ctypes.c_char_p(seq)
+  quals_c = None
+  if quals:
+    quals_c = (ctypes.c_char_p * n_seqs)()
+    for i, qual in enumerate(quals):
+      quals_c[i] = ctypes.c_char_p(qual)
+  # Start with room for every row (and the consensus) to be twice as long as the longest sequence.
+  max_len = max(1, 2*max(len(seq) for seq in seqs))
+  buf = None
+  if rows:
+    buf = ctypes.create_string_buffer(n_seqs * max_len)
+  cons_buf = ctypes.create_string_buffer(max_len + 1)
+  while True:
+    aln_len = poa.poa(seqs_c, quals_c, n_seqs, qual_thres, buf, len(buf) if rows else 0, cons_buf,
+                      len(cons_buf))
+    if aln_len != ERR_TOO_BIG:
+      break
+    if rows:
+      buf = ctypes.create_string_buffer(len(buf)*2)
+    cons_buf = ctypes.create_string_buffer(len(cons_buf)*2)
+  if aln_len == ERR_CYCLE:
+    raise PoaError('Partial-order graph could not be laid out as an alignment.')
+  aligned_seqs = None
+  if rows:
+    data = buf.raw[:n_seqs*aln_len]
+    aligned_seqs = [data[i*aln_len:(i+1)*aln_len] for i in range(n_seqs)]
+  return aligned_seqs, cons_buf.value
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -15,6 +15,9 @@ double *get_diffs_frac_simple(char *cons, char *seqs[], int n_seqs);
 double **get_diffs_frac_binned(char *cons, char *seqs[], int n_seqs, int seq_len, int bins);
 char *transfer_gaps(char *gapped_seq, char *inseq, char gap_char1, char gap_char2);
 char **transfer_gaps_multi(int n_seqs, char *gapped_seqs[], char *inseqs[], char gap_char1, char gap_char2);
+int base_to_bits(char base);
+int pack_seq(char *seq, int seq_len, unsigned char *out);
+int unpack_seq(unsigned char *packed, int seq_len, char *out);
 
 
 // Return the reverse complement of a sequence.
@@ -234,3 +237,102 @@ char **transfer_gaps_multi(int n_seqs, char *gapped_seqs[], char *inseqs[], char
   }
   return outseqs;
 }
+
+
+/* 2-bit packing of sequences, for the binary families format (see famfile.py).
+ * Each base becomes 2 bits (A=0, C=1, G=2, T=3), 4 per byte, first base in the lowest bits.
+ * Any other character (N, gaps, lowercase, etc) is packed as an A and recorded in an exception list.
+ * Packed layout:
+ *   n_exceptions:      4 bytes, little-endian
+ *   bases:             (seq_len+3)/4 bytes
+ *   exception coords:  n_exceptions * 4 bytes, little-endian
+ *   exception chars:   n_exceptions bytes
+ */
+
+int base_to_bits(char base) {
+  switch (base) {
+    case 'A':
+      return 0;
+    case 'C':
+      return 1;
+    case 'G':
+      return 2;
+    case 'T':
+      return 3;
+    default:
+      return -1;
+  }
+}
+
+
+static void write_uint32(unsigned char *out, unsigned int value) {
+  out[0] = value & 0xff;
+  out[1] = (value >> 8) & 0xff;
+  out[2] = (value >> 16) & 0xff;
+  out[3] = (value >> 24) & 0xff;
+}
+
+
+static unsigned int read_uint32(unsigned char *in) {
+  return in[0] | (in[1] << 8) | (in[2] << 16) | ((unsigned int)in[3] << 24);
+}
+
+
+// Pack "seq" into "out", which must have room for 4 + (seq_len+3)/4 + 5*seq_len bytes.
+// Returns the number of bytes written.
+int pack_seq(char *seq, int seq_len, unsigned char *out) {
+  int packed_len = (seq_len + 3) / 4;
+  unsigned char *bases = out + 4;
+  memset(bases, 0, packed_len);
+  // First pass: pack the bases and count the exceptions.
+  int n_exceptions = 0;
+  int i, bits;
+  for (i = 0; i < seq_len; i++) {
+    bits = base_to_bits(seq[i]);
+    if (bits < 0) {
+      n_exceptions++;
+      bits = 0;
+    }
+    bases[i/4] |= bits << (2 * (i % 4));
+  }
+  write_uint32(out, n_exceptions);
+  // Second pass: record the exceptions.
+  unsigned char *coords = bases + packed_len;
+  unsigned char *chars = coords + 4 * n_exceptions;
+  int e = 0;
+  if (n_exceptions > 0) {
+    for (i = 0; i < seq_len; i++) {
+      if (base_to_bits(seq[i]) < 0) {
+        write_uint32(coords + 4*e, i);
+        chars[e] = seq[i];
+        e++;
+      }
+    }
+  }
+  return 4 + packed_len + 5 * n_exceptions;
+}
+
+
+// Unpack a sequence of "seq_len" bases packed by pack_seq() into "out" (which needs room for
+// seq_len + 1 characters; it will be null-terminated). Returns the number of packed bytes read.
+int unpack_seq(unsigned char *packed, int seq_len, char *out) {
+  static const char BITS_TO_BASE[] = "ACGT";
+  int n_exceptions = read_uint32(packed);
+  int packed_len = (seq_len + 3) / 4;
+  unsigned char *bases = packed + 4;
+  int i;
+  for (i = 0; i < seq_len; i++) {
+    out[i] = BITS_TO_BASE[(bases[i/4] >> (2 * (i % 4))) & 3];
+  }
+  out[seq_len] = '\0';
+  unsigned char *coords = bases + packed_len;
+  unsigned char *chars = coords + 4 * n_exceptions;
+  unsigned int coord;
+  for (i = 0; i < n_exceptions; i++) {
+    coord = read_uint32(coords + 4*i);
+    if (coord < seq_len) {
+      out[coord] = chars[i];
+    }
+  }
+  return 4 + packed_len + 5 * n_exceptions;
+}
@@ -76,3 +76,29 @@ def transfer_gaps_multi(seqs, aligned, gap_char_in='-', gap_char_out='-'):
   for seq in output_c.contents:
     output.append(seq)
   return output
+
+
+def pack_seq(seq):
+  """Pack a sequence into 2 bits per base (plus a list of non-ACGT exceptions).
+  See pack_seq() in seqtools.c for the format."""
+  seq_len = len(seq)
+  out = ctypes.create_string_buffer(4 + (seq_len+3)//4 + 5*seq_len)
+  size = seqtools.pack_seq(ctypes.c_char_p(seq), seq_len, out)
+  return out.raw[:size]
+
+
+def unpack_seq(data, seq_len, offset=0):
+  """Unpack a sequence of length "seq_len" packed by pack_seq(), starting at "offset" in the str
+  "data". Returns the sequence and the offset of the end of the packed data."""
+  packed_len = (seq_len+3)//4
+  if offset + 4 + packed_len > len(data):
+    raise ValueError('Packed sequence extends past the end of the data.')
+  n_exceptions = ord(data[offset]) | ord(data[offset+1]) << 8 | ord(data[offset+2]) << 16 | \
+                 ord(data[offset+3]) << 24
+  size = 4 + packed_len + 5*n_exceptions
+  if offset + size > len(data) or n_exceptions > seq_len:
+    raise ValueError('Packed sequence extends past the end of the data.')
+  out = ctypes.create_string_buffer(seq_len+1)
+  address = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value + offset
+  seqtools.unpack_seq(ctypes.c_void_p(address), seq_len, out)
+  return out.raw[:seq_len], offset+size
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Center-star multiple sequence alignment, for large families. One read is picked as the center,
+every other read is aligned to it with a banded pairwise alignment (banded_align() in swalign.c),
+and the pairwise alignments are merged into one alignment by padding every read's insertions
+relative to the center to the longest insertion at that spot. The cost is linear in the number of
+reads, and bounded for each read by its length and the band width, unlike a full multiple sequence
+alignment."""
+import sys
+import argparse
+import swalign
+
+# How far from the diagonal the banded alignment looks, beyond the difference in length between the
+# read and the center.
+BAND = 10
+
+
+def make_argparser():
+  parser = argparse.ArgumentParser(description='Align a set of sequences with a center-star '
+                                               'alignment.')
+  parser.add_argument('fasta', type=argparse.FileType('r'), nargs='?', default=sys.stdin,
+    help='The sequences, in FASTA format (but no multi-line sequences). Omit to read from stdin.')
+  parser.add_argument('-b', '--band', type=int, default=BAND,
+    help='The band width. Default: %(default)s.')
+  return parser
+
+
+def main(argv):
+  parser = make_argparser()
+  args = parser.parse_args(argv[1:])
+  names = []
+  seqs = []
+  for line in args.fasta:
+    if line.startswith('>'):
+      names.append(line.rstrip('\r\n')[1:])
+    else:
+      seqs.append(line.rstrip('\r\n'))
+  for name, aligned in zip(names, align(seqs, band=args.band)):
+    print '>'+name
+    print aligned
+
+
+def align(seqs, quals=None, band=BAND, center=None):
+  """Align a list of sequences. Returns a list of the aligned sequences, in the same order, in upper
+  case, with "-" for gaps. "center" is the index of the read to use as the center. By default, it's
+  chosen by choose_center(), using "quals" if given (a quality string for each sequence)."""
+  if not seqs:
+    return []
+  seqs = [seq.upper() for seq in seqs]
+  if center is None:
+    center_i = choose_center(seqs, quals)
+  else:
+    center_i = center
+  center = seqs[center_i]
+  # For each read, its bases aligned to each center base (or "-"), and the bases it has inserted
+  # before each center base (and after the last one).
+  aligned_bases = []
+  insertions = []
+  max_insertions = [0] * (len(center) + 1)
+  for i, seq in enumerate(seqs):
+    if i == center_i:
+      bases = list(center)
+      inserted = [''] * (len(center) + 1)
+    else:
+      seq_band = band + abs(len(seq) - len(center))
+      center_aligned, seq_aligned = swalign.banded_align(center, seq, seq_band)
+      bases, inserted = split_alignment(center_aligned, seq_aligned, len(center))
+    aligned_bases.append(bases)
+    insertions.append(inserted)
+    for pos, insertion in enumerate(inserted):
+      if len(insertion) > max_insertions[pos]:
+        max_insertions[pos] = len(insertion)
+  # Build the rows, with insertions left-aligned in the space before each center base.
+  rows = []
+  for bases, inserted in zip(aligned_bases, insertions):
+    row = []
+    for pos in range(len(center) + 1):
+      if max_insertions[pos]:
+        row.append(inserted[pos].ljust(max_insertions[pos], '-'))
+      if pos < len(center):
+        row.append(bases[pos])
+    rows.append(''.join(row))
+  return rows
+
+
+def choose_center(seqs, quals=None):
+  """Return the index of the center read: the one with the highest mean quality score, if quality
+  scores are given, or else the longest. Ties go to the first."""
+  if quals:
+    best_i = None
+    best_mean = None
+    for i, qual in enumerate(quals):
+      mean = sum(bytearray(qual)) / float(len(qual)) if qual else 0
+      if best_mean is None or mean > best_mean:
+        best_i = i
+        best_mean = mean
+    return best_i
+  return max(range(len(seqs)), key=lambda i: (len(seqs[i]), -i))
+
+
+def split_alignment(center_aligned, seq_aligned, center_len):
+  """Split a pairwise alignment to the center into the read's base (or "-") at each center base,
+  and the bases it has inserted before each center base (plus after the last one)."""
+  bases = []
+  inserted = [''] * (center_len + 1)
+  pos = 0
+  for center_base, base in zip(center_aligned, seq_aligned):
+    if center_base == '-':
+      inserted[pos] += base
+    else:
+      bases.append(base)
+      pos += 1
+  return bases, inserted
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -318,6 +318,130 @@ align_t *smith_waterman(seq_pair_t *problem, bool local) {
   return result;
 }
 
+// Globally align "b" to "a", looking only at cells within "band" of the main diagonal, so the
+// time and memory are linear in the length of the sequences. Gaps at the ends are free, so either
+// sequence can extend past the end of the other.
+// Writes the aligned sequences to "out_a" and "out_b" (null-terminated), with "-" for gaps.
+// Returns the length of the alignment, or ERR_TOO_BIG if it won't fit in "out_size" characters
+// (including the null terminator). "a" + "b" lengths + 1 is always enough.
+int banded_align(char *a, char *b, int band, char *out_a, char *out_b, int out_size) {
+  int m = strlen(a);
+  int n = strlen(b);
+  int width = 2 * band + 1;
+  int *scores = malloc(sizeof(int) * (m + 1) * width);
+  // The move into each cell: 'd' for diagonal, 'u' for up (gap in b), 'l' for left (gap in a).
+  char *moves = malloc(sizeof(char) * (m + 1) * width);
+  int i, j, k;
+  for (k = 0; k < (m + 1) * width; k++) {
+    scores[k] = BAND_NEG_INF;
+  }
+  // Cell (i, j) is at scores[i * width + j - i + band].
+  #define CELL(i, j) ((i) * width + (j) - (i) + band)
+  #define IN_BAND(i, j) ((j) >= 0 && (j) <= n && (j) - (i) >= -band && (j) - (i) <= band)
+  for (i = 0; i <= m; i++) {
+    int j_start = i - band > 0 ? i - band : 0;
+    int j_end = i + band < n ? i + band : n;
+    for (j = j_start; j <= j_end; j++) {
+      if (i == 0 && j == 0) {
+        scores[CELL(0, 0)] = 0;
+        moves[CELL(0, 0)] = 0;
+        continue;
+      }
+      // Ties go to the diagonal, then the gap in b.
+      int best = BAND_NEG_INF;
+      char move = 0;
+      if (i > 0 && j > 0) {
+        best = scores[CELL(i-1, j-1)] + (a[i-1] == b[j-1] ? BAND_MATCH : BAND_MISMATCH);
+        move = 'd';
+      }
+      if (i > 0 && IN_BAND(i-1, j) && scores[CELL(i-1, j)] + BAND_GAP > best) {
+        best = scores[CELL(i-1, j)] + BAND_GAP;
+        move = 'u';
+      }
+      if (j > 0 && IN_BAND(i, j-1) && scores[CELL(i, j-1)] + BAND_GAP > best) {
+        best = scores[CELL(i, j-1)] + BAND_GAP;
+        move = 'l';
+      }
+      scores[CELL(i, j)] = best;
+      moves[CELL(i, j)] = move;
+    }
+  }
+  // End anywhere in the last row or column.
+  int end_i = -1;
+  int end_j = -1;
+  for (i = 0; i <= m; i++) {
+    if (IN_BAND(i, n) && (end_i < 0 || scores[CELL(i, n)] > scores[CELL(end_i, end_j)])) {
+      end_i = i;
+      end_j = n;
+    }
+  }
+  for (j = 0; j <= n; j++) {
+    if (IN_BAND(m, j) && (end_i < 0 || scores[CELL(m, j)] > scores[CELL(end_i, end_j)])) {
+      end_i = m;
+      end_j = j;
+    }
+  }
+  int aln_len = 0;
+  if (end_i >= 0) {
+    // The alignment, plus whichever sequence has bases left after the end cell.
+    aln_len = (m - end_i) + (n - end_j);
+    i = end_i;
+    j = end_j;
+    while (i > 0 || j > 0) {
+      char move = moves[CELL(i, j)];
+      aln_len++;
+      if (move == 'd') {
+        i--;
+        j--;
+      } else if (move == 'u') {
+        i--;
+      } else {
+        j--;
+      }
+    }
+  }
+  if (end_i < 0 || aln_len + 1 > out_size) {
+    free(scores);
+    free(moves);
+    return ERR_TOO_BIG;
+  }
+  // Write the alignment from the end backward.
+  k = aln_len;
+  out_a[k] = '\0';
+  out_b[k] = '\0';
+  for (i = m, j = n; i > end_i || j > end_j; ) {
+    k--;
+    if (i > end_i) {
+      out_a[k] = a[--i];
+      out_b[k] = '-';
+    } else {
+      out_a[k] = '-';
+      out_b[k] = b[--j];
+    }
+  }
+  i = end_i;
+  j = end_j;
+  while (i > 0 || j > 0) {
+    char move = moves[CELL(i, j)];
+    k--;
+    if (move == 'd') {
+      out_a[k] = a[--i];
+      out_b[k] = b[--j];
+    } else if (move == 'u') {
+      out_a[k] = a[--i];
+      out_b[k] = '-';
+    } else {
+      out_a[k] = '-';
+      out_b[k] = b[--j];
+    }
+  }
+  #undef CELL
+  #undef IN_BAND
+  free(scores);
+  free(moves);
+  return aln_len;
+}
+
 void print_alignment(align_t *result, int target_len, int query_len) {
   printf("Score: %0.0f  Matches: %d\n", result->score, result->matches);
   printf("Target: %3d %s %-3d\n", result->start_a, result->seqs->a, result->end_a);
@@ -24,6 +24,7 @@
  */
 
 #include <float.h>
+#include <limits.h>
 #include <math.h>
 #include <stdio.h>
 #include <stdlib.h>
@@ -36,6 +37,13 @@
 #define TRANS "TVGHEFCDIJMLKNOPQYWAABSXRZ[\\]^_`tvghefcdijmlknopqywaabsxrz"
 #define TRANS_OFFSET 65
 
+// Scores for banded_align().
+#define BAND_MATCH 2
+#define BAND_MISMATCH -1
+#define BAND_GAP -3
+#define BAND_NEG_INF (INT_MIN / 2)
+#define ERR_TOO_BIG -1
+
 typedef enum { false, true } bool;
 
 typedef struct {
@@ -86,4 +94,6 @@ void destroy_seq_pair(seq_pair_t *pair);
 
 align_t *smith_waterman(seq_pair_t *problem, bool local);
 
+int banded_align(char *a, char *b, int band, char *out_a, char *out_b, int out_size);
+
 void print_alignment(align_t *result, int target_len, int query_len);
@@ -73,6 +73,11 @@ class Align(object):
 # Initialize functions (define types).
 swalign.smith_waterman.restype = ctypes.POINTER(AlignC)
 swalign.revcomp.restype = ctypes.c_char_p
+swalign.banded_align.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p,
+                                 ctypes.c_char_p, ctypes.c_int]
+
+# Error codes from banded_align() in swalign.c.
+ERR_TOO_BIG = -1
 
 
 def smith_waterman(target, query):
@@ -94,6 +99,17 @@ def smith_waterman_duplex(target, query):
     return align
 
 
+def banded_align(target, query, band):
+  """Globally align query to target, only considering alignments within "band" bases of the main
+  diagonal. Gaps at the ends are free. Returns the aligned target and query, with "-" for gaps."""
+  size = len(target) + len(query) + 1
+  out_target = ctypes.create_string_buffer(size)
+  out_query = ctypes.create_string_buffer(size)
+  aln_len = swalign.banded_align(target, query, band, out_target, out_query, size)
+  assert aln_len != ERR_TOO_BIG, 'Banded alignment too long for buffer.'
+  return out_target.value, out_query.value
+
+
 def revcomp(seq):
   """Return the reverse complement of the input sequence.
   Leaves the input string unaltered."""
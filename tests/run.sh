@@ -82,10 +82,37 @@ initial_declarations=$(declare -F)
 # Do all tests.
 function all {
   barcodes
+  families
+  extsort
+  shards
+  correct_sort
+  binary
+  index
+  gzipped
+  truncated
+  multiline
+  filters
+  counts
+  trim
+  ranges
+  interleaved
+  ubam
   align
   align_p3
+  align_mafft_pool
+  align_mafft_fail
+  align_builtin
+  align_fast_path
+  align_poa
+  align_star
+  align_duplex
+  align_parallel
   duplex
   duplex_qual
+  duplex_poa
+  duplex_aligned
+  duplex_aligned_overhang
+  duplex_binary
   stats_diffs
 }
 
@@ -97,6 +124,190 @@ function barcodes {
     | diff -s - "$dirname/families.sort.tsv"
 }
 
+# make_families.py
+function families {
+  echo -e "\tmake_families.py ::: families.raw_[12].fq"
+  python "$dirname/../make_families.py" -t 12 -i 5 "$dirname/families.raw_1.fq" "$dirname/families.raw_2.fq" \
+    | diff -s - "$dirname/families.sort.tsv"
+}
+
+# extsort.py, with a tiny memory budget to force spilling and multi-pass merging
+function extsort {
+  echo -e "\textsort.py ::: families.sort.tsv (reversed)"
+  tac "$dirname/families.sort.tsv" | python "$dirname/../extsort.py" -S 1K --max-runs 2 \
+    | diff -s - "$dirname/families.sort.tsv"
+}
+
+# make_families.py --shards: every barcode in exactly one shard, each shard sorted
+function shards {
+  echo -e "\tmake_families.py --shards 3 ::: families.raw_[12].fq"
+  local prefix=$(mktemp -d)/families
+  python "$dirname/../make_families.py" --shards 3 -o "$prefix" \
+    "$dirname/families.raw_1.fq" "$dirname/families.raw_2.fq"
+  for i in 0 1 2; do
+    LC_ALL=C sort "$prefix.$i.tsv" | diff -s - "$prefix.$i.tsv"
+  done
+  cat "$prefix".*.tsv | LC_ALL=C sort | diff -s - "$dirname/families.sort.tsv"
+  rm -r "$(dirname "$prefix")"
+}
+
+# correct.py --sort on unsorted input with corrected barcodes, compared to sorting its plain output
+function correct_sort {
+  local args=("$dirname/correct.families.tsv" "$dirname/correct.barcodes.fa" "$dirname/correct.sam")
+  for mem in 1G 1K; do
+    echo -e "\tcorrect.py --sort --mem $mem ::: correct.families.tsv"
+    python "$dirname/../correct.py" --sort --mem $mem "${args[@]}" \
+      | diff -s - <(python "$dirname/../correct.py" "${args[@]}" | LC_ALL=C sort)
+  done
+}
+
+# make_families.py --binary, converted back to text with famfile.py
+function binary {
+  echo -e "\tmake_families.py --binary ::: families.raw_[12].fq"
+  python "$dirname/../make_families.py" --binary "$dirname/families.raw_1.fq" "$dirname/families.raw_2.fq" \
+    | python "$dirname/../famfile.py" | diff -s - "$dirname/families.sort.tsv"
+}
+
+# famindex.py on a BGZF copy of families.sort.tsv
+function index {
+  echo -e "\tfamindex.py ::: families.sort.tsv (BGZF)"
+  local families=$(mktemp -d)/families.tsv.gz
+  python "$dirname/../bgzf.py" < "$dirname/families.sort.tsv" > "$families"
+  python "$dirname/../famindex.py" "$families"
+  local barcode=ACCGACACAGACTAGGGATCAAAG
+  python "$dirname/../famindex.py" "$families" "$barcode" \
+    | diff -s - <(awk -F '\t' '$1 == "'$barcode'"' "$dirname/families.sort.tsv")
+  rm -r "$(dirname "$families")"
+}
+
+# make_families.py and dunovo.py on gzipped input, with --compress-output
+function gzipped {
+  echo -e "\tmake_families.py --compress-output ::: families.raw_[12].fq.gz"
+  local tmp=$(mktemp -d)
+  gzip -c "$dirname/families.raw_1.fq" > "$tmp/reads_1.fq.gz"
+  python "$dirname/../bgzf.py" < "$dirname/families.raw_2.fq" > "$tmp/reads_2.fq.gz"
+  python "$dirname/../make_families.py" --compress-output "$tmp/reads_1.fq.gz" "$tmp/reads_2.fq.gz" \
+    | gzip -dc | diff -s - "$dirname/families.sort.tsv"
+  echo -e "\tdunovo.py --compress-output ::: families.msa.tsv.gz"
+  python "$dirname/../bgzf.py" < "$dirname/families.msa.tsv" > "$tmp/families.msa.tsv.gz"
+  python "$dirname/../dunovo.py" --compress-output "$tmp/families.msa.tsv.gz" \
+    | gzip -dc | diff -s - "$dirname/families.cons.fa"
+  rm -r "$tmp"
+}
+
+# extsort.py and make_families.py on truncated gzip files (they should fail instead of using what
+# they could read)
+function truncated {
+  echo -e "\textsort.py, make_families.py ::: truncated gzip and BGZF files"
+  local tmp=$(mktemp -d)
+  for i in $(seq 20); do cat "$dirname/families.sort.tsv"; done | gzip -c > "$tmp/families.tsv.gz"
+  head -c $(($(wc -c < "$tmp/families.tsv.gz") / 2)) "$tmp/families.tsv.gz" > "$tmp/truncated.tsv.gz"
+  if python "$dirname/../extsort.py" "$tmp/truncated.tsv.gz" > /dev/null 2>&1; then
+    echo "Truncated input was accepted."
+  else
+    echo "Truncated input was rejected."
+  fi
+  # A BGZF file cut off at a block boundary, leaving out the EOF marker block.
+  for i in $(seq 20); do cat "$dirname/families.sort.tsv"; done | python "$dirname/../bgzf.py" \
+    | head -c -28 > "$tmp/truncated.bgzf.tsv.gz"
+  if python "$dirname/../extsort.py" "$tmp/truncated.bgzf.tsv.gz" > /dev/null 2>&1; then
+    echo "Truncated BGZF input was accepted."
+  else
+    echo "Truncated BGZF input was rejected."
+  fi
+  # make_families.py should report the failed decompression, not crash with a traceback.
+  for mate in 1 2; do
+    for i in $(seq 20); do cat "$dirname/families.raw_$mate.fq"; done | gzip -c > "$tmp/reads_$mate.fq.gz"
+  done
+  head -c $(($(wc -c < "$tmp/reads_1.fq.gz") / 2)) "$tmp/reads_1.fq.gz" > "$tmp/truncated_1.fq.gz"
+  if python "$dirname/../make_families.py" "$tmp/truncated_1.fq.gz" "$tmp/reads_2.fq.gz" \
+      > /dev/null 2> "$tmp/stderr"; then
+    echo "Truncated FASTQ input was accepted."
+  elif grep -q Traceback "$tmp/stderr"; then
+    echo "Truncated FASTQ input crashed make_families.py."
+  else
+    echo "Truncated FASTQ input was rejected."
+  fi
+  rm -r "$tmp"
+}
+
+# make_families.py on reads wrapped onto multiple lines, with CRLF line endings
+function multiline {
+  echo -e "\tmake_families.py ::: families.raw_[12].fq (multi-line, CRLF)"
+  local tmp=$(mktemp -d)
+  for mate in 1 2; do
+    awk 'NR % 2 == 0 && length($0) > 10 {print substr($0, 1, 10); print substr($0, 11); next} {print}' \
+      "$dirname/families.raw_$mate.fq" | sed 's/$/\r/' > "$tmp/reads_$mate.fq"
+  done
+  python "$dirname/../make_families.py" "$tmp/reads_1.fq" "$tmp/reads_2.fq" \
+    | diff -s - "$dirname/families.sort.tsv"
+  rm -r "$tmp"
+}
+
+# make_families.py with barcode filters that all the test reads pass
+function filters {
+  echo -e "\tmake_families.py --invariant-seq GCATC ::: families.raw_[12].fq"
+  python "$dirname/../make_families.py" --max-n 0 --min-tag-qual 30 --invariant-seq GCATC \
+    --invariant-mismatches 0 --max-repeat 6 --filter-log /dev/null \
+    "$dirname/families.raw_1.fq" "$dirname/families.raw_2.fq" | diff -s - "$dirname/families.sort.tsv"
+}
+
+# make_families.py --counts and famcounts.py
+function counts {
+  echo -e "\tmake_families.py --counts ::: families.raw_[12].fq"
+  local counts=$(mktemp)
+  python "$dirname/../make_families.py" --counts "$counts" \
+    "$dirname/families.raw_1.fq" "$dirname/families.raw_2.fq" > /dev/null
+  python "$dirname/../famcounts.py" "$dirname/families.sort.tsv" | diff -s - "$counts"
+  rm "$counts"
+}
+
+# make_families.py --trim on pairs with short inserts, where reads run into their mates' barcodes
+function trim {
+  echo -e "\tmake_families.py --trim ::: readthrough_[12].fq"
+  python "$dirname/../make_families.py" --trim --filter-log /dev/null \
+    "$dirname/readthrough_1.fq" "$dirname/readthrough_2.fq" | diff -s - "$dirname/readthrough.sort.tsv"
+}
+
+# make_families.py reading byte ranges of the input in 3 processes
+function ranges {
+  echo -e "\tmake_families.py -p 3 ::: families.raw_[12].fq (x2000)"
+  local tmp=$(mktemp -d)
+  # Make the input big enough to split, and give mates the same names.
+  for mate in 1 2; do
+    awk -v mate=$mate '{lines[NR] = $0} END {
+        for (copy = 1; copy <= 2000; copy++) {
+          for (i = 1; i <= NR; i += 4) {
+            print "@copy" copy "." i "/" mate; print lines[i+1]; print "+"; print lines[i+3]
+          }
+        }
+      }' "$dirname/families.raw_$mate.fq" > "$tmp/reads_$mate.fq"
+  done
+  python "$dirname/../make_families.py" "$tmp/reads_1.fq" "$tmp/reads_2.fq" > "$tmp/serial.tsv"
+  python "$dirname/../make_families.py" -p 3 "$tmp/reads_1.fq" "$tmp/reads_2.fq" \
+    | diff -s - "$tmp/serial.tsv"
+  rm -r "$tmp"
+}
+
+# make_families.py --interleaved
+function interleaved {
+  echo -e "\tmake_families.py --interleaved ::: families.raw_[12].fq (interleaved)"
+  local tmp=$(mktemp)
+  paste -d '\n' <(paste - - - - < "$dirname/families.raw_1.fq") \
+    <(paste - - - - < "$dirname/families.raw_2.fq") | tr '\t' '\n' > "$tmp"
+  python "$dirname/../make_families.py" --interleaved "$tmp" | diff -s - "$dirname/families.sort.tsv"
+  rm "$tmp"
+}
+
+# make_families.py on an unaligned BAM made by bam.py
+function ubam {
+  echo -e "\tmake_families.py ::: families.raw_[12].fq (uBAM)"
+  local tmp=$(mktemp)
+  python "$dirname/../bam.py" "$dirname/families.raw_1.fq" "$dirname/families.raw_2.fq" > "$tmp"
+  python "$dirname/../make_families.py" "$tmp" | diff -s - "$dirname/families.sort.tsv"
+  rm "$tmp"
+}
+
 # align_families.py
 function align {
   echo -e "\talign_families.py ::: families.sort.tsv:"
@@ -109,6 +320,78 @@ function align_p3 {
   python "$dirname/../align_families.py" -p 3 "$dirname/families.sort.tsv" | diff -s - "$dirname/families.msa.tsv"
 }
 
+# align_families.py running MAFFT from a single process
+function align_mafft_pool {
+  echo -e "\talign_families.py --mafft-pool -p 3 ::: families.sort.tsv:"
+  python "$dirname/../align_families.py" --mafft-pool -p 3 "$dirname/families.sort.tsv" \
+    | diff -s - "$dirname/families.msa.tsv"
+}
+
+# align_families.py with a MAFFT which always fails (it should exit with an error naming the
+# families it left out, instead of silently dropping them)
+function align_mafft_fail {
+  local tmp=$(mktemp -d)
+  echo -e '#!/bin/sh\nexit 1' > "$tmp/mafft"
+  chmod +x "$tmp/mafft"
+  local barcodes='ACCGACACAGACTAGGGATCAAAG, ACTAGTATAAGCATGATTAAGGCT, TATTTGGAGGTATTGTTGATGAGA'
+  for opts in '-p 1' '-p 3' '--mafft-pool -p 3'; do
+    echo -e "\talign_families.py $opts ::: families.sort.tsv (failing MAFFT):"
+    if PATH="$tmp:$PATH" python "$dirname/../align_families.py" $opts \
+        "$dirname/families.sort.tsv" > /dev/null 2> "$tmp/stderr"; then
+      echo "Failed alignments were accepted."
+    fi
+    tail -n 1 "$tmp/stderr" | diff -s - <(echo "Error: Families from 3 barcodes failed to align and "\
+"were left out of the output: $barcodes")
+  done
+  rm -r "$tmp"
+}
+
+# align_families.py with the built-in aligner (msa.c)
+function align_builtin {
+  echo -e "\talign_families.py --aligner builtin ::: families.sort.tsv:"
+  python "$dirname/../align_families.py" --aligner builtin "$dirname/families.sort.tsv" \
+    | diff -s - "$dirname/families.builtin.msa.tsv"
+}
+
+# The same, with families of only a few substitutions taking the ungapped path instead of the aligner.
+function align_fast_path {
+  echo -e "\talign_families.py --aligner builtin --fast-path ::: families.sort.tsv:"
+  python "$dirname/../align_families.py" --aligner builtin --fast-path \
+    "$dirname/families.sort.tsv" | diff -s - "$dirname/families.builtin.msa.tsv"
+}
+
+# The partial-order aligner gives the same alignment as the built-in one on the toy data.
+function align_poa {
+  echo -e "\talign_families.py --aligner poa ::: families.sort.tsv:"
+  python "$dirname/../align_families.py" --aligner poa "$dirname/families.sort.tsv" \
+    | diff -s - "$dirname/families.builtin.msa.tsv"
+}
+
+# The center-star alignment (star.py) also agrees with the built-in aligner on the toy data, both for
+# every family and for families over the --star-above limit.
+function align_star {
+  echo -e "\talign_families.py --aligner star ::: families.sort.tsv:"
+  python "$dirname/../align_families.py" --aligner star "$dirname/families.sort.tsv" \
+    | diff -s - "$dirname/families.builtin.msa.tsv"
+  echo -e "\talign_families.py --aligner builtin --star-above 1 ::: families.sort.tsv:"
+  python "$dirname/../align_families.py" --aligner builtin --star-above 1 \
+    "$dirname/families.sort.tsv" | diff -s - "$dirname/families.builtin.msa.tsv"
+}
+
+# Both strands of each duplex in one alignment
+function align_duplex {
+  echo -e "\talign_families.py --aligner builtin --align-duplex ::: families.sort.tsv:"
+  python "$dirname/../align_families.py" --aligner builtin --align-duplex \
+    "$dirname/families.sort.tsv" | diff -s - "$dirname/families.duplex.msa.tsv"
+}
+
+# Multiple workers, with duplexes sent out of order (largest first), still give output in order.
+function align_parallel {
+  echo -e "\talign_families.py --aligner builtin -p 2 --window 3 ::: families.sort.tsv:"
+  python "$dirname/../align_families.py" --aligner builtin -p 2 --window 3 \
+    "$dirname/families.sort.tsv" | diff -s - "$dirname/families.builtin.msa.tsv"
+}
+
 # dunovo.py defaults on toy data
 function duplex {
   echo -e "\tdunovo.py ::: families.msa.tsv:"
@@ -123,6 +406,39 @@ function duplex_qual {
   python "$dirname/../dunovo.py" --incl-sscs -q 10 "$dirname/qual.msa.tsv" | diff -s - "$dirname/qual.cons.10.fa"
 }
 
+# dunovo.py with partial-order alignment consensus
+function duplex_poa {
+  echo -e "\tdunovo.py --consensus poa ::: families.msa.tsv qual.msa.tsv:"
+  python "$dirname/../dunovo.py" --consensus poa "$dirname/families.msa.tsv" \
+    | diff -s - "$dirname/families.cons.fa"
+  python "$dirname/../dunovo.py" --consensus poa --incl-sscs -q 20 "$dirname/qual.msa.tsv" \
+    | diff -s - "$dirname/qual.cons.20.fa"
+}
+
+# dunovo.py calling duplex consensuses straight from joint alignments
+function duplex_aligned {
+  echo -e "\tdunovo.py --aligned-duplex ::: families.duplex.msa.tsv:"
+  python "$dirname/../dunovo.py" --aligned-duplex "$dirname/families.duplex.msa.tsv" \
+    | diff -s - "$dirname/families.cons.fa"
+  python "$dirname/../dunovo.py" --aligned-duplex --incl-sscs "$dirname/families.duplex.msa.tsv" \
+    | diff -s - "$dirname/families.cons.incl-sscs.fa"
+}
+
+# dunovo.py --aligned-duplex where one strand's reads run past the other's: the overhangs are left
+# out, as when the two single-strand consensuses are aligned to each other.
+function duplex_aligned_overhang {
+  echo -e "\tdunovo.py --aligned-duplex ::: overhang.duplex.msa.tsv:"
+  python "$dirname/../dunovo.py" --aligned-duplex "$dirname/overhang.duplex.msa.tsv" \
+    | diff -s - <(python "$dirname/../dunovo.py" "$dirname/overhang.msa.tsv")
+}
+
+# dunovo.py on binary input
+function duplex_binary {
+  echo -e "\tdunovo.py ::: families.msa.tsv (binary):"
+  python "$dirname/../famfile.py" --binary "$dirname/families.msa.tsv" \
+    | python "$dirname/../dunovo.py" | diff -s - "$dirname/families.cons.fa"
+}
+
 function duplex_gapqual {
   echo -e "\tdunovo.py ::: gapqual.msa.tsv:"
   python "$dirname/../dunovo.py" --incl-sscs -q 25 "$dirname/gapqual.msa.tsv" | diff -s - "$dirname/gapqual.cons.fa"
@@ -1,6 +1,14 @@
 #!/usr/bin/env python
 import os
-__version__ = '0.5'
+import sys
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(script_dir))
+try:
+  import families
+except (ImportError, IOError):
+  # The C library hasn't been compiled. Fall back to the pure Python parser.
+  families = None
+__version__ = '0.6'
 
 
 class FastqReadGenerator(object):
@@ -14,6 +22,7 @@ class FastqReadGenerator(object):
     print "Its sequence is: "+read.seq
     print "Its quality is:  "+read.qual
   All values (id, name, seq, qual) are whitespace-stripped.
+  If the C library from the parent directory (libfamilies.so) is available, it does the parsing.
   """
 
   def __init__(self, filepath):
@@ -27,6 +36,26 @@ class FastqReadGenerator(object):
     return self.reads()
 
   def reads(self):
+    if families is None:
+      return self.python_reads()
+    else:
+      return self.c_reads()
+
+  def c_reads(self):
+    with open(self.filepath, 'rb') as filehandle:
+      try:
+        for name, seq, qual in families.read_fastq(filehandle):
+          read = Read()
+          read.name = name.strip()
+          if read.name:
+            read.id = read.name.split()[0]
+          read.seq = seq.strip()
+          read.qual = qual.strip()
+          yield read
+      except families.FormatError as error:
+        raise FormatError(str(error))
+
+  def python_reads(self):
     with open(self.filepath, 'rU') as filehandle:
       read = None
       line_type = 'first'
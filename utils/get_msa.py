@@ -8,6 +8,7 @@ import subprocess
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 import consensus
 import seqtools
+import famindex
 
 OPT_DEFAULTS = {'format':'plain', 'qual':20, 'qual_format':'sanger'}
 USAGE = "%(prog)s [options]"
@@ -30,6 +31,10 @@ def main(argv):
          'the read pairs from a single alpha/beta barcode combination (both the alpha-beta and '
          'beta-alpha strands). If "duplex" is given, you must also specify which of the four '
          'possible alignments to output with --mate and --order.')
+  parser.add_argument('-b', '--barcode',
+    help='For --format duplex, read only the family with this barcode from the --input file. If the '
+         'file has an index (see famindex.py), it will seek straight to the family instead of '
+         'reading the whole file.')
   parser.add_argument('-m', '--mate', type=int, choices=(1, 2))
   parser.add_argument('-o', '--order', choices=('ab', 'ba'))
   parser.add_argument('-F', '--qual-format', choices=('sanger',))
@@ -50,6 +55,8 @@ def main(argv):
     fail('Error: You cannot provide sequences in both a file and command-line arguments.')
   if args.format == 'duplex' and not (args.mate and args.order):
     fail('Error: If the --format is duplex, you must specify a --mate and --order.')
+  if args.barcode and (args.format != 'duplex' or not args.input or args.input == '-'):
+    fail('Error: --barcode requires --format duplex and an --input file.')
 
   # Read input.
   quals = []
@@ -61,7 +68,9 @@ def main(argv):
         with open(args.input) as infile:
           seqs = [line.strip() for line in infile]
     elif args.format == 'duplex':
-      if args.input == '-':
+      if args.barcode:
+        (seqs, quals) = parse_duplex(read_barcode(args.input, args.barcode), args.mate, args.order)
+      elif args.input == '-':
         (seqs, quals) = parse_duplex(sys.stdin, args.mate, args.order)
       else:
         with open(args.input) as infile:
@@ -80,6 +89,19 @@ def main(argv):
     print seq
 
 
+def read_barcode(families_path, barcode):
+  """Return the lines of one family from a families file, using its index if it has one."""
+  index = famindex.load_index_for(families_path)
+  if index:
+    infile = famindex.open_families(families_path)
+    try:
+      return list(famindex.read_family(infile, index, barcode))
+    finally:
+      infile.close()
+  with open(families_path) as infile:
+    return [line for line in infile if line.split('\t', 1)[0] == barcode]
+
+
 def parse_duplex(infile, mate, order):
   seqs = []
   quals = []
@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 from __future__ import division
+import os
 import sys
 import argparse
-import getreads
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(script_dir))
+import families
+import bgzf
+import famcounts
+import barcodes
 
 OPT_DEFAULTS = {'tag_len':12, 'const_len':5, 'min_reads':3, 'human':True}
 USAGE = "%(prog)s [options]"
@@ -17,10 +23,13 @@ def main(argv):
   parser = argparse.ArgumentParser(description=DESCRIPTION, epilog=EPILOG)
   parser.set_defaults(**OPT_DEFAULTS)
 
-  parser.add_argument('infile1', metavar='reads_1.fq',
-    help='The first mates in the read pairs.')
-  parser.add_argument('infile2', metavar='reads_2.fq',
-    help='The second mates in the read pairs.')
+  parser.add_argument('infile1', metavar='reads_1.fq', nargs='?',
+    help='The first mates in the read pairs. Can be gzipped.')
+  parser.add_argument('infile2', metavar='reads_2.fq', nargs='?',
+    help='The second mates in the read pairs. Can be gzipped.')
+  parser.add_argument('--counts', metavar='COUNTS_FILE',
+    help='Get the barcode counts from this family size table (from make_families.py --counts) '
+         'instead of reading the reads. Then the reads files aren\'t needed.')
   parser.add_argument('-t', '--tag-length', dest='tag_len', type=int)
   parser.add_argument('-c', '--constant-length', dest='const_len', type=int)
   parser.add_argument('-C', '--computer', dest='human', action='store_false',
@@ -31,64 +40,89 @@ def main(argv):
          '%(default)s')
   parser.add_argument('-v', '--validate', action='store_true',
     help='Check the id\'s of the reads to make sure the correct reads are mated into pairs (the '
-         'id\'s of mates must be identical).')
+         'id\'s of mates must be identical, apart from any "/1" and "/2" suffixes).')
 
   args = parser.parse_args(argv[1:])
 
-  with open(args.infile1) as infileh1:
-    with open(args.infile2) as infileh2:
-      barcodes = read_files(infileh1, infileh2, tag_len=args.tag_len, validate=args.validate)
+  if args.counts:
+    barcode_counts = read_counts(args.counts, tag_len=args.tag_len)
+  elif args.infile1 and args.infile2:
+    infileh1 = bgzf.get_fd_file(bgzf.open_input(args.infile1))
+    infileh2 = bgzf.get_fd_file(bgzf.open_input(args.infile2))
+    try:
+      barcode_counts = read_files(infileh1, infileh2, tag_len=args.tag_len, validate=args.validate)
+    except families.FormatError as error:
+      fail('Error: '+str(error))
+    finally:
+      infileh1.close()
+      infileh2.close()
+  else:
+    fail('Error: Please give either two reads files or a --counts file.')
 
-  stats = get_stats(barcodes, tag_len=args.tag_len, min_reads=args.min_reads)
+  stats = get_stats(barcode_counts, tag_len=args.tag_len, min_reads=args.min_reads)
   print_stats(stats, min_reads=args.min_reads, human=args.human)
 
 
 def read_files(infileh1, infileh2, tag_len=12, validate=False):
-  reader1 = getreads.getparser(infileh1, filetype='fastq').parser()
-  reader2 = getreads.getparser(infileh2, filetype='fastq').parser()
-  barcodes = {}
-  while True:
-    try:
-      read1 = reader1.next()
-      read2 = reader2.next()
-    except StopIteration:
-      break
-    if validate and read1.id != read2.id:
-      raise getreads.FormatError('Read pair mismatch: "{}" and "{}"'.format(read1.id, read2.id))
-    alpha = read1.seq[:tag_len]
-    beta  = read2.seq[:tag_len]
-    barcode = alpha + beta
-    if barcode in barcodes:
-      barcodes[barcode] += 1
+  counts = {}
+  for name1, seq1, qual1, name2, seq2, qual2 in families.read_pairs(infileh1, infileh2, validate):
+    alpha = seq1[:tag_len]
+    beta  = seq2[:tag_len]
+    key = get_key(alpha + beta, tag_len)
+    if key in counts:
+      counts[key] += 1
     else:
-      barcodes[barcode] = 1
-  return barcodes
-
-
-def get_stats(barcodes, tag_len=12, min_reads=3):
+      counts[key] = 1
+  return counts
+
+
+def get_key(barcode, tag_len=12):
+  """Use the barcode encoded as an integer as its dict key, where possible, to save memory. Barcodes
+  with N's, or which are short because the reads were, stay strings."""
+  if len(barcode) == 2*tag_len:
+    code = barcodes.encode(barcode)
+    if code is not None:
+      return code
+  return barcode
+
+
+def read_counts(counts_path, tag_len=12):
+  """Get the same dict as read_files() from a family size table. The table is keyed by the
+  canonical (alpha/beta sorted) barcode, so the "ba" family is the one with the tags swapped."""
+  barcode_counts = {}
+  family_counts, read_pairs = famcounts.load_counts(counts_path)
+  for barcode, counts in family_counts.items():
+    key = get_key(barcode, tag_len)
+    if counts['ab']:
+      barcode_counts[key] = counts['ab']
+    if counts['ba']:
+      swapped = barcodes.swap_halves(key, tag_len)
+      barcode_counts[swapped] = barcode_counts.get(swapped, 0) + counts['ba']
+  return barcode_counts
+
+
+def get_stats(barcode_counts, tag_len=12, min_reads=3):
   passed_sscs = 0
   duplexes = 0
   passed_duplexes = 0
   singletons = 0
   total_pairs = 0
-  for barcode, count in barcodes.items():
+  for key, count in barcode_counts.items():
     total_pairs += count
     if count == 1:
       singletons += 1
     if count >= min_reads:
       passed_sscs += 1
-    alpha = barcode[:tag_len]
-    beta  = barcode[tag_len:]
-    reverse = beta + alpha
-    if reverse in barcodes:
+    reverse = barcodes.swap_halves(key, tag_len)
+    if reverse in barcode_counts:
       duplexes += 1
-      if count >= min_reads and barcodes[reverse] >= min_reads:
+      if count >= min_reads and barcode_counts[reverse] >= min_reads:
         passed_duplexes += 1
   # Each full duplex ends up being counted twice. Halve it to get the real total.
   stats = {
     'pairs':total_pairs,
-    'barcodes':len(barcodes),
-    'avg_pairs':total_pairs/len(barcodes),
+    'barcodes':len(barcode_counts),
+    'avg_pairs':total_pairs/len(barcode_counts),
     'singletons':singletons,
     'duplexes':duplexes//2,
     'passed_sscs':passed_sscs*2,